@@ -0,0 +1,473 @@
+"""
+An in-memory stand-in for the parts of Redis the bot uses, for tests that
+need more than a couple of canned replies. Commands go through the real
+redis-py client methods and response callbacks; only the server is fake.
+"""
+import fnmatch
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from redis import StrictRedis
+from redis.client import StrictPipeline, Token
+from redis.exceptions import NoScriptError, ResponseError, WatchError
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+
+def _number(value):
+    value = _bytes(value).decode()
+    return float(value) if '.' in value or 'inf' in value else int(value)
+
+
+def _score_bound(value):
+    value = _bytes(value).decode()
+    if value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+class FakePipeline(StrictPipeline):
+    def __init__(self, fake, transaction, shard_hint):
+        super().__init__(fake.connection_pool, fake.response_callbacks, transaction, shard_hint)
+        self.fake = fake
+        self.watched = {}
+
+    def immediate_execute_command(self, *args, **options):
+        if args[0] == 'WATCH':
+            self.watching = True
+            for key in args[1:]:
+                self.watched[_bytes(key)] = self.fake.versions.get(_bytes(key), 0)
+            return True
+        return self.fake.execute_command(*args, **options)
+
+    def reset(self):
+        super().reset()
+        self.watched = {}
+
+    def execute(self, raise_on_error=True):
+        hook, self.fake.before_exec = self.fake.before_exec, None
+        if hook is not None and self.watched:
+            hook()
+        try:
+            with self.fake.lock:
+                if any(self.fake.versions.get(key, 0) != version for key, version in self.watched.items()):
+                    raise WatchError('Watched variable changed.')
+                results = []
+                for args, options in self.command_stack:
+                    try:
+                        results.append(self.fake.execute_command(*args, **options))
+                    except ResponseError as e:
+                        results.append(e)
+            if raise_on_error:
+                for result in results:
+                    if isinstance(result, ResponseError):
+                        raise result
+            return results
+        finally:
+            self.reset()
+
+
+class FakeRedis(StrictRedis):
+    """
+    Usage:
+    redis = FakeRedis()
+    redis.sadd('blacklist', 'spez')
+    redis.data  # {b'blacklist': {b'spez'}}
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.data = {}
+        self.expiry = {}
+        self.versions = {}
+        self.published = []
+        self.subscribers = []
+        self.calls = []
+        self.lock = threading.RLock()
+        # Called once, just before the next transaction with a WATCH runs,
+        # to make changes "at the same time" as it
+        self.before_exec = None
+        # There's no Lua here, so scripts are run by Python functions that
+        # do the same thing, taking (redis, keys, args); see `add_script`
+        self.scripts = {}
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return FakePipeline(self, transaction, shard_hint)
+
+    def add_script(self, source, func):
+        self.scripts[hashlib.sha1(source.encode()).hexdigest()] = func
+
+    def execute_command(self, *args, **options):
+        name = str(args[0]).upper()
+        handler = getattr(self, f'_{name.lower()}', None)
+        if handler is None:
+            raise ResponseError(f"ERR unknown command '{name}'")
+        # Keywords like WITHSCORES come in as redis-py Tokens
+        args = tuple(str(arg) if isinstance(arg, Token) else arg for arg in args)
+        with self.lock:
+            self.calls.append(name)
+            raw = handler(*args[1:])
+        if name in self.response_callbacks:
+            return self.response_callbacks[name](raw, **options)
+        return raw
+
+    # Helpers
+
+    def _get_typed(self, key, kind, create=False):
+        key = _bytes(key)
+        value = self.data.get(key)
+        if value is None:
+            if not create:
+                return None
+            value = self.data[key] = kind()
+        if type(value) is not kind:
+            raise ResponseError(WRONGTYPE)
+        return value
+
+    def _touch(self, key):
+        key = _bytes(key)
+        self.versions[key] = self.versions.get(key, 0) + 1
+        value = self.data.get(key)
+        if value is not None and not value and not isinstance(value, bytes):
+            # Redis deletes empty containers
+            del self.data[key]
+            self.expiry.pop(key, None)
+
+    # Keys
+
+    def _del(self, *keys):
+        removed = 0
+        for key in map(_bytes, keys):
+            if self.data.pop(key, None) is not None:
+                removed += 1
+            self.expiry.pop(key, None)
+            self._touch(key)
+        return removed
+
+    def _exists(self, *keys):
+        return sum(_bytes(key) in self.data for key in keys)
+
+    def _type(self, key):
+        value = self.data.get(_bytes(key))
+        kinds = {bytes: b'string', list: b'list', set: b'set', dict: b'hash', OrderedDict: b'stream'}
+        if isinstance(value, _ZSet):
+            return b'zset'
+        return kinds.get(type(value), b'none')
+
+    def _expire(self, key, seconds):
+        if _bytes(key) not in self.data:
+            return 0
+        self.expiry[_bytes(key)] = int(seconds)
+        return 1
+
+    def _ttl(self, key):
+        if _bytes(key) not in self.data:
+            return -2
+        return self.expiry.get(_bytes(key), -1)
+
+    def _rename(self, src, dst):
+        if _bytes(src) not in self.data:
+            raise ResponseError('ERR no such key')
+        self.data[_bytes(dst)] = self.data.pop(_bytes(src))
+        self._touch(src)
+        self._touch(dst)
+        return b'OK'
+
+    def _scan(self, cursor, *args):
+        options = dict(zip(args[::2], args[1::2]))
+        pattern = _bytes(options.get('MATCH', '*')).decode()
+        keys = [key for key in list(self.data) if fnmatch.fnmatchcase(key.decode(), pattern)]
+        return [b'0', keys]
+
+    def pubsub(self, **kwargs):
+        return FakePubSub(self)
+
+    def _publish(self, channel, message):
+        self.published.append((_bytes(channel), _bytes(message)))
+        handlers = [handler for subscribed, handler in self.subscribers if subscribed == _bytes(channel)]
+        for handler in handlers:
+            handler({'type': 'message', 'channel': _bytes(channel), 'data': _bytes(message)})
+        return len(handlers)
+
+    # Strings
+
+    def _get(self, key):
+        return self._get_typed(key, bytes)
+
+    def _set(self, key, value, *args):
+        self.data[_bytes(key)] = _bytes(value)
+        self.expiry.pop(_bytes(key), None)
+        if 'EX' in args:
+            self.expiry[_bytes(key)] = int(args[args.index('EX') + 1])
+        self._touch(key)
+        return b'OK'
+
+    def _incrby(self, key, amount):
+        value = int(self._get_typed(key, bytes) or 0) + int(amount)
+        self.data[_bytes(key)] = _bytes(value)
+        self._touch(key)
+        return value
+
+    def _incr(self, key):
+        return self._incrby(key, 1)
+
+    # Lists
+
+    def _rpush(self, key, *values):
+        items = self._get_typed(key, list, create=True)
+        items.extend(map(_bytes, values))
+        self._touch(key)
+        return len(items)
+
+    def _lpop(self, key):
+        items = self._get_typed(key, list)
+        if not items:
+            return None
+        value = items.pop(0)
+        self._touch(key)
+        return value
+
+    def _lrange(self, key, start, end):
+        items = self._get_typed(key, list) or []
+        end = int(end)
+        return items[int(start):None if end == -1 else end + 1]
+
+    def _llen(self, key):
+        return len(self._get_typed(key, list) or [])
+
+    # Sets
+
+    def _sadd(self, key, *members):
+        items = self._get_typed(key, set, create=True)
+        added = len(set(map(_bytes, members)) - items)
+        items.update(map(_bytes, members))
+        self._touch(key)
+        return added
+
+    def _srem(self, key, *members):
+        items = self._get_typed(key, set) or set()
+        removed = len(set(map(_bytes, members)) & items)
+        items.difference_update(map(_bytes, members))
+        self._touch(key)
+        return removed
+
+    def _smembers(self, key):
+        return list(self._get_typed(key, set) or [])
+
+    def _sismember(self, key, member):
+        return int(_bytes(member) in (self._get_typed(key, set) or set()))
+
+    def _scard(self, key):
+        return len(self._get_typed(key, set) or [])
+
+    # Hashes
+
+    def _hget(self, key, field):
+        return (self._get_typed(key, dict) or {}).get(_bytes(field))
+
+    def _hmget(self, key, *fields):
+        values = self._get_typed(key, dict) or {}
+        return [values.get(_bytes(field)) for field in fields]
+
+    def _hset(self, key, field, value):
+        values = self._get_typed(key, dict, create=True)
+        created = _bytes(field) not in values
+        values[_bytes(field)] = _bytes(value)
+        self._touch(key)
+        return int(created)
+
+    def _hsetnx(self, key, field, value):
+        values = self._get_typed(key, dict, create=True)
+        if _bytes(field) in values:
+            return 0
+        values[_bytes(field)] = _bytes(value)
+        self._touch(key)
+        return 1
+
+    def _hmset(self, key, *pairs):
+        values = self._get_typed(key, dict, create=True)
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            values[_bytes(field)] = _bytes(value)
+        self._touch(key)
+        return b'OK'
+
+    def _hdel(self, key, *fields):
+        values = self._get_typed(key, dict) or {}
+        deleted = sum(values.pop(_bytes(field), None) is not None for field in fields)
+        self._touch(key)
+        return deleted
+
+    def _hgetall(self, key):
+        values = self._get_typed(key, dict) or {}
+        return [item for pair in values.items() for item in pair]
+
+    def _hincrby(self, key, field, amount):
+        values = self._get_typed(key, dict, create=True)
+        value = int(values.get(_bytes(field), 0)) + int(amount)
+        values[_bytes(field)] = _bytes(value)
+        self._touch(key)
+        return value
+
+    # Sorted sets
+
+    def _zadd(self, key, *pairs):
+        scores = self._get_typed(key, _ZSet, create=True)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += _bytes(member) not in scores
+            scores[_bytes(member)] = float(_number(score))
+        self._touch(key)
+        return added
+
+    def _zscore(self, key, member):
+        score = (self._get_typed(key, _ZSet) or {}).get(_bytes(member))
+        return None if score is None else _bytes(score)
+
+    def _ranked(self, key):
+        scores = self._get_typed(key, _ZSet) or {}
+        return sorted(scores.items(), key=lambda item: (-item[1], [-byte for byte in item[0]]))
+
+    def _zrevrank(self, key, member):
+        members = [name for name, _score in self._ranked(key)]
+        return members.index(_bytes(member)) if _bytes(member) in members else None
+
+    def _zrevrange(self, key, start, end, *args):
+        ranked = self._ranked(key)
+        end = int(end)
+        ranked = ranked[int(start):None if end == -1 else end + 1]
+        if 'WITHSCORES' in args:
+            return [item for name, score in ranked for item in (name, _bytes(score))]
+        return [name for name, _score in ranked]
+
+    def _zcount(self, key, low, high):
+        (low, low_open), (high, high_open) = _score_bound(low), _score_bound(high)
+        return sum(
+            (low < score if low_open else low <= score) and (score < high if high_open else score <= high)
+            for score in (self._get_typed(key, _ZSet) or {}).values()
+        )
+
+    def _zcard(self, key):
+        return len(self._get_typed(key, _ZSet) or {})
+
+    # Scripts: run while holding the lock, so they're atomic like in Redis
+
+    def _evalsha(self, sha, numkeys, *args):
+        if sha not in self.scripts:
+            raise NoScriptError('NOSCRIPT No matching script.')
+        numkeys = int(numkeys)
+        return self.scripts[sha](self, list(args[:numkeys]), list(args[numkeys:]))
+
+    def _script(self, subcommand, source):
+        sha = hashlib.sha1(_bytes(source)).hexdigest()
+        if sha not in self.scripts:
+            raise ResponseError('ERR scripts have to be added to FakeRedis with add_script')
+        return sha
+
+    # Streams: entries are an OrderedDict of id -> fields, and the consumer
+    # groups live alongside in `self.groups`
+
+    def _xadd(self, key, *args):
+        entries = self._get_typed(key, OrderedDict, create=True)
+        fields = list(args[args.index('*') + 1:])
+        entry_id = f'{int(time.time() * 1000)}-{len(entries)}'.encode()
+        entries[entry_id] = [_bytes(field) for field in fields]
+        if 'MAXLEN' in args:
+            maxlen = int(args[args.index('MAXLEN') + 2])
+            while len(entries) > maxlen:
+                entries.popitem(last=False)
+        self._touch(key)
+        return entry_id
+
+    @property
+    def groups(self):
+        return self.__dict__.setdefault('_groups', {})
+
+    def _xgroup(self, subcommand, key, group, start, *args):
+        if (_bytes(key), _bytes(group)) in self.groups:
+            raise ResponseError('BUSYGROUP Consumer Group name already exists')
+        if _bytes(key) not in self.data:
+            if 'MKSTREAM' not in args:
+                raise ResponseError('ERR no such key')
+            self.data[_bytes(key)] = OrderedDict()
+        # Delivered up to, and pending ID -> [consumer, delivered at, deliveries]
+        self.groups[(_bytes(key), _bytes(group))] = {'last': None, 'pending': OrderedDict()}
+        return b'OK'
+
+    def _xreadgroup(self, *args):
+        group, consumer = _bytes(args[1]), _bytes(args[2])
+        count = int(args[args.index('COUNT') + 1])
+        key = _bytes(args[args.index('STREAMS') + 1])
+        state = self.groups[(key, group)]
+        entries = self._get_typed(key, OrderedDict) or OrderedDict()
+        ids = list(entries)
+        start = ids.index(state['last']) + 1 if state['last'] in ids else 0
+        fresh = ids[start:start + count]
+        if not fresh:
+            return None
+        for entry_id in fresh:
+            state['pending'][entry_id] = [consumer, time.time(), 1]
+        state['last'] = fresh[-1]
+        return [[key, [[entry_id, entries[entry_id]] for entry_id in fresh]]]
+
+    def _xack(self, key, group, *ids):
+        pending = self.groups[(_bytes(key), _bytes(group))]['pending']
+        return sum(pending.pop(_bytes(entry_id), None) is not None for entry_id in ids)
+
+    def _xpending(self, key, group, start, end, count):
+        pending = self.groups[(_bytes(key), _bytes(group))]['pending']
+        now = time.time()
+        return [
+            [entry_id, consumer, int((now - delivered_at) * 1000), deliveries]
+            for entry_id, (consumer, delivered_at, deliveries) in list(pending.items())[:int(count)]
+        ]
+
+    def _xclaim(self, key, group, consumer, min_idle_ms, *ids):
+        pending = self.groups[(_bytes(key), _bytes(group))]['pending']
+        entries = self._get_typed(key, OrderedDict) or OrderedDict()
+        now = time.time()
+        claimed = []
+        for entry_id in map(_bytes, ids):
+            if entry_id not in pending:
+                continue
+            _owner, delivered_at, deliveries = pending[entry_id]
+            if (now - delivered_at) * 1000 < int(min_idle_ms):
+                continue
+            pending[entry_id] = [_bytes(consumer), now, deliveries + 1]
+            claimed.append([entry_id, entries[entry_id]] if entry_id in entries else None)
+        return claimed
+
+
+class _ZSet(dict):
+    pass
+
+
+class FakePubSub(object):
+    """
+    Messages are handed to the handlers straight away, in the publishing
+    thread.
+    """
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def subscribe(self, **handlers):
+        for channel, handler in handlers.items():
+            self.fake.subscribers.append((_bytes(channel), handler))
+
+    def run_in_thread(self, sleep_time=0, daemon=False):
+        return _Listening()
+
+
+class _Listening(object):
+    def is_alive(self):
+        return True
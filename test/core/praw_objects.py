@@ -0,0 +1,50 @@
+"""
+Real PRAW objects built from the data Reddit sends, without going near the
+network. Use these instead of hand-made stand-ins wherever the attributes
+PRAW does (or doesn't) give an object matter.
+"""
+from praw import Reddit  # type: ignore
+from praw.models import Comment, Message  # type: ignore
+
+_reddit = None
+
+
+def reddit() -> Reddit:
+    global _reddit
+    if _reddit is None:
+        _reddit = Reddit(client_id='test', client_secret='test', user_agent='tor tests', check_for_updates=False)
+    return _reddit
+
+
+def inbox_comment(comment_id: str, submission_id: str, body='', author='pam',
+                  subreddit='TranscribersOfReddit', parent_id=None) -> Comment:
+    """
+    A comment as it comes out of the inbox: it has `context` but, unlike a
+    comment fetched from its thread, no `link_id`.
+    """
+    return Comment(reddit(), _data={
+        'id': comment_id,
+        'name': f't1_{comment_id}',
+        'body': body,
+        'author': author,
+        'subreddit': subreddit,
+        'parent_id': parent_id or f't3_{submission_id}',
+        'context': f'/r/{subreddit}/comments/{submission_id}/some_title/{comment_id}/?context=3',
+        'was_comment': True,
+        'new': True,
+    })
+
+
+def inbox_message(message_id: str, author='pam', subject='hi', body='') -> Message:
+    return Message.parse({
+        'id': message_id,
+        'name': f't4_{message_id}',
+        'author': author,
+        'subject': subject,
+        'body': body,
+        'was_comment': False,
+        'new': True,
+        'dest': 'transcribersofreddit',
+        'replies': '',
+        'subreddit': None,
+    }, reddit())
@@ -1,9 +1,26 @@
+import json
+import os
+import socket
+
 import pytest  # type: ignore
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+from prawcore.exceptions import NotFound  # type: ignore
+
+from tor import __root__
+from tor.core import admin_commands
+from tor.core.admin_commands import CommandRegistry
+from tor.core.admin_commands import _blacklist_candidates
 from tor.core.admin_commands import from_moderator
+from tor.core.admin_commands import ping
+from tor.core.admin_commands import process_blacklist
 from tor.core.admin_commands import process_override
+from tor.core.admin_commands import rebuild_leaderboard
+from tor.core.admin_commands import show_leaderboard
+from tor.helpers.leaderboard import Leaderboard
+
+from .fake_redis import FakeRedis
 
 
 tor = MagicMock()
@@ -34,6 +51,15 @@ def test_from_moderator_true():
     assert from_moderator(reply, config) is True
 
 
+def test_from_moderator_ignores_case():
+    config = Object()
+    config.tor_mods = frozenset({'asdf', 'qwer'})
+    reply = Object()
+    reply.author = 'QWER'
+
+    assert from_moderator(reply, config) is True
+
+
 def test_from_moderator_false():
     config = Object()
     config.tor_mods = ['asdf', 'qwer']
@@ -79,3 +105,240 @@ def test_process_override_not_moderator2(mock_process_done, asd):
 
     message.reply.assert_called_once()
     mock_process_done.assert_called_once()
+
+
+def write_commands(path, function_name):
+    path.write_text(json.dumps({
+        'notAuthorizedResponses': ['Nope'],
+        'commands': {
+            'ping': {
+                'description': 'Ping',
+                'allowedNames': ['someone'],
+                'pythonFunction': function_name,
+            },
+        },
+    }))
+
+
+def test_command_registry_loads_commands(tmp_path):
+    commands_file = tmp_path / 'commands.json'
+    write_commands(commands_file, 'ping')
+
+    registry = CommandRegistry(str(commands_file), functions={'ping': ping})
+    command = registry.get('ping')
+
+    assert command.function is ping
+    assert command.allowed_names == frozenset({'someone'})
+    assert registry.get('nope') is None
+
+
+def test_command_registry_rejects_unknown_functions(tmp_path):
+    commands_file = tmp_path / 'commands.json'
+    write_commands(commands_file, 'update_and_restart')
+
+    with pytest.raises(ValueError):
+        CommandRegistry(str(commands_file), functions={'ping': ping})
+
+
+def test_command_registry_reloads_when_changed(tmp_path):
+    commands_file = tmp_path / 'commands.json'
+    write_commands(commands_file, 'ping')
+    registry = CommandRegistry(str(commands_file), functions={'ping': ping, 'pong': process_override})
+
+    write_commands(commands_file, 'pong')
+    os.utime(str(commands_file), (0, 12345))
+
+    assert registry.get('ping').function is process_override
+
+
+def test_command_registry_keeps_old_commands_on_bad_reload(tmp_path):
+    commands_file = tmp_path / 'commands.json'
+    write_commands(commands_file, 'ping')
+    registry = CommandRegistry(str(commands_file), functions={'ping': ping})
+
+    write_commands(commands_file, 'missing')
+    os.utime(str(commands_file), (0, 12345))
+
+    assert registry.get('ping').function is ping
+
+
+def test_command_registry_validate_raises_on_bad_file(tmp_path):
+    commands_file = tmp_path / 'commands.json'
+    write_commands(commands_file, 'ping')
+    registry = CommandRegistry(str(commands_file), functions={'ping': ping})
+    registry.validate()
+
+    write_commands(commands_file, 'missing')
+    os.utime(str(commands_file), (0, 12345))
+
+    with pytest.raises(ValueError):
+        registry.validate()
+
+
+def test_shipped_commands_file_is_valid():
+    registry = CommandRegistry(os.path.join(__root__, 'commands.json'))
+
+    assert registry.get('ping') is not None
+
+
+class FakeBlacklist(object):
+    def __init__(self, members):
+        self.members = set(members)
+
+    def add(self, *usernames):
+        added = [username not in self.members for username in usernames]
+        self.members.update(usernames)
+        return added
+
+
+def blacklist_config(existing_users, blacklisted=()):
+    config = Object()
+    config.tor_mods = frozenset({'modperson'})
+    config.blacklist = FakeBlacklist(blacklisted)
+    config.r = Object()
+
+    class FakeRedditor(object):
+        def __init__(self, name):
+            self.name = name
+
+        @property
+        def id(self):
+            canonical = {user.casefold(): user for user in existing_users}.get(self.name.casefold())
+            if not canonical:
+                raise NotFound(MagicMock(status_code=404))
+            self.name = canonical
+            return 'abc123'
+
+    config.r.redditor = FakeRedditor
+    return config
+
+
+def test_blacklist_candidates_cleans_up_names():
+    body = 'u/Spammer\n\n/u/other\n# a comment\nspammer\n  third  '
+
+    assert _blacklist_candidates(body, Object()) == (['Spammer', 'other', 'third'], [])
+
+
+def test_process_blacklist_handles_every_name():
+    reply = Object()
+    reply.body = 'spammer\nalready\nmodperson\nnobody\nanother'
+    config = blacklist_config(['Spammer', 'already', 'another'], blacklisted=['already'])
+
+    result = process_blacklist(reply, config)
+
+    assert config.blacklist.members == {'Spammer', 'already', 'another'}
+    assert 'Blacklisted 2 of 5 users' in result
+    assert '(2): Spammer, another' in result
+    assert '(1): nobody' in result
+    assert '(1): modperson' in result
+
+
+class FakeResponse(object):
+    def __init__(self, body, status_code=200, headers=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.encoding = 'utf-8'
+        self.is_redirect = 'location' in self.headers
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+def paste_config(monkeypatch, response, address='104.20.208.21'):
+    config = blacklist_config(['Spammer', 'other'])
+    config.http = Object()
+    config.http.requests = []
+
+    def get(url, **kwargs):
+        config.http.requests.append((url, kwargs))
+        return response
+
+    config.http.get = get
+    monkeypatch.setattr(
+        admin_commands.socket, 'getaddrinfo',
+        lambda host, port, proto: [(socket.AF_INET, socket.SOCK_STREAM, proto, '', (address, port))],
+    )
+    return config
+
+
+def test_blacklist_reads_the_raw_paste(monkeypatch):
+    response = FakeResponse(b'spammer\nu/other\n')
+    config = paste_config(monkeypatch, response)
+
+    usernames, unreadable = _blacklist_candidates('https://pastebin.com/AbC123', config)
+
+    assert (usernames, unreadable) == (['spammer', 'other'], [])
+    [(url, kwargs)] = config.http.requests
+    assert url == 'https://pastebin.com/raw/AbC123'
+    assert kwargs['stream'] is True
+    assert kwargs['allow_redirects'] is False
+    assert response.closed
+
+
+@pytest.mark.parametrize('line,address,response', [
+    # Not a paste site
+    ('http://169.254.169.254/latest/meta-data', '169.254.169.254', FakeResponse(b'')),
+    ('https://example.com/names.txt', '93.184.216.34', FakeResponse(b'')),
+    # A paste site that resolves somewhere it shouldn't
+    ('https://pastebin.com/AbC123', '127.0.0.1', FakeResponse(b'')),
+    ('https://pastebin.com/AbC123', '10.0.0.5', FakeResponse(b'')),
+    # Sent elsewhere, or too big
+    ('https://pastebin.com/AbC123', '104.20.208.21', FakeResponse(b'', 302, {'location': 'http://localhost/'})),
+    ('https://pastebin.com/AbC123', '104.20.208.21', FakeResponse(b'x' * (admin_commands.MAX_PASTE_SIZE + 1))),
+])
+def test_blacklist_refuses_links_it_should_not_read(monkeypatch, line, address, response):
+    config = paste_config(monkeypatch, response, address=address)
+
+    assert _blacklist_candidates(f'spammer\n{line}', config) == (['spammer'], [line])
+
+
+def test_process_blacklist_reports_unreadable_lists(monkeypatch):
+    reply = Object()
+    reply.body = 'spammer\nhttps://example.com/names.txt'
+    config = paste_config(monkeypatch, FakeResponse(b''))
+
+    result = process_blacklist(reply, config)
+
+    assert config.http.requests == []
+    assert "**Couldn't read these lists** (1): https://example.com/names.txt" in result
+
+
+def leaderboard_message(name):
+    reply = Object()
+    reply.author = Object()
+    reply.author.name = name
+    return reply
+
+
+def test_show_leaderboard_reads_the_sorted_set():
+    cfg = Object()
+    cfg.redis = FakeRedis()
+    Leaderboard(cfg.redis).set('pam', 60)
+    Leaderboard(cfg.redis).set('jim', 120)
+    cfg.redis.calls.clear()
+
+    results = show_leaderboard(leaderboard_message('pam'), cfg)
+
+    assert results.startswith('1. u/jim: 120\n2. u/pam: 60\n')
+    assert 'You are number 2 with 60.' in results
+    assert '* grafeas-teal: 1' in results
+    assert 'SCAN' not in cfg.redis.calls
+
+
+def test_rebuild_leaderboard_backfills_from_user_records():
+    cfg = Object()
+    cfg.redis = FakeRedis()
+    cfg.redis.hset('::user::pam', 'transcriptions', '60')
+    cfg.redis.set('::user::jim', json.dumps({'username': 'jim', 'transcriptions': 120}))
+
+    assert rebuild_leaderboard(leaderboard_message('dwight'), cfg) == 'Leaderboard rebuilt with 2 volunteers.'
+    assert Leaderboard(cfg.redis).top(2) == [('jim', 120), ('pam', 60)]
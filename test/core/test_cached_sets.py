@@ -0,0 +1,70 @@
+import threading
+import time
+
+from tor.helpers.cached_sets import CachedRedisSet
+
+from .fake_redis import FakeRedis
+
+
+class SlowRedis(FakeRedis):
+    def smembers(self, name):
+        time.sleep(0.05)
+        return super().smembers(name)
+
+
+def test_membership_is_loaded_once_and_checked_locally():
+    redis = FakeRedis()
+    redis.sadd('blacklist', 'spez')
+    blacklist = CachedRedisSet(redis, 'blacklist')
+
+    assert 'spez' in blacklist
+    assert 'pam' not in blacklist
+    assert len(blacklist) == 1
+    assert redis.calls.count('SMEMBERS') == 1
+
+
+def test_changes_reach_every_copy():
+    redis = FakeRedis()
+    ours = CachedRedisSet(redis, 'blacklist')
+    theirs = CachedRedisSet(redis, 'blacklist')
+    ours.resync()
+    theirs.resync()
+
+    assert ours.add('spez', 'kn0thing') == [True, True]
+    assert ours.add('spez') == [False]
+    assert 'spez' in theirs
+
+    assert theirs.remove('spez') == [True]
+    assert 'spez' not in ours
+    assert redis.smembers('blacklist') == {b'kn0thing'}
+
+
+def test_stale_copy_is_reloaded():
+    redis = FakeRedis()
+    blacklist = CachedRedisSet(redis, 'blacklist', resync_interval=0.01)
+    assert 'spez' not in blacklist
+
+    # Changed behind our back, without an announcement
+    redis.sadd('blacklist', 'spez')
+    time.sleep(0.02)
+
+    assert 'spez' in blacklist
+
+
+def test_only_one_thread_reloads_a_stale_copy():
+    redis = SlowRedis()
+    redis.sadd('blacklist', 'spez')
+    blacklist = CachedRedisSet(redis, 'blacklist', resync_interval=60)
+    blacklist.resync()
+    blacklist._synced_at = 0.5  # long ago, but loaded
+    redis.calls.clear()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append('spez' in blacklist)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True] * 8
+    assert redis.calls.count('SMEMBERS') == 1
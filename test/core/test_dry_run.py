@@ -0,0 +1,192 @@
+import json
+
+import requests
+
+from tor.core.dry_run import DryRunAdapter, DryRunRedis, Journal, Overlay, Recording, _fake_write
+from tor.core.metrics import TimedRedis
+from tor.core.post_state import PostState, PostStateStore, state
+
+
+def _read(journal):
+    journal.close()
+    with open(journal.path) as lines:
+        return [json.loads(line) for line in lines]
+
+
+def test_submit_is_held_back(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    adapter = DryRunAdapter(journal)
+    request = requests.Request('POST', 'https://oauth.reddit.com/api/submit/', data={
+        'sr': 'TranscribersOfReddit', 'title': 'Image | A cat', 'api_type': 'json',
+    }).prepare()
+
+    response = adapter.send(request)
+
+    data = response.json()['json']['data']
+    assert data['name'] == f't3_{data["id"]}'
+    assert '/r/TranscribersOfReddit/' in data['url']
+    assert journal.counts == {('reddit', 'POST /api/submit'): 1}
+    [entry] = _read(journal)
+    assert entry['data'] == {'sr': 'TranscribersOfReddit', 'title': 'Image | A cat'}
+
+
+def test_replay_serves_recorded_responses(tmp_path):
+    path = str(tmp_path / 'traffic.jsonl')
+    request = requests.Request('GET', 'https://www.reddit.com/r/pics/new.json').prepare()
+    for body in ('{"first": 1}', '{"second": 2}'):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body.encode()
+        Recording(path).save(request, response)
+
+    replay = Recording(path).load()
+    adapter = DryRunAdapter(Journal(str(tmp_path / 'journal.jsonl')), replay=replay)
+
+    assert adapter.send(request).json() == {'first': 1}
+    assert adapter.send(request).json() == {'second': 2}
+    assert adapter.send(request).json() == {'second': 2}
+    other = requests.Request('GET', 'https://www.reddit.com/r/aww/new.json').prepare()
+    assert adapter.send(other).status_code == 404
+
+
+def test_posts_that_only_read_are_let_through(tmp_path):
+    path = str(tmp_path / 'traffic.jsonl')
+    url = 'https://oauth.reddit.com/r/TranscribersOfReddit/api/flairselector/'
+    choices = requests.Request('POST', url, data={'link': 't3_abc'}).prepare()
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'{"choices": [{"flair_text": "Unclaimed", "flair_template_id": "fe9d"}]}'
+    Recording(path).save(choices, response)
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    adapter = DryRunAdapter(journal, replay=Recording(path).load())
+
+    assert adapter.send(choices).json()['choices'][0]['flair_text'] == 'Unclaimed'
+    # Which post it's about is part of what was recorded
+    other = requests.Request('POST', url, data={'link': 't3_other'}).prepare()
+    assert adapter.send(other).status_code == 404
+    adapter.send(requests.Request('POST', 'https://oauth.reddit.com/r/TranscribersOfReddit/api/selectflair/', data={
+        'link': 't3_abc', 'flair_template_id': 'fe9d',
+    }).prepare())
+    assert journal.counts == {('reddit', 'POST /r/TranscribersOfReddit/api/selectflair'): 1}
+
+
+class FakeRedis(object):
+    def __init__(self, journal, values=None):
+        self.journal = journal
+        self.overlay = Overlay()
+        self.values = values or {}
+
+    def get(self, key):
+        return self.overlay.read(('GET', key), self.values.get(key))
+
+    def hget(self, key, field):
+        return self.overlay.read(('HGET', key, field), self.values.get(key, {}).get(field))
+
+    def hgetall(self, key):
+        return self.values.get(key, {})
+
+
+def test_fake_writes_add_up(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    conn = FakeRedis(journal, {'::count::': b'41'})
+
+    assert _fake_write(conn, ('INCR', '::count::')) == 42
+    assert _fake_write(conn, ('INCR', '::count::')) == 43
+    assert _fake_write(conn, ('HINCRBY', '::user::pam', 'transcriptions', 2)) == 2
+    assert _fake_write(conn, ('HINCRBY', '::user::pam', 'transcriptions', 2)) == 4
+    assert _fake_write(conn, ('SET', 'key', 'value')) is True
+    assert _fake_write(conn, ('SADD', 'set', 'member')) == 1
+    assert [entry['action'] for entry in _read(journal)] == ['INCR', 'INCR', 'HINCRBY', 'HINCRBY', 'SET', 'SADD']
+
+
+def test_overlay_shows_held_back_writes_to_later_reads():
+    overlay = Overlay()
+    overlay.write(('SADD', 'complete_post_ids', 't3_new'))
+    overlay.write(('SREM', 'complete_post_ids', 't3_old'))
+    overlay.write(('SET', 'key', 'value'))
+    overlay.write(('HMSET', '::user::pam', 'transcriptions', '5', 'flair_suffix', '""'))
+
+    assert overlay.read(('SISMEMBER', 'complete_post_ids', 't3_new'), False) is True
+    assert overlay.read(('SISMEMBER', 'complete_post_ids', 't3_old'), True) is False
+    assert overlay.read(('SISMEMBER', 'complete_post_ids', 't3_other'), True) is True
+    assert overlay.read(('SMEMBERS', 'complete_post_ids'), {b't3_old', b't3_other'}) == {b't3_new', b't3_other'}
+    assert overlay.read(('GET', 'key'), None) == b'value'
+    assert overlay.read(('HMGET', '::user::pam', 'transcriptions', 'username'), [b'1', b'"pam"']) == [b'5', b'"pam"']
+    assert overlay.read(('HGETALL', '::user::pam'), {b'username': b'"pam"'}) == {
+        b'username': b'"pam"', b'transcriptions': b'5', b'flair_suffix': b'""',
+    }
+
+    overlay.write(('HDEL', '::user::pam', 'username', 'flair_suffix'))
+    assert overlay.read(('HGET', '::user::pam', 'username'), b'"pam"') is None
+    assert overlay.read(('HMGET', '::user::pam', 'username', 'transcriptions'), [b'"pam"', b'1']) == [None, b'5']
+    assert overlay.read(('HGETALL', '::user::pam'), {b'username': b'"pam"'}) == {b'transcriptions': b'5'}
+    overlay.write(('HSET', '::user::pam', 'username', '"Pam"'))
+    assert overlay.read(('HGET', '::user::pam', 'username'), b'"pam"') == b'"Pam"'
+
+    overlay.write(('DEL', 'complete_post_ids', 'key'))
+    assert overlay.read(('SMEMBERS', 'complete_post_ids'), {b't3_other'}) == set()
+    assert overlay.read(('GET', 'key'), b'value') is None
+
+
+def listing(*fullnames):
+    return json.dumps({'kind': 'Listing', 'data': {'after': None, 'children': [
+        {'kind': 't1', 'data': {'name': fullname}} for fullname in fullnames
+    ]}})
+
+
+def test_items_marked_as_read_leave_the_unread_listing(tmp_path):
+    path = str(tmp_path / 'traffic.jsonl')
+    unread = requests.Request('GET', 'https://oauth.reddit.com/message/unread/?limit=1024').prepare()
+    response = requests.Response()
+    response.status_code = 200
+    response._content = listing('t1_a', 't1_b', 't4_c').encode()
+    Recording(path).save(unread, response)
+    adapter = DryRunAdapter(Journal(str(tmp_path / 'journal.jsonl')), replay=Recording(path).load())
+
+    adapter.send(requests.Request('POST', 'https://oauth.reddit.com/api/read_message/', data={
+        'id': 't1_a,t4_c',
+    }).prepare())
+
+    children = adapter.send(unread).json()['data']['children']
+    assert [child['data']['name'] for child in children] == ['t1_b']
+
+
+def dry_run_redis(monkeypatch, journal, values):
+    """
+    A `DryRunRedis` whose reads are answered from `values` instead of a
+    Redis server.
+    """
+    def execute_command(self, *args, **options):
+        command, stored = str(args[0]).upper(), values.get(args[1], {})
+        if command == 'HGETALL':
+            return dict(stored)
+        if command == 'HGET':
+            return stored.get(str(args[2]).encode())
+        raise AssertionError(f'Unexpected {command}')
+
+    monkeypatch.setattr(TimedRedis, 'execute_command', execute_command)
+    conn = DryRunRedis()
+    conn.journal = journal
+    conn.overlay = Overlay()
+    return conn
+
+
+def test_post_state_transitions_are_held_back_but_seen(tmp_path, monkeypatch):
+    journal = Journal(str(tmp_path / 'journal.jsonl'))
+    store = PostStateStore(dry_run_redis(monkeypatch, journal, {
+        PostStateStore.key('t3_abc'): {b'state': b'unclaimed', b'origin': b't3_xyz'},
+    }))
+
+    claimed = store.claim('t3_abc', 'pam')
+    assert claimed.ok
+    assert claimed.post.claimant == 'pam'
+    assert store.claim('t3_abc', 'jim').post.claimant == 'pam'
+    assert store.unclaim('t3_abc').ok
+    assert store.get('t3_abc') == PostState(state.unclaimed, origin='t3_xyz')
+    assert store.claim('t3_missing', 'pam').missing
+    assert store.init('t3_new', state.unclaimed).state == state.unclaimed
+    assert store.get('t3_new').state == state.unclaimed
+
+    actions = [entry['action'] for entry in _read(journal)]
+    assert 'EVALSHA' not in actions
+    assert {'HMSET', 'HSET', 'HDEL', 'EXPIRE'} <= set(actions)
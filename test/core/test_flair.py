@@ -0,0 +1,174 @@
+import csv
+import json
+
+import pytest  # type: ignore
+
+from tor.core.users import User
+from tor.helpers import flair
+from tor.helpers.flair import (CUSTOM_FLAIR, FLAIR_UPDATE_QUEUE, _flair_text, _get_flair_css, _split_flair,
+                               push_flair_updates, reconcile_flair, update_user_flair)
+from tor.helpers.leaderboard import Leaderboard
+
+from .fake_redis import FakeRedis
+
+
+@pytest.mark.parametrize('count,css', [
+    (0, 'grafeas'),
+    (49, 'grafeas'),
+    (50, 'grafeas-green'),
+    (99, 'grafeas-green'),
+    (100, 'grafeas-teal'),
+    (250, 'grafeas-purple'),
+    (500, 'grafeas-golden'),
+    (1000, 'grafeas-diamond'),
+    (2500, 'grafeas-ruby'),
+    (5000, 'grafeas-topaz'),
+    (9999, 'grafeas-topaz'),
+    (10000, 'grafeas-jade'),
+])
+def test_get_flair_css(count, css):
+    assert _get_flair_css(count) == css
+
+
+def test_split_flair_keeps_suffix():
+    assert _split_flair('51 Γ - Beta Tester') == (51, ' - Beta Tester')
+    assert _flair_text(*_split_flair('1234 Γ')) == '1234 Γ'
+
+
+class Object(object):
+    pass
+
+
+def config(flairs):
+    cfg = Object()
+    cfg.redis = FakeRedis()
+    cfg.tor = Object()
+    cfg.tor.flair = lambda limit: iter(flairs)
+    return cfg
+
+
+def saved_user(redis, username, transcriptions, suffix=' - Beta Tester'):
+    user = User(username, redis_conn=redis)
+    user.increment('transcriptions', transcriptions)
+    user.update('flair_suffix', suffix)
+    user.save()
+
+
+def queued(cfg):
+    return {username.decode() for username in cfg.redis.smembers(FLAIR_UPDATE_QUEUE)}
+
+
+def test_reconcile_queues_flair_that_fell_behind():
+    cfg = config([
+        {'user': 'pam', 'flair_text': '10 Γ - Beta Tester'},
+        {'user': 'jim', 'flair_text': '7 Γ - Beta Tester'},
+    ])
+    saved_user(cfg.redis, 'pam', 12)
+    saved_user(cfg.redis, 'jim', 7)
+
+    assert reconcile_flair(cfg) == 1
+    assert queued(cfg) == {'pam'}
+
+
+def test_reconcile_leaves_flair_that_is_ahead_alone(caplog):
+    cfg = config([{'user': 'pam', 'flair_text': '50 Γ - Beta Tester'}])
+    saved_user(cfg.redis, 'pam', 12)
+
+    assert reconcile_flair(cfg) == 0
+    assert queued(cfg) == set()
+    assert User('pam', redis_conn=cfg.redis).get('transcriptions') == 12
+    assert 'pam' in caplog.text
+
+
+def test_reconcile_picks_up_unknown_users_from_their_flair():
+    cfg = config([
+        {'user': 'pam', 'flair_text': '51 Γ - Proofreader'},
+        {'user': 'jim', 'flair_text': 'Custom flair'},
+        {'user': 'dwight', 'flair_text': None},
+    ])
+
+    assert reconcile_flair(cfg) == 0
+    pam = User('pam', redis_conn=cfg.redis)
+    assert pam.get('transcriptions') == 51
+    assert pam.get('flair_suffix') == ' - Proofreader'
+    assert Leaderboard(cfg.redis).count('pam') == 51
+    assert not cfg.redis.exists(User.redis_key_for('jim'))
+    assert not cfg.redis.exists(User.redis_key_for('dwight'))
+
+
+def test_reconcile_converts_users_saved_the_old_way():
+    cfg = config([{'user': 'pam', 'flair_text': '10 Γ - Beta Tester'}])
+    cfg.redis.set(User.redis_key_for('pam'), json.dumps({
+        'username': 'pam', 'transcriptions': 12, 'flair_suffix': ' - Beta Tester',
+    }))
+
+    assert reconcile_flair(cfg) == 1
+    assert queued(cfg) == {'pam'}
+    assert cfg.redis.type(User.redis_key_for('pam')) == b'hash'
+
+
+def completed_by(monkeypatch, cfg, author_flair_text):
+    """
+    A `done` from pam, whose flair on Reddit is `author_flair_text`.
+    Returns the list of comments that were looked up to find it.
+    """
+    looked_up = []
+
+    def get_comment(r, fullname):
+        looked_up.append(fullname)
+        comment = Object()
+        comment.author_flair_text = author_flair_text
+        return comment
+
+    monkeypatch.setattr(flair, 'get_comment', get_comment)
+    cfg.r = None
+    post = Object()
+    post.author = 'pam'
+    post.fullname = 't1_e1'
+    return post, looked_up
+
+
+def test_custom_flair_is_only_looked_up_once(monkeypatch):
+    cfg = config([])
+    post, looked_up = completed_by(monkeypatch, cfg, 'Assistant to the Regional Manager')
+
+    update_user_flair(post, cfg)
+    update_user_flair(post, cfg)
+
+    assert looked_up == ['t1_e1']
+    assert User('pam', redis_conn=cfg.redis).get('flair_suffix') is CUSTOM_FLAIR
+    assert Leaderboard(cfg.redis).count('pam') == 2
+    assert queued(cfg) == set()
+
+
+def test_empty_suffix_is_only_looked_up_once(monkeypatch):
+    cfg = config([])
+    post, looked_up = completed_by(monkeypatch, cfg, '10 Γ')
+
+    update_user_flair(post, cfg)
+    update_user_flair(post, cfg)
+
+    assert looked_up == ['t1_e1']
+    assert User('pam', redis_conn=cfg.redis).get('flair_suffix') == ''
+    assert User('pam', redis_conn=cfg.redis).get('transcriptions') == 12
+    assert queued(cfg) == {'pam'}
+
+
+def test_push_escapes_the_flair_csv():
+    cfg = config([])
+    cfg.tor = 'TranscribersOfReddit'
+    cfg.r = Object()
+    cfg.r.posts = []
+    cfg.r.post = lambda url, data: cfg.r.posts.append((url, data)) or [{'ok': True}]
+    saved_user(cfg.redis, 'pam', 12, suffix=' - "Pam", the receptionist')
+    saved_user(cfg.redis, 'jim', 7, suffix=CUSTOM_FLAIR)
+    cfg.redis.sadd(FLAIR_UPDATE_QUEUE, 'pam', 'jim')
+
+    assert push_flair_updates(cfg) == 1
+
+    [(url, data)] = cfg.r.posts
+    assert url == 'r/TranscribersOfReddit/api/flaircsv/'
+    assert list(csv.reader(data['flair_csv'].splitlines())) == [
+        ['pam', '12 Γ - "Pam", the receptionist', 'grafeas'],
+    ]
+    assert queued(cfg) == set()
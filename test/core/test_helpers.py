@@ -0,0 +1,102 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tor.core.helpers import (get_parent_post_id, get_submission, in_object_scope, reddit_object_scope,
+                              serialize_requests)
+
+from .praw_objects import inbox_comment, reddit
+
+
+class Object(object):
+    pass
+
+
+class FakeReddit(object):
+    def submission(self, id):
+        submission = Object()
+        submission.id = id
+        return submission
+
+
+def test_get_parent_post_id_of_an_inbox_comment():
+    # A reply to another comment, as it comes out of the inbox: no link_id
+    comment = inbox_comment('e2', 'abc123', parent_id='t1_e1')
+
+    with reddit_object_scope():
+        parent = get_parent_post_id(comment, reddit())
+
+        assert parent.id == 'abc123'
+        assert get_parent_post_id(comment, reddit()) is parent
+
+
+def test_reddit_object_scope_shares_objects():
+    r = FakeReddit()
+
+    with reddit_object_scope():
+        first = get_submission(r, 'abc123')
+        assert get_submission(r, 't3_abc123') is first
+
+    # Once the scope is over, nothing is remembered
+    assert get_submission(r, 'abc123') is not first
+
+
+def test_reddit_object_scope_is_per_run():
+    r = FakeReddit()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with reddit_object_scope():
+            first = get_submission(r, 'abc123')
+            # Another task's run, side by side with this one
+            other_run = executor.submit(lambda: get_submission(r, 'abc123')).result()
+            worker = executor.submit(in_object_scope(get_submission), r, 'abc123').result()
+
+    assert other_run is not first
+    assert worker is first
+
+
+def test_reddit_object_scope_ends_with_its_run_even_if_others_are_going():
+    r = FakeReddit()
+    started, finish = threading.Event(), threading.Event()
+
+    def long_run():
+        with reddit_object_scope():
+            started.set()
+            finish.wait(5)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(long_run)
+        started.wait(5)
+        with reddit_object_scope():
+            first = get_submission(r, 'abc123')
+        try:
+            assert get_submission(r, 'abc123') is not first
+        finally:
+            finish.set()
+
+
+class SlowSession(object):
+    def __init__(self):
+        self.running = 0
+        self.most_at_once = 0
+
+    def request(self, method, path):
+        self.running += 1
+        self.most_at_once = max(self.most_at_once, self.running)
+        time.sleep(0.01)
+        self.running -= 1
+        return path
+
+
+def test_serialize_requests_lets_one_request_through_at_a_time():
+    r = Object()
+    r._core = r._read_only_core = SlowSession()
+    r._authorized_core = None
+    serialize_requests(r)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        paths = list(executor.map(lambda n: r._core.request('GET', f'/{n}'), range(8)))
+
+    assert paths == [f'/{n}' for n in range(8)]
+    assert r._core is r._read_only_core
+    assert r._core.most_at_once == 1
@@ -0,0 +1,171 @@
+import time
+
+import pytest  # type: ignore
+
+from tor.core import inbox, validation
+from tor.core.inbox import MOD_SUPPORT_PHRASES, _shard_key, classify_reply, intent
+
+from .fake_redis import FakeRedis
+from .praw_objects import inbox_comment, inbox_message
+
+
+class Object(object):
+    pass
+
+
+def reply_with(body):
+    reply = Object()
+    reply.body = body
+    return reply
+
+
+def config(perform_header_check=True):
+    cfg = Object()
+    cfg.perform_header_check = perform_header_check
+    return cfg
+
+
+def legacy_intent(reply, cfg):
+    """
+    The decision chain that process_reply used before the classifier, kept
+    here to make sure the priorities haven't changed.
+    """
+    r_body = reply.body.lower()
+
+    if any([regex.search(reply.body) for regex in MOD_SUPPORT_PHRASES]):
+        return intent.mod_intervention
+    elif 'image transcription' in r_body or validation._footer_check(reply, cfg):
+        return intent.wrong_post_location
+    elif 'i accept' in r_body:
+        return intent.accept_coc
+    elif 'unclaim' in r_body or 'cancel' in r_body:
+        return intent.unclaim
+    elif 'claim' in r_body or 'dibs' in r_body:
+        return intent.claim
+    elif 'done' in r_body or 'deno' in r_body or 'doen' in r_body:
+        return intent.done
+    elif 'thank' in r_body:
+        return intent.thanks
+    elif '!override' in r_body:
+        return intent.override
+    return intent.unhandled
+
+
+@pytest.mark.parametrize('body', [
+    'claim',
+    'Claiming this one!',
+    'DIBS',
+    'unclaim please',
+    'I need to cancel my claim',
+    'done',
+    'Deno',
+    'doen and thanks',
+    'i accept. claim',
+    'Thank you!',
+    '!override',
+    'undone',
+    'What the FUCK, I am done',
+    '*Image Transcription: Tweet*\n\n---\n\nclaim done',
+    "words\n\n^(I'm a human volunteer) www.reddit.com/r/TranscribersOfReddit",
+    'just chatting',
+    '',
+])
+def test_classify_reply_matches_legacy_priorities(body):
+    reply = reply_with(body)
+    cfg = config()
+
+    assert classify_reply(reply, cfg).intent == legacy_intent(reply, cfg)
+
+
+def test_classify_reply_reports_every_match():
+    classified = classify_reply(reply_with('Undo my CLAIM, I am done. Thanks'), config())
+
+    assert classified.intent == intent.mod_intervention
+    assert classified.mod_phrases == ['Undo']
+    assert {intent.claim, intent.done, intent.thanks} <= classified.matched
+
+
+def test_classify_reply_finds_overlapping_keywords():
+    classified = classify_reply(reply_with('UNCLAIM'), config())
+
+    assert classified.intent == intent.unclaim
+    assert classified.keywords == {'unclaim', 'claim'}
+
+
+def test_classify_reply_only_checks_the_footer_when_it_matters(monkeypatch):
+    checked = []
+    monkeypatch.setattr(validation, '_footer_check', lambda reply, cfg: checked.append(reply.body) or False)
+
+    classify_reply(reply_with('undo that'), config())
+    classify_reply(reply_with('*Image Transcription*'), config())
+    assert checked == []
+
+    classify_reply(reply_with('claim'), config())
+    assert checked == ['claim']
+
+
+def test_classify_reply_alt_text():
+    assert classify_reply(reply_with('deno'), config()).alt_text is True
+    assert classify_reply(reply_with('done'), config()).alt_text is False
+
+
+def test_classify_reply_without_header_check():
+    # With the check turned off, everything looks like a transcription
+    classified = classify_reply(reply_with('claim'), config(perform_header_check=False))
+
+    assert classified.intent == intent.wrong_post_location
+
+
+def test_shard_key_for_inbox_comments():
+    # Inbox comments have no link_id; the submission comes from `context`
+    first = inbox_comment('e1', '8swl2n', author='pam')
+    second = inbox_comment('e2', '8swl2n', author='jim', parent_id='t1_e1')
+
+    assert _shard_key(first) == _shard_key(second) == 't3_8swl2n'
+    assert _shard_key(inbox_message('m1', author='Pam')) == _shard_key(inbox_message('m2', author='pam'))
+
+
+class FakeInbox(object):
+    def __init__(self, items):
+        self.items = items
+        self.marked_read = []
+
+    def unread(self, limit=None):
+        # Newest first, like Reddit
+        return iter(reversed(self.items))
+
+    def mark_read(self, items):
+        self.marked_read.extend(items)
+
+
+def test_check_inbox_keeps_order_within_each_shard(monkeypatch):
+    items = [
+        inbox_comment('a1', 'post_a', body='claim'),
+        inbox_comment('b1', 'post_b', body='claim'),
+        inbox_message('m1', author='dwight'),
+        inbox_comment('a2', 'post_a', body='done'),
+        inbox_comment('b2', 'post_b', body='unclaim', parent_id='t1_b1'),
+        inbox_message('m2', author='Dwight'),
+        inbox_comment('a3', 'post_a', body='thanks'),
+    ]
+    handled = []
+
+    def process(item, cfg):
+        # Give the other shards a chance to get in between
+        time.sleep(0.01)
+        handled.append(item.fullname)
+
+    monkeypatch.setattr(inbox, 'process_inbox_item', process)
+    cfg = Object()
+    cfg.r = Object()
+    cfg.r.inbox = FakeInbox(items)
+    cfg.redis = FakeRedis()
+    cfg.inbox_workers = 3
+
+    inbox.check_inbox(cfg)
+
+    assert sorted(handled) == sorted(item.fullname for item in items)
+    for shard in (['t1_a1', 't1_a2', 't1_a3'], ['t1_b1', 't1_b2'], ['t4_m1', 't4_m2']):
+        assert [fullname for fullname in handled if fullname in shard] == shard
+    assert len(cfg.r.inbox.marked_read) == len(items)
+    assert cfg.redis.smembers(inbox.INBOX_CHECKPOINT_KEY) == set()
@@ -0,0 +1,48 @@
+import pytest  # type: ignore
+
+from tor.core.config import Config
+from tor.core.initialize import build_snapshot
+
+PAGES = {
+    'domains': 'video: [youtube.com, vimeo.com]\n---\naudio: [soundcloud.com]\n---\nimages: [imgur.com, i.redd.it]',
+    'subreddits': 'pics\n\nfunny\n',
+    'subreddits/upvote-filtered': 'pics,100\n',
+    'subreddits/domain-filter-bypass': 'funny\n',
+    'subreddits/no-link-header': '',
+    'format/audio': 'audio',
+    'format/video': 'video',
+    'format/images': 'images',
+    'format/other': 'other',
+    'format/header': 'header',
+    'usefulgifs/no': 'https://example.com/no.gif\n',
+}
+
+
+def test_build_snapshot():
+    snapshot = build_snapshot(PAGES, frozenset({'mod'}))
+
+    assert snapshot.video_domains == {'youtube.com', 'vimeo.com'}
+    assert snapshot.image_domains == {'imgur.com', 'i.redd.it'}
+    assert snapshot.subreddits_to_check == ('pics', 'funny')
+    assert snapshot.upvote_filter_subs == {'pics': 100}
+    assert snapshot.no_gifs == ('https://example.com/no.gif',)
+
+
+def test_reload_is_idempotent():
+    cfg = Config()
+    cfg.publish_snapshot(build_snapshot(PAGES, frozenset()))
+    first = cfg.snapshot
+    cfg.publish_snapshot(build_snapshot(PAGES, frozenset()))
+
+    assert cfg.snapshot == first
+    assert cfg.audio_domains == {'soundcloud.com'}
+
+
+def test_snapshot_attributes_are_read_only():
+    cfg = Config()
+
+    with pytest.raises(AttributeError):
+        cfg.tor_mods = frozenset({'someone'})
+
+    cfg.update_snapshot(tor_mods=frozenset({'someone'}))
+    assert cfg.tor_mods == {'someone'}
@@ -0,0 +1,63 @@
+import urllib.request
+
+import pytest  # type: ignore
+
+from tor.core.metrics import Counter, Gauge, Histogram, Registry, _MetricsHandler, start_metrics_server
+
+
+def test_counter_and_gauge_render():
+    registry = Registry()
+    posts = Counter('posts_total', 'Posts', ['outcome'], registry=registry)
+    backlog = Gauge('backlog', 'Backlog', registry=registry)
+
+    posts.inc(outcome='scanned')
+    posts.inc(2, outcome='scanned')
+    backlog.set(7)
+
+    rendered = registry.render()
+    assert '# TYPE posts_total counter' in rendered
+    assert 'posts_total{outcome="scanned"} 3' in rendered
+    assert 'backlog 7' in rendered
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = Histogram('latency_seconds', 'Latency', ['stage'], buckets=(1, 5), registry=registry)
+
+    for value in (0.5, 2, 10):
+        latency.observe(value, stage='inbox')
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{stage="inbox",le="1"} 1' in lines
+    assert 'latency_seconds_bucket{stage="inbox",le="5"} 2' in lines
+    assert 'latency_seconds_bucket{stage="inbox",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{stage="inbox"} 12.5' in lines
+    assert 'latency_seconds_count{stage="inbox"} 3' in lines
+
+
+def test_wrong_labels_are_rejected():
+    counter = Counter('things_total', 'Things', ['kind'], registry=Registry())
+
+    with pytest.raises(ValueError):
+        counter.inc(sort='wrong')
+
+
+def test_metrics_are_served(monkeypatch):
+    registry = Registry()
+    Counter('served_total', 'Served', registry=registry).inc()
+    monkeypatch.setattr(_MetricsHandler, 'registry', registry)
+
+    server = start_metrics_server('127.0.0.1', 0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/metrics') as response:
+            assert 'served_total 1' in response.read().decode()
+    finally:
+        server.shutdown()
+
+
+def test_metrics_server_on_a_taken_port_is_skipped():
+    server = start_metrics_server('127.0.0.1', 0)
+    try:
+        assert start_metrics_server('127.0.0.1', server.server_port) is None
+    finally:
+        server.shutdown()
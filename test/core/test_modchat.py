@@ -0,0 +1,142 @@
+import threading
+import time
+
+from tor.helpers import modchat
+from tor.helpers.modchat import ModchatDispatcher
+
+
+class FakeSlack(object):
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.calls = []
+        self.called = threading.Event()
+
+    def api_call(self, method, **kwargs):
+        self.calls.append(kwargs)
+        self.called.set()
+        return self.responses.pop(0) if self.responses else {'ok': True}
+
+
+def dispatcher(client, **kwargs):
+    kwargs.setdefault('min_interval', 0)
+    kwargs.setdefault('coalesce_window', 0.05)
+    return ModchatDispatcher(client, **kwargs)
+
+
+def test_messages_keep_their_order_and_are_merged():
+    client = FakeSlack()
+    chat = dispatcher(client)
+
+    for message in ('one', 'two', 'three'):
+        chat.send('general', message)
+    chat.send('removed_posts', 'elsewhere')
+    chat.flush()
+
+    assert sorted((call['channel'], call['text']) for call in client.calls) == [
+        ('general', 'one\n\ntwo\n\nthree'),
+        ('removed_posts', 'elsewhere'),
+    ]
+
+
+def test_long_batches_are_split_in_order(monkeypatch):
+    monkeypatch.setattr(modchat, 'MAX_MESSAGE_LENGTH', 10)
+    client = FakeSlack()
+    chat = dispatcher(client)
+
+    for message in ('aaaa', 'bbbb', 'cccc'):
+        chat.send('general', message)
+    chat.flush()
+
+    assert [call['text'] for call in client.calls] == ['aaaa\n\nbbbb', 'cccc']
+
+
+def test_rate_limited_messages_are_sent_again_after_backing_off(monkeypatch):
+    monkeypatch.setattr(modchat, 'RATE_LIMITED_BACKOFF', 0.2)
+    client = FakeSlack([{'ok': False, 'error': 'ratelimited'}])
+    chat = dispatcher(client)
+
+    chat.send('general', 'hello')
+    assert client.called.wait(2)
+    client.called.clear()
+    chat.send('general', 'again')
+
+    # Nothing more until the backoff is over
+    assert not client.called.wait(0.1)
+    assert client.called.wait(2)
+    assert [call['text'] for call in client.calls] == ['hello', 'hello\n\nagain']
+    chat.flush()
+
+
+def test_flush_sends_everything_without_waiting(monkeypatch):
+    client = FakeSlack()
+    chat = dispatcher(client, min_interval=60, coalesce_window=60)
+
+    chat.send('general', 'one')
+    chat.send('general', 'two')
+    chat.flush(timeout=2)
+
+    assert [call['text'] for call in client.calls] == ['one\n\ntwo']
+    assert not chat._thread.is_alive()
+
+
+def test_flush_is_registered_for_exit_once(monkeypatch):
+    registered = []
+    monkeypatch.setattr(modchat.atexit, 'register', registered.append)
+    chat = dispatcher(FakeSlack())
+
+    chat.send('general', 'one')
+    chat.flush()
+    # The sender is gone, so this starts a new one
+    chat.send('general', 'two')
+    chat.flush()
+
+    assert registered == [chat.flush]
+
+
+def test_full_queue_drops_messages():
+    started = threading.Event()
+    release = threading.Event()
+
+    class StuckSlack(FakeSlack):
+        def api_call(self, method, **kwargs):
+            started.set()
+            release.wait(2)
+            return super().api_call(method, **kwargs)
+
+    chat = dispatcher(StuckSlack(), max_queue_size=1, coalesce_window=0)
+    chat.send('general', 'first')
+    assert started.wait(2)
+
+    assert chat.send('general', 'queued') is True
+    assert chat.send('general', 'dropped') is False
+    assert chat.dropped == 1
+    release.set()
+    chat.flush()
+
+
+def test_flush_waits_out_a_short_rate_limit(monkeypatch):
+    monkeypatch.setattr(modchat, 'RATE_LIMITED_BACKOFF', 0.2)
+    client = FakeSlack([{'ok': False, 'error': 'ratelimited'}])
+    chat = dispatcher(client, coalesce_window=60)
+
+    chat.send('general', 'hello')
+    chat.flush(timeout=2)
+
+    assert [call['text'] for call in client.calls] == ['hello', 'hello']
+    assert chat.dropped == 0
+
+
+def test_flush_gives_up_when_rate_limited_for_too_long():
+    client = FakeSlack([{'ok': False, 'error': 'ratelimited'}] * 10)
+    chat = dispatcher(client, coalesce_window=60)
+
+    chat.send('general', 'one')
+    chat.send('general', 'two')
+    started = time.monotonic()
+    chat.flush(timeout=0.3)
+
+    # Sent once, then left alone until time ran out
+    assert [call['text'] for call in client.calls] == ['one\n\ntwo']
+    assert chat.dropped == 1
+    assert not chat._thread.is_alive()
+    assert time.monotonic() - started < 2
@@ -0,0 +1,111 @@
+from tor.core.posts import OCR_PAYLOAD_TTL, queue_ocr_bot
+from tor.helpers.ocr_queue import OCR_MAX_DELIVERIES, OCRJobQueue
+
+from .fake_redis import FakeRedis
+
+
+class Object(object):
+    pass
+
+
+def config(redis, mode):
+    cfg = Object()
+    cfg.redis = redis
+    cfg.ocr_dispatch_mode = mode
+    cfg.image_domains = frozenset({'i.redd.it'})
+    return cfg
+
+
+def submission(fullname='t3_tor123'):
+    post = Object()
+    post.fullname = fullname
+    return post
+
+
+POST = {'name': 't3_abc123', 'domain': 'i.redd.it'}
+
+
+def test_list_mode_queues_payload_with_expiry():
+    redis = FakeRedis()
+
+    queue_ocr_bot(POST, submission(), config(redis, 'list'))
+
+    assert redis.lrange('ocr_ids', 0, -1) == [b't3_abc123']
+    assert redis.ttl('t3_abc123') == OCR_PAYLOAD_TTL
+    # What the OCR bot does with it: take the next ID, look up our post,
+    # and delete the payload once it's done
+    post_name = redis.lpop('ocr_ids')
+    assert redis.get(post_name) == b't3_tor123'
+    redis.delete(post_name)
+    assert redis.llen('ocr_ids') == 0
+    assert redis.get(post_name) is None
+
+
+def test_list_mode_skips_posts_that_are_not_images():
+    redis = FakeRedis()
+
+    queue_ocr_bot(dict(POST, domain='youtube.com'), submission(), config(redis, 'list'))
+
+    assert redis.data == {}
+
+
+def test_stream_mode_publishes_one_entry():
+    redis = FakeRedis()
+
+    queue_ocr_bot(POST, submission(), config(redis, 'stream'))
+
+    queue = OCRJobQueue(redis, consumer='worker-1')
+    queue.ensure_group()
+    [job] = queue.read()
+    assert (job.post_name, job.tor_fullname) == ('t3_abc123', 't3_tor123')
+    # Nothing is left lying around besides the stream itself
+    assert list(redis.data) == [b'ocr_jobs']
+
+
+def test_stream_jobs_are_handed_out_once_and_acked():
+    redis = FakeRedis()
+    queue = OCRJobQueue(redis, consumer='worker-1')
+    queue.ensure_group()
+    queue.ensure_group()  # already exists; not an error
+    first = queue.publish('t3_one', 't3_tor1')
+    second = queue.publish('t3_two', 't3_tor2')
+
+    jobs = queue.read(count=1)
+    assert [job.id for job in jobs] == [first]
+    assert [job.post_name for job in queue.read()] == ['t3_two']
+    assert queue.read() == []
+
+    assert queue.ack(first) == 1
+    assert queue.ack(first) == 0
+    assert queue.ack() == 0
+    pending = redis.execute_command('XPENDING', 'ocr_jobs', 'ocr_workers', '-', '+', 10)
+    assert [entry[0].decode() for entry in pending] == [second]
+
+
+def test_stream_reclaims_jobs_from_a_crashed_worker():
+    redis = FakeRedis()
+    crashed = OCRJobQueue(redis, consumer='worker-1')
+    crashed.ensure_group()
+    crashed.publish('t3_one', 't3_tor1')
+    crashed.read()
+
+    survivor = OCRJobQueue(redis, consumer='worker-2')
+    assert survivor.reclaim(min_idle_ms=60 * 1000) == []
+
+    [job] = survivor.reclaim(min_idle_ms=0)
+    assert job.post_name == 't3_one'
+    survivor.ack(job.id)
+    assert survivor.reclaim(min_idle_ms=0) == []
+
+
+def test_stream_drops_jobs_that_keep_failing():
+    redis = FakeRedis()
+    queue = OCRJobQueue(redis, consumer='worker-1')
+    queue.ensure_group()
+    queue.publish('t3_poison', 't3_tor1')
+    queue.read()
+    for _attempt in range(OCR_MAX_DELIVERIES - 1):
+        assert len(queue.reclaim(min_idle_ms=0)) == 1
+
+    assert queue.reclaim(min_idle_ms=0) == []
+    assert redis.execute_command('XPENDING', 'ocr_jobs', 'ocr_workers', '-', '+', 10) == []
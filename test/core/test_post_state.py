@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest  # type: ignore
+
+from tor.core.helpers import flair
+from tor.core.post_state import PostStateStore, _parse, state, state_from_flair
+
+from .fake_redis import FakeRedis
+
+
+@pytest.mark.parametrize('flair_text,expected', [
+    (None, state.unclaimed),
+    ('', state.unclaimed),
+    (flair.unclaimed, state.unclaimed),
+    (flair.summoned_unclaimed, state.unclaimed),
+    (flair.in_progress, state.in_progress),
+    (flair.completed, state.completed),
+    (flair.meta, None),
+    (flair.disregard, None),
+])
+def test_state_from_flair(flair_text, expected):
+    assert state_from_flair(flair_text) == expected
+
+
+def test_parse_record():
+    post = _parse([
+        b'state', b'in_progress',
+        b'claimant', b'pam',
+        b'origin', b't3_xyz789',
+        b'claimed_at', b'1500000000.5',
+    ])
+
+    assert post.state == state.in_progress
+    assert post.claimant == 'pam'
+    assert post.origin == 't3_xyz789'
+    assert post.claimed_at == 1500000000.5
+    assert post.completed_at is None
+
+
+def test_parse_missing_record():
+    assert _parse([]) is None
+
+
+def store():
+    redis = FakeRedis()
+    posts = PostStateStore(redis)
+    posts.init('t3_abc', state.unclaimed, origin='t3_xyz')
+    return posts
+
+
+def test_claim_unclaim_and_complete():
+    posts = store()
+
+    claimed = posts.claim('t3_abc', 'pam')
+    assert claimed.ok
+    assert (claimed.post.state, claimed.post.claimant, claimed.post.origin) == (state.in_progress, 'pam', 't3_xyz')
+
+    unclaimed = posts.unclaim('t3_abc')
+    assert unclaimed.ok
+    assert (unclaimed.post.state, unclaimed.post.claimant, unclaimed.post.claimed_at) == (state.unclaimed, '', None)
+
+    posts.claim('t3_abc', 'jim')
+    completed = posts.complete('t3_abc')
+    assert completed.ok
+    assert completed.post.state == state.completed
+    assert completed.post.completed_at is not None
+
+    reopened = posts.reopen('t3_abc')
+    assert reopened.ok
+    assert (reopened.post.state, reopened.post.claimant, reopened.post.completed_at) == (state.in_progress, 'jim', None)
+
+
+def test_only_one_claim_wins_a_race():
+    posts = store()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda name: posts.claim('t3_abc', name), [f'user{n}' for n in range(8)]))
+
+    [winner] = [result for result in results if result.ok]
+    losers = [result for result in results if not result.ok]
+    assert len(losers) == 7
+    assert all(result.result == 0 and result.post.claimant == winner.post.claimant for result in losers)
+
+
+def test_claiming_again_leaves_the_claim_alone():
+    posts = store()
+    posts.claim('t3_abc', 'pam')
+
+    again = posts.claim('t3_abc', 'pam')
+
+    assert not again.ok
+    assert (again.post.state, again.post.claimant) == (state.in_progress, 'pam')
+
+
+def test_transitions_from_the_wrong_state_do_nothing():
+    posts = store()
+
+    completed = posts.complete('t3_abc')
+    assert completed.result == 0
+    assert completed.post.state == state.unclaimed
+    assert posts.unclaim('t3_abc').result == 0
+    assert posts.claim('t3_missing', 'pam').missing
@@ -0,0 +1,56 @@
+from tor.core import posts
+from tor.core.trace import LifecycleTrace
+
+from .fake_redis import FakeRedis
+
+
+class Object(object):
+    pass
+
+
+def config():
+    cfg = Object()
+    cfg.redis = FakeRedis()
+    cfg.traces = LifecycleTrace(cfg.redis)
+    cfg.image_domains = []
+    cfg.audio_domains = []
+    cfg.video_domains = ['youtube.com']
+    cfg.video_formatting = 'video'
+    return cfg
+
+
+def new_post():
+    return {
+        'name': 't3_abc123',
+        'subreddit': 'videos',
+        'created_utc': 1000.0,
+        'author': 'pam',
+        'domain': 'youtube.com',
+        'url': 'https://www.youtube.com/watch?v=abc',
+    }
+
+
+def test_untranscribable_video_is_not_traced(monkeypatch):
+    cfg = config()
+    monkeypatch.setattr(posts, 'should_process_post', lambda post, cfg: True)
+    monkeypatch.setattr(posts, 'is_transcribable_youtube_video', lambda url: False)
+    monkeypatch.setattr(posts, 'add_complete_post_id', lambda url, cfg: None)
+
+    posts.process_post(new_post(), cfg)
+
+    assert cfg.traces.get('t3_abc123') == {}
+
+
+def test_posted_video_is_traced_from_discovery(monkeypatch):
+    cfg = config()
+    requested = []
+    monkeypatch.setattr(posts, 'should_process_post', lambda post, cfg: True)
+    monkeypatch.setattr(posts, 'is_transcribable_youtube_video', lambda url: True)
+    monkeypatch.setattr(posts, 'request_transcription', lambda post, *args: requested.append(post['name']))
+
+    posts.process_post(new_post(), cfg)
+
+    assert requested == ['t3_abc123']
+    trace = cfg.traces.get('t3_abc123')
+    assert trace['subreddit'] == 'videos'
+    assert 'discovered' in trace
@@ -0,0 +1,40 @@
+import os
+import time
+from unittest.mock import MagicMock
+
+from tor.core.profiling import Profiler, mode
+
+
+def busy(cfg):
+    end = time.monotonic() + 0.05
+    while time.monotonic() < end:
+        sum(range(1000))
+
+
+def test_sampled_profile_writes_folded_stacks(tmp_path):
+    profiler = Profiler(str(tmp_path), sample_interval=0.001)
+    reply = MagicMock()
+    assert profiler.start(2, reply=reply)
+    assert not profiler.start(1)
+
+    profiler.wrap('inbox', busy)(None)
+    assert profiler.active
+    profiler.wrap('inbox', busy)(None)
+
+    assert not profiler.active
+    folded, = os.listdir(str(tmp_path))
+    assert folded.endswith('.folded')
+    with open(os.path.join(str(tmp_path), folded)) as stacks:
+        assert any(line.startswith('inbox;') and 'test_profiling:busy' in line for line in stacks)
+    assert 'Profiled 2 runs' in reply.reply.call_args[0][0]
+
+
+def test_cprofile_only_counts_chosen_tasks(tmp_path):
+    profiler = Profiler(str(tmp_path), profile_mode=mode.cprofile)
+    profiler.start(1, tasks=['scan'])
+
+    assert profiler.wrap('inbox', busy) is busy
+    profiler.wrap('scan', busy)(None)
+
+    assert not profiler.active
+    assert [name[-7:] for name in os.listdir(str(tmp_path))] == ['.pstats']
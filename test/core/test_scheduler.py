@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+
+import pytest  # type: ignore
+
+from tor.core.scheduler import Scheduler, Task, load_schedule
+
+
+def noop(cfg):
+    pass
+
+
+def run_for(scheduler, seconds):
+    threading.Timer(seconds, scheduler.stop).start()
+    scheduler.run()
+
+
+def test_load_schedule_applies_overrides(tmp_path):
+    schedule = tmp_path / 'schedule.json'
+    schedule.write_text(json.dumps({'inbox': {'interval': 5, 'concurrency': 2}}))
+    tasks = [Task('inbox', noop, interval=10), Task('scan', noop, interval=30)]
+
+    inbox, scan = load_schedule(tasks, str(schedule))
+
+    assert (inbox.interval, inbox.concurrency) == (5, 2)
+    assert scan == tasks[1]
+    assert load_schedule(tasks, str(tmp_path / 'missing.json')) == tasks
+
+
+def test_load_schedule_rejects_unknown_tasks(tmp_path):
+    schedule = tmp_path / 'schedule.json'
+    schedule.write_text(json.dumps({'inbx': {'interval': 5}}))
+
+    with pytest.raises(ValueError):
+        load_schedule([Task('inbox', noop, interval=10)], str(schedule))
+
+
+def test_crashing_task_is_restarted_alone():
+    runs = {'good': 0, 'bad': 0}
+
+    def good(cfg):
+        runs['good'] += 1
+
+    def bad(cfg):
+        runs['bad'] += 1
+        raise RuntimeError('boom')
+
+    scheduler = Scheduler(None, [Task('good', good, interval=0.01), Task('bad', bad, interval=0.01)])
+    run_for(scheduler, 1.8)
+
+    # Restarted after 1s, and the other task kept going the whole time
+    assert runs['bad'] == 2
+    assert runs['good'] > 10
+
+
+def test_slow_run_does_not_exceed_concurrency():
+    running = []
+    most = []
+    lock = threading.Lock()
+
+    def slow(cfg):
+        with lock:
+            running.append(1)
+            most.append(len(running))
+        time.sleep(0.2)
+        with lock:
+            running.pop()
+
+    scheduler = Scheduler(None, [Task('slow', slow, interval=0, timeout=0.05, concurrency=2)])
+    run_for(scheduler, 0.5)
+
+    assert max(most) == 2
+
+
+def test_timed_out_run_is_counted_until_it_ends():
+    finish = threading.Event()
+    overrunning = []
+
+    def slow(cfg):
+        finish.wait(5)
+
+    scheduler = Scheduler(None, [Task('slow', slow, interval=0, timeout=0.05)])
+
+    def check():
+        overrunning.append(scheduler.overrunning['slow'])
+        finish.set()
+
+    threading.Timer(0.3, check).start()
+    run_for(scheduler, 0.6)
+
+    assert overrunning == [1]
+    assert scheduler.overrunning['slow'] == 0
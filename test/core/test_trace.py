@@ -0,0 +1,58 @@
+from tor.cli.trace import show, stats
+from tor.core.trace import group_steps, last_stage, percentile, steps
+
+TRACE = {
+    'subreddit': 'pics',
+    'created': '1000.0',
+    'discovered': '1060.0',
+    'posted': '1065.0',
+    'claimed': '1665.0',
+}
+
+
+class FakeTraces(object):
+    def __init__(self, traces):
+        self.traces = traces
+
+    def scan(self):
+        return iter(self.traces.items())
+
+    def get(self, post_id):
+        return self.traces.get(post_id, {})
+
+
+def test_steps_between_reached_stages():
+    assert steps(TRACE) == {
+        ('created', 'discovered'): 60,
+        ('discovered', 'posted'): 5,
+        ('posted', 'claimed'): 600,
+        ('created', 'claimed'): 665,
+    }
+    # Nothing between stages that were skipped
+    assert steps({'posted': '10', 'completed': '70'}) == {('posted', 'completed'): 60}
+    assert last_stage(TRACE) == 'claimed'
+
+
+def test_group_steps_by_subreddit():
+    traces = [('t3_a', TRACE), ('t3_b', {'subreddit': 'funny', 'discovered': '0', 'posted': '3'})]
+
+    groups = group_steps(iter(traces), by_subreddit=True)
+
+    assert groups['funny'][('discovered', 'posted')] == [3]
+    assert groups['pics'][('posted', 'claimed')] == [600]
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([7], 90) == 7
+
+
+def test_cli_output():
+    traces = FakeTraces({'t3_abc': TRACE})
+
+    assert any('posted -> claimed' in line and 'p50=10.0m' in line for line in stats(traces))
+    assert show(traces, 'abc')[0] == 't3_abc (pics)'
+    assert show(traces, 'nope') == ['No trace for t3_nope.']
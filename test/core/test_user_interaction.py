@@ -0,0 +1,157 @@
+import pytest  # type: ignore
+from praw.exceptions import APIException  # type: ignore
+
+from tor.core import user_interaction
+from tor.core.helpers import flair, get_submission, reddit_object_scope
+from tor.core.post_state import PostState, PostStateStore, state
+from tor.core.trace import LifecycleTrace
+
+from .fake_redis import FakeRedis
+from .praw_objects import inbox_comment, reddit
+
+
+class Object(object):
+    pass
+
+
+def test_unclaim_from_the_inbox_uses_the_shared_submission(monkeypatch):
+    looked_up = []
+
+    def load_post_state(submission, cfg):
+        looked_up.append(submission)
+        return PostState(state.unclaimed)
+
+    monkeypatch.setattr(user_interaction, 'load_post_state', load_post_state)
+    comment = inbox_comment('e2', 'abc123', body='unclaim', parent_id='t1_e1')
+    replies = []
+    comment.reply = replies.append
+    cfg = Object()
+    cfg.r = reddit()
+
+    with reddit_object_scope():
+        user_interaction.process_unclaim(comment, cfg)
+
+        assert looked_up == [get_submission(cfg.r, 'abc123')]
+    assert replies == [user_interaction._(user_interaction.i18n['responses']['unclaim']['still_unclaimed'])]
+
+
+def responses(section, name):
+    return user_interaction._(user_interaction.i18n['responses'][section][name])
+
+
+def config(monkeypatch):
+    cfg = Object()
+    cfg.r = reddit()
+    cfg.redis = FakeRedis()
+    cfg.post_states = PostStateStore(cfg.redis)
+    cfg.post_states.init('t3_abc123', state.unclaimed, origin='t3_xyz789')
+    cfg.traces = LifecycleTrace(cfg.redis)
+    cfg.accepted_coc = {'pam', 'jim'}
+
+    cfg.flairs = []
+    cfg.credited = []
+    monkeypatch.setattr(user_interaction, 'project_flair', lambda post, text, cfg: cfg.flairs.append(text))
+    monkeypatch.setattr(user_interaction, 'update_user_flair', lambda post, cfg: cfg.credited.append(post.author.name))
+    monkeypatch.setattr(user_interaction, 'verified_posted_transcript', lambda post, cfg: True)
+    return cfg
+
+
+def comment(body, author='pam', fail_with=None):
+    """
+    A reply to our post. If `fail_with` is set, the first reply to it fails
+    with that error.
+    """
+    post = inbox_comment('e1', 'abc123', body=body, author=author)
+    post.replies_sent = []
+    errors = [APIException(fail_with, 'Try again later', None)] if fail_with else []
+
+    def reply(text):
+        if errors:
+            raise errors.pop()
+        post.replies_sent.append(text)
+
+    post.reply = reply
+    return post
+
+
+def test_claim_whose_reply_fails_still_sets_flair_and_can_be_retried(monkeypatch):
+    cfg = config(monkeypatch)
+    claim = comment('claim', fail_with='RATELIMIT')
+
+    with pytest.raises(APIException):
+        user_interaction.process_claim(claim, cfg)
+    assert cfg.flairs == [flair.in_progress]
+
+    user_interaction.process_claim(claim, cfg)
+
+    assert claim.replies_sent == [responses('claim', 'success')]
+    assert cfg.flairs == [flair.in_progress, flair.in_progress]
+    assert cfg.post_states.get('t3_abc123').claimant == 'pam'
+
+
+def test_claim_lost_to_someone_else(monkeypatch):
+    cfg = config(monkeypatch)
+    cfg.post_states.claim('t3_abc123', 'jim')
+    claim = comment('claim')
+
+    user_interaction.process_claim(claim, cfg)
+
+    assert claim.replies_sent == [responses('claim', 'already_claimed')]
+    assert cfg.flairs == []
+    assert cfg.post_states.get('t3_abc123').claimant == 'jim'
+
+
+def test_claim_on_a_deleted_comment_gives_the_post_back(monkeypatch):
+    cfg = config(monkeypatch)
+
+    with pytest.raises(APIException):
+        user_interaction.process_claim(comment('claim', fail_with='RATELIMIT'), cfg)
+    user_interaction.process_claim(comment('claim', fail_with='DELETED_COMMENT'), cfg)
+
+    assert cfg.post_states.get('t3_abc123').state == state.unclaimed
+    assert cfg.flairs[-1] == flair.unclaimed
+
+
+def test_done_on_an_unclaimed_post(monkeypatch):
+    cfg = config(monkeypatch)
+    done = comment('done')
+
+    user_interaction.process_done(done, cfg)
+
+    assert done.replies_sent == [responses('done', 'still_unclaimed')]
+    assert cfg.post_states.get('t3_abc123').state == state.unclaimed
+    assert cfg.credited == []
+
+
+def test_done_whose_reply_fails_is_credited_once(monkeypatch):
+    cfg = config(monkeypatch)
+    cfg.post_states.claim('t3_abc123', 'pam')
+    done = comment('done', fail_with='RATELIMIT')
+
+    with pytest.raises(APIException):
+        user_interaction.process_done(done, cfg)
+    assert cfg.credited == ['pam']
+    assert cfg.flairs == [flair.completed]
+
+    user_interaction.process_done(done, cfg)
+
+    assert done.replies_sent == [responses('done', 'completed_transcript')]
+    assert cfg.credited == ['pam']
+    assert cfg.redis.get('total_completed') == b'1'
+    assert cfg.post_states.get('t3_abc123').state == state.completed
+
+
+def test_done_that_cannot_be_credited_can_be_tried_again(monkeypatch):
+    cfg = config(monkeypatch)
+    cfg.post_states.claim('t3_abc123', 'pam')
+
+    def broken(post, cfg):
+        raise RuntimeError('Reddit is down')
+
+    monkeypatch.setattr(user_interaction, 'update_user_flair', broken)
+
+    with pytest.raises(RuntimeError):
+        user_interaction.process_done(comment('done'), cfg)
+
+    assert cfg.post_states.get('t3_abc123').state == state.in_progress
+    assert cfg.flairs == [flair.in_progress]
@@ -0,0 +1,101 @@
+import json
+
+import pytest  # type: ignore
+
+from tor.core.users import User, UserDataNotFound, migrate_all_users
+
+from .fake_redis import FakeRedis
+
+LEGACY_PAM = {
+    'username': 'pam',
+    'transcriptions': 10,
+    'posts_completed': ['t3_one', 't3_two'],
+}
+
+
+def legacy_redis(**users):
+    redis = FakeRedis()
+    for username, record in users.items():
+        redis.set(f'::user::{username}', json.dumps(record))
+    return redis
+
+
+def test_legacy_user_becomes_a_hash_when_loaded():
+    redis = legacy_redis(pam=LEGACY_PAM)
+
+    pam = User('pam', redis_conn=redis)
+
+    assert redis.type('::user::pam') == b'hash'
+    assert pam.get('transcriptions') == 10
+    assert pam.get('posts_completed') == ['t3_one', 't3_two']
+    assert redis.lrange('::user::pam::posts_completed', 0, -1) == [b't3_one', b't3_two']
+    assert redis.hget('::user::pam', 'posts_completed') is None
+
+
+def test_migrate_all_users():
+    redis = legacy_redis(pam=LEGACY_PAM, jim={'username': 'jim', 'transcriptions': 3})
+    User('dwight', redis_conn=redis).save()
+    User('dwight', redis_conn=redis).increment('transcriptions')
+
+    assert migrate_all_users(redis) == 2
+    # The list keys hanging off a user aren't users
+    assert migrate_all_users(redis) == 0
+    assert User('jim', redis_conn=redis).get('transcriptions') == 3
+
+
+def test_increment_during_migration_is_not_lost():
+    redis = legacy_redis(pam=LEGACY_PAM)
+
+    def other_bot():
+        # Another bot converts pam and counts a transcription while we're
+        # still converting her from the blob we read
+        User('pam', redis_conn=redis).increment('transcriptions')
+
+    redis.before_exec = other_bot
+    pam = User('pam', redis_conn=redis)
+
+    assert pam.get('transcriptions') == 11
+    assert redis.hget('::user::pam', 'transcriptions') == b'11'
+    assert redis.lrange('::user::pam::posts_completed', 0, -1) == [b't3_one', b't3_two']
+
+
+def test_increment_on_a_migrated_user():
+    redis = legacy_redis(pam=LEGACY_PAM)
+    pam = User('pam', redis_conn=redis)
+
+    assert pam.increment('transcriptions') == 11
+    assert pam.increment('transcriptions', 5) == 16
+    assert User('pam', redis_conn=redis).get('transcriptions') == 16
+    assert User('pam', redis_conn=redis).get('username') == 'pam'
+
+
+def test_increment_on_a_user_saved_the_old_way_again():
+    redis = FakeRedis()
+    pam = User('pam', redis_conn=redis)
+    pam.save()
+    # An older bot wrote the whole record back as a blob
+    redis.set('::user::pam', json.dumps(LEGACY_PAM))
+
+    assert pam.increment('transcriptions') == 11
+    assert redis.type('::user::pam') == b'hash'
+
+
+def test_only_changes_are_saved():
+    redis = legacy_redis(pam=LEGACY_PAM)
+    pam = User('pam', redis_conn=redis)
+    other = User('pam', redis_conn=redis)
+
+    pam.update('flair_suffix', ' - Beta Tester')
+    pam.list_update('posts_completed', 't3_three')
+    other.increment('transcriptions')
+    pam.save()
+
+    reloaded = User('pam', redis_conn=redis)
+    assert reloaded.get('transcriptions') == 11
+    assert reloaded.get('flair_suffix') == ' - Beta Tester'
+    assert reloaded.get('posts_completed') == ['t3_one', 't3_two', 't3_three']
+
+
+def test_missing_user():
+    with pytest.raises(UserDataNotFound):
+        User('nobody', redis_conn=FakeRedis(), create_if_not_found=False)
@@ -0,0 +1,178 @@
+import threading
+
+import pytest  # type: ignore
+
+from tor.core import validation
+
+
+class Object(object):
+    pass
+
+
+def done_comment(history=()):
+    post = Object()
+    post.fullname = 't1_done'
+    post.author = Object()
+    post.author.comments = Object()
+    post.author.comments.new = lambda limit: iter(history)
+    post.submission = Object()
+    post.submission.shortlink = 'https://redd.it/abc123'
+    return post
+
+
+def config():
+    cfg = Object()
+    cfg.perform_header_check = False
+    cfg.r = Object()
+
+    def submission(*args, **kwargs):
+        linked = Object()
+        linked.fullname = 't3_xyz789'
+        return linked
+
+    cfg.r.submission = submission
+    return cfg
+
+
+def patch_checks(monkeypatch, thread_result, history_result, thread_done=None):
+    top_parent = Object()
+    top_parent.url = 'https://www.reddit.com/r/funny/comments/xyz789/'
+    top_parent.id_from_url = lambda url: 'xyz789'
+    monkeypatch.setattr(validation, 'get_parent_post_id', lambda post, r: top_parent)
+
+    def thread_check(post, linked_resource, cfg, cancelled):
+        if thread_done:
+            thread_done.wait(5)
+        return thread_result
+
+    monkeypatch.setattr(validation, '_linked_thread_check', thread_check)
+    monkeypatch.setattr(validation, '_author_history_check', lambda post, cfg, cancelled, history: history_result)
+
+    sent = []
+    monkeypatch.setattr(validation, 'send_to_modchat', lambda message, cfg, channel: sent.append(message))
+    return sent
+
+
+def test_found_in_thread(monkeypatch):
+    sent = patch_checks(monkeypatch, thread_result=True, history_result=False)
+
+    assert validation.verified_posted_transcript(done_comment(), config()) is True
+    assert sent == []
+
+
+def test_not_found_anywhere(monkeypatch):
+    patch_checks(monkeypatch, thread_result=False, history_result=False)
+
+    assert validation.verified_posted_transcript(done_comment(), config()) is False
+
+
+def test_found_in_history_reports_removed_post(monkeypatch):
+    thread_done = threading.Event()
+    sent = patch_checks(monkeypatch, thread_result=False, history_result=True, thread_done=thread_done)
+
+    # The history check wins without waiting for the thread search
+    assert validation.verified_posted_transcript(done_comment(), config()) is True
+
+    thread_done.set()
+    for _ in range(50):
+        if sent:
+            break
+        threading.Event().wait(0.01)
+    assert sent == ['Found removed post: <https://redd.it/abc123>']
+
+
+def test_forbidden_thread_is_not_reported(monkeypatch):
+    sent = patch_checks(monkeypatch, thread_result=None, history_result=True)
+
+    assert validation.verified_posted_transcript(done_comment(), config()) is True
+    assert sent == []
+
+
+def recent_transcript():
+    transcript = Object()
+    transcript.is_root = True
+    transcript.link_id = 't3_xyz789'
+    return transcript
+
+
+def wait_for(sent):
+    for _ in range(50):
+        if sent:
+            break
+        threading.Event().wait(0.01)
+
+
+def test_found_in_recent_history_without_waiting_for_thread(monkeypatch):
+    thread_done = threading.Event()
+    sent = patch_checks(monkeypatch, thread_result=True, history_result=False, thread_done=thread_done)
+
+    assert validation.verified_posted_transcript(done_comment([recent_transcript()]), config()) is True
+
+    thread_done.set()
+    wait_for(sent)
+    assert sent == []
+
+
+def test_found_in_recent_history_still_reports_removed_post(monkeypatch):
+    sent = patch_checks(monkeypatch, thread_result=False, history_result=False)
+
+    assert validation.verified_posted_transcript(done_comment([recent_transcript()]), config()) is True
+
+    wait_for(sent)
+    assert sent == ['Found removed post: <https://redd.it/abc123>']
+
+
+def raising(error):
+    def check(*args):
+        raise error
+    return check
+
+
+def test_failed_history_search_falls_back_to_thread(monkeypatch):
+    patch_checks(monkeypatch, thread_result=True, history_result=False)
+    monkeypatch.setattr(validation, '_author_history_check', raising(RuntimeError('history')))
+
+    assert validation.verified_posted_transcript(done_comment(), config()) is True
+
+
+def test_failed_thread_search_falls_back_to_history(monkeypatch):
+    patch_checks(monkeypatch, thread_result=False, history_result=True)
+    monkeypatch.setattr(validation, '_linked_thread_check', raising(RuntimeError('thread')))
+
+    assert validation.verified_posted_transcript(done_comment(), config()) is True
+
+
+def test_both_searches_failing_is_an_error(monkeypatch):
+    patch_checks(monkeypatch, thread_result=False, history_result=False)
+    monkeypatch.setattr(validation, '_linked_thread_check', raising(RuntimeError('thread')))
+    monkeypatch.setattr(validation, '_author_history_check', raising(RuntimeError('history')))
+
+    with pytest.raises(RuntimeError):
+        validation.verified_posted_transcript(done_comment(), config())
+
+
+class HistoryComment(object):
+    is_root = True
+    body = 'the transcript'
+    link_title = 'A cat'
+
+    def __init__(self, link_id):
+        self.link_id = link_id
+
+    @property
+    def submission(self):
+        raise AssertionError('the post of every history item should not be loaded')
+
+
+def test_author_history_check_matches_by_link_id(monkeypatch):
+    top_parent = Object()
+    top_parent.url = 'https://www.reddit.com/r/funny/comments/xyz789/'
+    top_parent.id_from_url = lambda url: 'xyz789'
+    monkeypatch.setattr(validation, 'get_parent_post_id', lambda post, r: top_parent)
+    post = done_comment()
+    post.link_title = 'Image | A cat'
+
+    assert validation._author_history_check(post, config(), history=[HistoryComment('t3_other')]) is False
+    assert validation._author_history_check(
+        post, config(), history=[HistoryComment('t3_other'), HistoryComment('t3_xyz789')]
+    ) is True
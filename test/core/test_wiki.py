@@ -0,0 +1,75 @@
+import time
+from unittest.mock import MagicMock
+
+from tor.core.wiki import WikiCache
+
+
+class Object(object):
+    pass
+
+
+def revision(pagename, revision_id, timestamp):
+    page = Object()
+    page.name = pagename
+    return {'page': page, 'id': revision_id, 'timestamp': timestamp}
+
+
+def wiki_subreddit(pages, revisions):
+    subreddit = MagicMock()
+    subreddit.__str__.return_value = 'transcribersofreddit'
+
+    def get_page(name):
+        page = Object()
+        page.content_md = pages[name]
+        return page
+
+    subreddit.wiki.__getitem__.side_effect = get_page
+    subreddit.wiki.revisions.return_value = revisions
+    return subreddit
+
+
+def test_stale_pages_only_lists_revised_pages():
+    subreddit = wiki_subreddit(
+        {'domains': 'a', 'subreddits': 'b'},
+        [revision('domains', 'rev-2', time.time())],
+    )
+    cache = WikiCache('unused.json')
+    cache.fetch('domains', subreddit, revision='rev-1')
+    cache.fetch('subreddits', subreddit, revision='rev-1')
+
+    assert cache.stale_pages(['domains', 'subreddits', 'format/header'], subreddit) == ['domains', 'format/header']
+
+
+def test_stale_pages_with_full_listing_trusts_recent_checks():
+    subreddit = wiki_subreddit({'domains': 'a'}, [])
+    cache = WikiCache('unused.json')
+    cache.fetch('domains', subreddit, revision='rev-1')
+
+    # A full page of revisions for other pages, all older than our check
+    subreddit.wiki.revisions.return_value = [
+        revision(f'other/{i}', f'rev-{i}', time.time() - 3600) for i in range(100)
+    ]
+    assert cache.stale_pages(['domains'], subreddit) == []
+
+    # ...but not if the listing doesn't reach back far enough
+    subreddit.wiki.revisions.return_value = [
+        revision(f'other/{i}', f'rev-{i}', time.time()) for i in range(100)
+    ]
+    assert cache.stale_pages(['domains'], subreddit) == ['domains']
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'wiki_snapshot.json')
+    subreddit = wiki_subreddit({'domains': 'a'}, [])
+
+    cache = WikiCache(path)
+    cache.fetch('domains', subreddit, revision='rev-1')
+    cache.save_snapshot(subreddit)
+
+    restored = WikiCache(path)
+    assert restored.load_snapshot(subreddit) is True
+    assert restored.content('domains') == 'a'
+
+    other = MagicMock()
+    other.__str__.return_value = 'ModsOfTor'
+    assert WikiCache(path).load_snapshot(other) is False
@@ -1,7 +1,8 @@
 import argparse
+import atexit
 import os
-import time
 import logging
+from typing import List
 
 from praw import Reddit  # type: ignore
 
@@ -10,15 +11,24 @@ from praw import Reddit  # type: ignore
 import tor
 from tor import __version__
 from tor.core.config import config
-from tor.core.helpers import run_until_dead
+from tor.core.helpers import reddit_object_scope, run_until_dead, serialize_requests
 from tor.core.inbox import check_inbox
-from tor.core.initialize import configure_logging, initialize
-from tor.helpers.flair import set_meta_flair_on_other_posts
+from tor.core.initialize import (configure_logging, initialize, initialize_from_snapshot,
+                                 refresh_moderators)
+from tor.core.dry_run import DryRun
+from tor.core.metrics import TimedRequestor, start_metrics_server
+from tor.core.scheduler import Task, load_schedule
+from tor.core.users import migrate_all_users
+from tor.helpers.flair import (FLAIR_RECONCILE_INTERVAL, push_flair_updates,
+                               reconcile_flair, set_meta_flair_on_other_posts)
 from tor.helpers.threaded_worker import threaded_check_submissions
 
 ##############################
 NOOP_MODE = bool(os.getenv('NOOP_MODE', ''))
 DEBUG_MODE = bool(os.getenv('DEBUG_MODE', ''))
+PROFILE_RUNS = int(os.getenv('PROFILE_RUNS', '0'))
+DRY_RUN = bool(os.getenv('DRY_RUN', ''))
+DRY_RUN_JOURNAL = os.getenv('DRY_RUN_JOURNAL', 'dry_run_journal.jsonl')
 ##############################
 
 # Patreon Dedications:
@@ -69,6 +79,10 @@ def parse_arguments():
     parser.add_argument('--version', action='version', version=__version__)
     parser.add_argument('--debug', action='store_true', default=DEBUG_MODE, help='Puts bot in dev-mode using non-prod credentials')
     parser.add_argument('--noop', action='store_true', default=NOOP_MODE, help='Just run the daemon, but take no action (helpful for testing infrastructure changes)')
+    parser.add_argument('--dry-run', action='store_true', default=DRY_RUN, help=f'Run everything for real, but write every change to {DRY_RUN_JOURNAL} instead of making it')
+    parser.add_argument('--record', metavar='PATH', help='Dry run, saving every response from Reddit to PATH')
+    parser.add_argument('--replay', metavar='PATH', help='Dry run with the responses saved by --record instead of live ones')
+    parser.add_argument('--profile', type=int, default=PROFILE_RUNS, metavar='N', help='Profile the first N task runs and save the results to PROFILE_DIR')
 
     return parser.parse_args()
 
@@ -77,21 +91,37 @@ def noop(cfg):
     pass
 
 
-def run(cfg):
+def scoped(func):
     """
-    Primary routine.
-
-    :param cfg: Global config dict, supplied by tor_core.
-    :return: None.
+    Anything loaded from Reddit during a run of `func` is reused until the
+    end of it, then thrown away so the next run sees fresh data.
     """
-    check_inbox(cfg)
+    def run_scoped(cfg):
+        with reddit_object_scope():
+            func(cfg)
+
+    run_scoped.__name__ = func.__name__
+    return run_scoped
 
-    threaded_check_submissions(cfg)
 
-    set_meta_flair_on_other_posts(cfg)
+def build_tasks(cfg) -> List[Task]:
+    """
+    Every stage of the bot, with how often it runs. These are the defaults;
+    any of them can be changed in the file at `cfg.schedule_path`.
 
-    if cfg.debug_mode:
-        time.sleep(60)
+    :param cfg: the global config object.
+    :return: List of tasks for `run_until_dead`.
+    """
+    tasks = [
+        Task('inbox', scoped(check_inbox), interval=10, jitter=2, timeout=600),
+        Task('submissions', scoped(threaded_check_submissions), interval=45, jitter=5, timeout=600),
+        Task('meta_flair', scoped(set_meta_flair_on_other_posts), interval=300, jitter=30, timeout=120),
+        Task('flair_push', push_flair_updates, interval=60, jitter=10, timeout=300),
+        Task('flair_reconcile', reconcile_flair, interval=FLAIR_RECONCILE_INTERVAL.total_seconds(), jitter=600,
+             timeout=1800),
+        Task('mod_refresh', refresh_moderators, interval=cfg.mod_refresh_interval, jitter=30, timeout=120),
+    ]
+    return load_schedule(tasks, cfg.schedule_path)
 
 
 def main():
@@ -109,12 +139,33 @@ def main():
     else:
         bot_name = os.environ.get('BOT_NAME', 'bot')
 
-    config.r = Reddit(bot_name)
+    if opt.dry_run or opt.record or opt.replay:
+        config.dry_run = DryRun(DRY_RUN_JOURNAL, record=opt.record, replay=opt.replay)
+        atexit.register(config.dry_run.finish)
+        log.info(f'Dry run: nothing will be changed; see {DRY_RUN_JOURNAL} for what would have been')
+
+    config.r = serialize_requests(
+        Reddit(bot_name, requestor_class=TimedRequestor, requestor_kwargs={'session': config.http})
+    )
     config.name = 'u/ToR'
     config.bot_version = __version__
     configure_logging(config)
-    initialize(config)
+    if config.metrics_port:
+        start_metrics_server(config.metrics_host, config.metrics_port)
+    if not initialize_from_snapshot(config):
+        initialize(config)
     config.perform_header_check = True
+    # Once per start; anyone an older bot saves the old way after this is
+    # converted when they're next loaded
+    migrate_all_users(config.redis)
+    # Load the local copies before the inbox threads start relying on them
+    config.blacklist.resync()
+    config.accepted_coc.resync()
+    # Fail now, not when a mod first runs a command, if commands.json is bad
+    config.commands.validate()
+    tasks = build_tasks(config)
+    if opt.profile:
+        config.profiler.start(opt.profile)
     log.info('Bot built and initialized')
 
     tor.__SELF_NAME__ = config.r.user.me().name
@@ -122,9 +173,9 @@ def main():
         tor.__BOT_NAMES__.append(tor.__SELF_NAME__)
 
     if opt.noop:
-        run_until_dead(noop)
+        run_until_dead([Task('noop', noop, interval=60)])
     else:
-        run_until_dead(run)
+        run_until_dead(tasks)
 
 
 if __name__ == '__main__':
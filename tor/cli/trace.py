@@ -0,0 +1,110 @@
+"""
+Reads the lifecycle traces (see tor.core.trace) back out of Redis:
+
+    tor-trace stats                      # latency percentiles per stage
+    tor-trace stats --by-subreddit --hours 24
+    tor-trace stalled --hours 6          # where unfinished posts are stuck
+    tor-trace show t3_8swl2n             # one post
+"""
+import argparse
+import time
+from collections import Counter
+from datetime import datetime
+from typing import List
+
+from tor.core.config import config
+from tor.core.trace import STAGES, LifecycleTrace, group_steps, last_stage, percentile
+
+PERCENTILES = (50, 90, 99)
+
+
+def _duration(seconds: float) -> str:
+    if seconds < 120:
+        return f'{seconds:.0f}s'
+    if seconds < 2 * 60 * 60:
+        return f'{seconds / 60:.1f}m'
+    return f'{seconds / 60 / 60:.1f}h'
+
+
+def stats(traces: LifecycleTrace, by_subreddit=False, hours=None) -> List[str]:
+    since = time.time() - hours * 60 * 60 if hours else None
+    groups = group_steps(traces.scan(), by_subreddit=by_subreddit, since=since)
+
+    lines = []
+    for group in sorted(groups):
+        lines.append(f'{group}:')
+        steps = groups[group]
+        for step in sorted(steps, key=lambda step: (STAGES.index(step[0]), STAGES.index(step[1]))):
+            durations = steps[step]
+            quantiles = '  '.join(
+                f'p{percent}={_duration(percentile(durations, percent))}' for percent in PERCENTILES
+            )
+            lines.append(f'  {step[0]:>10} -> {step[1]:<10} n={len(durations):<6} {quantiles}')
+    return lines or ['No traces found.']
+
+
+def stalled(traces: LifecycleTrace, hours: float) -> List[str]:
+    cutoff = time.time() - hours * 60 * 60
+    stuck: 'Counter[str]' = Counter()
+    for _post_id, trace in traces.scan():
+        current = last_stage(trace)
+        if current and current != STAGES[-1] and float(trace[current]) < cutoff:
+            stuck[current] += 1
+
+    return [f'Posts that have been sitting for over {hours}h, by the last stage they reached:'] + [
+        f'  {name:>10}: {stuck[name]}' for name in STAGES[:-1]
+    ]
+
+
+def show(traces: LifecycleTrace, post_id: str) -> List[str]:
+    if not post_id.startswith('t3_'):
+        post_id = f't3_{post_id}'
+    trace = traces.get(post_id)
+    if not trace:
+        return [f'No trace for {post_id}.']
+
+    lines = [f'{post_id} ({trace.get("subreddit", "unknown subreddit")})']
+    previous = None
+    for name in STAGES:
+        if name not in trace:
+            continue
+        at = float(trace[name])
+        since_previous = f' (+{_duration(at - previous)})' if previous is not None else ''
+        lines.append(f'  {name:>10}: {datetime.fromtimestamp(at):%Y-%m-%d %H:%M:%S}{since_previous}')
+        previous = at
+    return lines
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(prog='tor-trace', description='Latency of posts through the bot')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    stats_parser = commands.add_parser('stats', help='Latency percentiles for each stage')
+    stats_parser.add_argument('--by-subreddit', action='store_true', help='One set of numbers per subreddit')
+    stats_parser.add_argument('--hours', type=float, help='Only posts discovered in the last N hours')
+
+    stalled_parser = commands.add_parser('stalled', help='Count unfinished posts by where they are stuck')
+    stalled_parser.add_argument('--hours', type=float, default=6, help='How long a post has to sit to count')
+
+    show_parser = commands.add_parser('show', help='The trace of one post')
+    show_parser.add_argument('post_id', help='ID or fullname of the post on its own subreddit')
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = parse_arguments(args)
+    traces = LifecycleTrace(config.redis)
+
+    if opt.command == 'stats':
+        lines = stats(traces, by_subreddit=opt.by_subreddit, hours=opt.hours)
+    elif opt.command == 'stalled':
+        lines = stalled(traces, opt.hours)
+    else:
+        lines = show(traces, opt.post_id)
+    print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    main()
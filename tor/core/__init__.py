@@ -1,3 +1,5 @@
+import threading
+
 __version__ = '0.6.0'
 
 # CTRL+C handler variable
@@ -22,6 +24,9 @@ class cached_property(object):
 
     The class has to have a `__dict__` in order for this property to
     work.
+
+    The value is only ever calculated once, even if several threads ask
+    for it at the same time.
     """
 
     # implementation detail: this property is implemented as non-data
@@ -37,12 +42,16 @@ class cached_property(object):
         self.__module__ = func.__module__
         self.__doc__ = doc or func.__doc__
         self.func = func
+        self.lock = threading.RLock()
 
     def __get__(self, obj, _type=None):
         if obj is None:
             return self
         value = obj.__dict__.get(self.__name__, _missing)
         if value is _missing:
-            value = self.func(obj)
-            obj.__dict__[self.__name__] = value
+            with self.lock:
+                value = obj.__dict__.get(self.__name__, _missing)
+                if value is _missing:
+                    value = self.func(obj)
+                    obj.__dict__[self.__name__] = value
         return value
@@ -1,23 +1,138 @@
+import ipaddress
 import json
 import logging
+import os
 import random
+import re
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
 
+import requests
 from praw.exceptions import ClientException as RedditClientException  # type: ignore
+from prawcore.exceptions import PrawcoreException  # type: ignore
 
-from tor.core.helpers import _, clean_id, send_to_modchat
+from tor.core.helpers import _, get_comment, get_wiki_page, send_to_modchat
 from tor.core.initialize import initialize
 from tor.core.user_interaction import process_done
+from tor.helpers.flair import FLAIR_TIERS
+from tor.helpers.leaderboard import Leaderboard
+
+# Users are looked up on Reddit this many at a time, by this many threads
+BLACKLIST_CHUNK_SIZE = 25
+BLACKLIST_WORKERS = 8
+
+# Lists of names can only be fetched from these paste sites, each turned into
+# the address of the plain text, so a link in a message can't send the bot
+# anywhere else
+PASTE_URLS = [
+    (re.compile(r'https?://(?:www\.)?pastebin\.com/(?:raw/)?(\w+)/?$'), 'https://pastebin.com/raw/{}'),
+    (
+        re.compile(r'https?://gist\.githubusercontent\.com/([\w-]+/\w+/raw/(?:\w+/)?[\w.-]+)$'),
+        'https://gist.githubusercontent.com/{}',
+    ),
+]
+
+# Nobody needs a list of names bigger than this
+MAX_PASTE_SIZE = 512 * 1024
+
+
+class Command(NamedTuple):
+    name: str
+    description: str
+    allowed_names: FrozenSet[str]
+    function: Callable
+
+
+class CommandRegistry(object):
+    """
+    The commands from commands.json, matched up with the functions that run
+    them. The file is read once and only read again when it changes (or on
+    `!reload`), and every command has to point at a function in
+    `COMMAND_FUNCTIONS`, so a typo fails when the file is loaded instead of
+    when a mod tries to use the command.
+
+    Usage:
+    commands = CommandRegistry('commands.json')
+    command = commands.get('ping')
+    """
+
+    def __init__(self, path='commands.json', functions: Optional[Dict[str, Callable]] = None) -> None:
+        self.path = path
+        self.functions = functions if functions is not None else COMMAND_FUNCTIONS
+        self.commands: Dict[str, Command] = {}
+        self.not_authorized_responses: List[str] = []
+        self._mtime: Optional[float] = None
+        self.load()
+
+    def get(self, name: str) -> Optional[Command]:
+        self.reload_if_changed()
+        return self.commands.get(name)
+
+    def load(self) -> None:
+        """
+        Read the commands file and swap in the new commands all at once.
+
+        :raises ValueError: if a command names a function that doesn't exist.
+        """
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, newline='') as commands_file:
+            data = json.load(commands_file)
+
+        unknown = sorted(
+            f'{name} -> {command["pythonFunction"]}'
+            for name, command in data['commands'].items()
+            if command['pythonFunction'] not in self.functions
+        )
+        if unknown:
+            raise ValueError(f'Commands in {self.path} point at unknown functions: {", ".join(unknown)}')
+
+        commands = {
+            name: Command(
+                name=name,
+                description=command.get('description', ''),
+                allowed_names=frozenset(command.get('allowedNames', [])),
+                function=self.functions[command['pythonFunction']],
+            )
+            for name, command in data['commands'].items()
+        }
+
+        self.commands, self.not_authorized_responses = commands, data['notAuthorizedResponses']
+        self._mtime = mtime
+        logging.info(f'Loaded {len(commands)} commands from {self.path}')
+
+    def validate(self) -> None:
+        """
+        Make sure the commands file on disk is the one we loaded and that it
+        loads, so a bad file is caught at startup instead of when a mod first
+        runs a command.
+
+        :raises ValueError: if a command names a function that doesn't exist.
+        """
+        if os.stat(self.path).st_mtime != self._mtime:
+            self.load()
+
+    def reload_if_changed(self) -> None:
+        try:
+            if os.stat(self.path).st_mtime == self._mtime:
+                return
+            self.load()
+        except (OSError, ValueError) as e:
+            # Keep using what we have rather than losing every command
+            logging.error(f'{e} - unable to reload {self.path}; keeping the old commands')
 
 
 def process_command(reply, cfg):
     """
     This function processes any commands send to the bot via PM with a subject
-    that stars with a !. The basic flow is read JSON file, look for key with
-    same subject, check if the caller is mod, or is in the list of allowed
-    people, then reply with the results of pythonFunction.
+    that stars with a !. The basic flow is look up the command with the same
+    name as the subject, check if the caller is mod, or is in the list of
+    allowed people, then reply with the results of the command's function.
 
     To add a new command: add an entry to commands.json, (look at the other
-    commands already listed), and add your function to admin_commands.py.
+    commands already listed), add your function to admin_commands.py and list
+    it in COMMAND_FUNCTIONS at the bottom.
 
     :param reply: Object, the message object that contains the requested
         command
@@ -28,71 +143,67 @@ def process_command(reply, cfg):
     # Trim off the ! from the start of the string
     requested_command = reply.subject[1:]
 
-    with open('commands.json', newline='') as commands_file:
-        commands = json.load(commands_file)
-        logging.debug(
-            f'Searching for command {requested_command}, '
-            f'from {reply.author.name}.'
-        )
+    logging.debug(
+        f'Searching for command {requested_command}, '
+        f'from {reply.author.name}.'
+    )
 
-        try:
-            command = commands['commands'][requested_command]
-
-        except KeyError:
-            if from_moderator(reply, cfg):
-                reply.reply(
-                    "That command hasn't been implemented yet ):"
-                    "\n\nMessage a dev to make your dream come true."
-                )
-
-            logging.warning(
-                f"Error, command: {requested_command} not found!"
-                f" (from {reply.author.name})"
+    command = cfg.commands.get(requested_command)
+    if command is None:
+        if from_moderator(reply, cfg):
+            reply.reply(
+                "That command hasn't been implemented yet ):"
+                "\n\nMessage a dev to make your dream come true."
             )
 
-            return
+        logging.warning(
+            f"Error, command: {requested_command} not found!"
+            f" (from {reply.author.name})"
+        )
+
+        return
 
-        # command found
+    # command found
+    logging.info(
+        f'{reply.author.name} is attempting to run {requested_command}'
+    )
+
+    # Mods are allowed to do any command, and some people are whitelisted
+    # per command to be able to use them
+    if reply.author.name not in command.allowed_names and not from_moderator(reply, cfg):
         logging.info(
-            f'{reply.author.name} is attempting to run {requested_command}'
+            f"{reply.author.name} failed to run {requested_command},"
+            f"because they aren't a mod, or aren't whitelisted to use this"
+            f" command"
+        )
+        username = reply.author.name
+        send_to_modchat(
+            f":banhammer: Someone did something bad! "
+            f"<https://reddit.com/user/{username}|u/{username}> tried to "
+            f"run {requested_command}!", cfg
         )
 
-        # Mods are allowed to do any command, and some people are whitelisted
-        # per command to be able to use them
-        if reply.author.name not in command['allowedNames'] and not from_moderator(reply, cfg):
-            logging.info(
-                f"{reply.author.name} failed to run {requested_command},"
-                f"because they aren't a mod, or aren't whitelisted to use this"
-                f" command"
-            )
-            username = reply.author.name
-            send_to_modchat(
-                f":banhammer: Someone did something bad! "
-                f"<https://reddit.com/user/{username}|u/{username}> tried to "
-                f"run {requested_command}!", cfg
-            )
-
-            reply.reply(
-                random.choice(commands['notAuthorizedResponses']).format(
-                    random.choice(cfg.no_gifs)
-                )
+        reply.reply(
+            random.choice(cfg.commands.not_authorized_responses).format(
+                random.choice(cfg.no_gifs)
             )
+        )
 
-            return
+        return
 
-        logging.debug(
-            f'Now executing command {requested_command},'
-            f' by {reply.author.name}.'
-        )
+    logging.debug(
+        f'Now executing command {requested_command},'
+        f' by {reply.author.name}.'
+    )
 
-        result = globals()[command['pythonFunction']](reply, cfg)
+    result = command.function(reply, cfg)
 
-        if result is not None:
-            reply.reply(result)
+    if result is not None:
+        reply.reply(result)
 
 
 def from_moderator(reply, cfg):
-    return reply.author in cfg.tor_mods
+    return reply.author is not None and str(reply.author).casefold() in cfg.tor_mods
 
 
 def process_override(reply, cfg):
@@ -120,8 +231,8 @@ def process_override(reply, cfg):
     # okay, so the parent of the reply should be the bot's comment
     # saying it can't find it. In that case, we need the parent's
     # parent. That should be the comment with the `done` call in it.
-    reply_parent = cfg.r.comment(id=clean_id(reply.parent_id))
-    parents_parent = cfg.r.comment(id=clean_id(reply_parent.parent_id))
+    reply_parent = get_comment(cfg.r, reply.parent_id)
+    parents_parent = get_comment(cfg.r, reply_parent.parent_id)
     if 'done' in parents_parent.body.lower():
         logging.info(
             f'Starting validation override for post {parents_parent.fullname}, '
@@ -132,50 +243,179 @@ def process_override(reply, cfg):
         )
 
 
+def _blacklist_candidates(body: str, cfg) -> Tuple[List[str], List[str]]:
+    """
+    Turn the body of a `!blacklist` message into a list of usernames. Each
+    line is a username (with or without `u/`), `wiki:<page>` to read the
+    names from a page of our wiki, or a link to a plain-text list like a
+    paste. Blank lines and lines starting with `#` are skipped, as are
+    repeated names.
+
+    :param body: the body of the message.
+    :param cfg: the global config object.
+    :return: List of usernames, in the order they were given, and the links
+        that couldn't be read.
+    """
+    names: List[str] = []
+    unreadable: List[str] = []
+    for line in body.splitlines():
+        line = line.strip()
+        if line.startswith('wiki:'):
+            names.extend(get_wiki_page(line[len('wiki:'):].strip(), cfg).splitlines())
+        elif line.startswith(('http://', 'https://')):
+            try:
+                names.extend(_fetch_text(line, cfg).splitlines())
+            except (ValueError, requests.RequestException) as e:
+                logging.warning(f'Unable to read blacklist from {line}: {e}')
+                unreadable.append(line)
+        else:
+            names.append(line)
+
+    seen = set()
+    usernames = []
+    for name in names:
+        name = name.strip()
+        for prefix in ('/u/', 'u/'):
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        if not name or name.startswith('#') or name.casefold() in seen:
+            continue
+        seen.add(name.casefold())
+        usernames.append(name)
+    return usernames, unreadable
+
+
+def _paste_url(url: str) -> str:
+    """
+    :return: the address of the plain text of a paste.
+    :raises ValueError: if the link isn't to one of `PASTE_URLS`.
+    """
+    for pattern, raw_url in PASTE_URLS:
+        match = pattern.match(url)
+        if match:
+            return raw_url.format(match.group(1))
+    raise ValueError('not a link to a paste site we know')
+
+
+def _is_public_host(host: str) -> bool:
+    try:
+        addresses = {str(info[4][0]) for info in socket.getaddrinfo(host, 443, proto=socket.IPPROTO_TCP)}
+    except socket.gaierror:
+        return False
+    # Scoped IPv6 addresses come with their interface after a %
+    return bool(addresses) and all(
+        ipaddress.ip_address(address.split('%')[0]).is_global for address in addresses
+    )
+
+
+def _fetch_text(url: str, cfg) -> str:
+    """
+    Read a list of names from a paste site.
+
+    :raises ValueError: if the link isn't to a paste site, the site resolves
+        to a private address, or the paste is too big.
+    """
+    url = _paste_url(url)
+    host = urlsplit(url).hostname or ''
+    if not _is_public_host(host):
+        raise ValueError(f'{host} is not a public address')
+
+    response = cfg.http.get(url, timeout=30, stream=True, allow_redirects=False)
+    try:
+        response.raise_for_status()
+        if response.is_redirect:
+            raise ValueError(f'{url} tried to send us to {response.headers.get("location")}')
+        content = b''
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            content += chunk
+            if len(content) > MAX_PASTE_SIZE:
+                raise ValueError(f'{url} is bigger than {MAX_PASTE_SIZE} bytes')
+    finally:
+        response.close()
+    return content.decode(response.encoding or 'utf-8', errors='replace')
+
+
+def _validate_usernames(usernames: List[str], cfg) -> Tuple[List[str], List[str]]:
+    """
+    Look up a list of users on Reddit, a few of them at a time.
+
+    :return: the names of the users that exist, spelled the way Reddit spells
+        them, and the names that don't.
+    """
+    def validate(chunk: List[str]) -> List[Tuple[str, Optional[str]]]:
+        results = []
+        for username in chunk:
+            try:
+                redditor = cfg.r.redditor(username)
+                # Redditor objects are lazy; asking for the ID makes sure
+                # this one really exists. Suspended accounts don't have one.
+                redditor.id
+                results.append((username, redditor.name))
+            except (PrawcoreException, RedditClientException, AttributeError):
+                results.append((username, None))
+        return results
+
+    chunks = [
+        usernames[i:i + BLACKLIST_CHUNK_SIZE]
+        for i in range(0, len(usernames), BLACKLIST_CHUNK_SIZE)
+    ]
+    valid: List[str] = []
+    invalid: List[str] = []
+    with ThreadPoolExecutor(max_workers=BLACKLIST_WORKERS) as executor:
+        for chunk_results in executor.map(validate, chunks):
+            for username, canonical in chunk_results:
+                if canonical:
+                    valid.append(canonical)
+                else:
+                    invalid.append(username)
+    return valid, invalid
+
+
 def process_blacklist(reply, cfg):
     """
     This is used to basically "shadow-ban" people from the bot.
     Format is:
     Subject: !blacklist
     body: <username1>\n<username2>...
+
+    Instead of usernames, a line can also be `wiki:<page>` or a link to a
+    paste (pastebin or a raw GitHub gist) to blacklist everyone listed there.
+
     :param reply: the comment reply object from the inbox
     :param cfg: the global config object
-    :return: None
+    :return: a summary of what happened to every name.
     """
+    usernames, unreadable = _blacklist_candidates(reply.body, cfg)
 
-    usernames = reply.body.splitlines()
-    results = ""
-    failed = []
-    successes = []
-    already_added = []
-
-    for username in usernames:
-        if username in cfg.tor_mods:
-            results += f'{username} is a mod! Don\'t blacklist mods!\n'
-            failed.append(username)
-            continue
-
-        try:
-            cfg.r.redditor(username)
-        except RedditClientException:
-            results += f'{username} isn\'t a valid user\n'
-            failed.append(username)
-            continue
+    moderators = [username for username in usernames if username.casefold() in cfg.tor_mods]
+    usernames = [username for username in usernames if username.casefold() not in cfg.tor_mods]
 
-        if not cfg.redis.sadd('blacklist', username):
-            results += f'{username} is already blacklisted, ya fool!\n'
-            already_added.append(username)
-            continue
+    valid, invalid = _validate_usernames(usernames, cfg)
 
-        results += f'{username} is now blacklisted\n'
-        successes.append(username)
+    # Everyone is written in one go
+    added = cfg.blacklist.add(*valid)
+    successes = [username for username, was_added in zip(valid, added) if was_added]
+    already_added = [username for username, was_added in zip(valid, added) if not was_added]
 
-        logging.info(
-            f'Blacklist: {repr(failed)} failed, {repr(successes)} succeeded, '
-            f'{repr(already_added)} were already blacklisted '
-        )
+    logging.info(
+        f'Blacklist: {len(successes)} added, {len(already_added)} were already '
+        f'blacklisted, {len(invalid)} invalid, {len(moderators)} mods'
+    )
 
-        return results
+    results = (
+        f'Blacklisted {len(successes)} of {len(successes) + len(already_added) + len(invalid) + len(moderators)}'
+        f' users.\n\n'
+    )
+    for heading, names in (
+        ('Now blacklisted', successes),
+        ('Already blacklisted, ya fool', already_added),
+        ("Aren't valid users", invalid),
+        ("Mods! Don't blacklist mods", moderators),
+        ("Couldn't read these lists", unreadable),
+    ):
+        if names:
+            results += f'**{heading}** ({len(names)}): {", ".join(names)}\n\n'
+    return results
 
 
 def reload_config(reply, cfg):
@@ -183,11 +423,84 @@ def reload_config(reply, cfg):
         f'Reloading configs at the request of {reply.author.name}'
     )
     initialize(cfg)
+    cfg.commands.load()
     logging.info('Reload complete.')
 
     return 'Config reloaded!'
 
 
+def show_leaderboard(reply, cfg):
+    """
+    Replies to the !leaderboard command with the top 10, where the person
+    asking is, and how many people are in each flair tier. Everything comes
+    straight from the leaderboard sorted set.
+
+    :param reply: the message object that contains the requested command
+    :param cfg: the global config object
+    :return: the leaderboard, which is given to Reddit's reply.reply()
+    """
+    leaderboard = Leaderboard(cfg.redis)
+
+    results = ''
+    for rank, (username, count) in enumerate(leaderboard.top(10), start=1):
+        results += f'{rank}. u/{username}: {count}\n'
+    if not results:
+        return 'The leaderboard is empty; `!rebuildleaderboard` fills it from the user records.'
+
+    rank = leaderboard.rank(reply.author.name)
+    if rank is not None:
+        results += f'\nYou are number {rank} with {leaderboard.count(reply.author.name)}.\n'
+    results += '\n'
+    for tier, count in leaderboard.tier_counts(FLAIR_TIERS).items():
+        results += f'* {tier}: {count}\n'
+
+    return results
+
+
+def rebuild_leaderboard(reply, cfg):
+    """
+    Replies to the !rebuildleaderboard command by refilling the leaderboard
+    from every user record. This looks at every user, so it's only meant for
+    backfilling, like after the leaderboard was first added.
+
+    :param reply: the message object that contains the requested command
+    :param cfg: the global config object
+    :return: the summary, which is given to Reddit's reply.reply()
+    """
+    logging.info(
+        f'Rebuilding the leaderboard at the request of {reply.author.name}'
+    )
+    total = Leaderboard(cfg.redis).rebuild()
+
+    return f'Leaderboard rebuilt with {total} volunteers.'
+
+
+def start_profiling(reply, cfg):
+    """
+    Replies to the !profile command. The body is the number of task runs to
+    profile (10 if it's left out), optionally followed by the names of the
+    tasks to look at. The summary is sent as another reply once it's done.
+
+    :param reply: the message object that contains the requested command
+    :param cfg: the global config object
+    :return: the response, which is given to Reddit's reply.reply()
+    """
+    words = reply.body.split()
+    if words and words[0].isdigit():
+        runs, tasks = int(words[0]), words[1:]
+    else:
+        runs, tasks = 10, words
+    if runs < 1:
+        return 'I need at least one run to profile.'
+
+    logging.info(
+        f'{reply.author.name} asked for a profile of {runs} runs'
+    )
+    if not cfg.profiler.start(runs, tasks, reply=reply):
+        return "There's already a profile being taken; try again when it's done."
+    return f'Profiling the next {runs} runs of {", ".join(tasks) if tasks else "every task"}. I\'ll reply here when it\'s done.'
+
+
 def ping(reply, cfg):
     """
     Replies to the !ping command, and is used as a keep alive check
@@ -199,3 +512,14 @@ def ping(reply, cfg):
         f'Received ping from {reply.author.name}. Pong!'
     )
     return "Pong!"
+
+
+# Every function that commands.json is allowed to point at
+COMMAND_FUNCTIONS: Dict[str, Callable] = {
+    'process_blacklist': process_blacklist,
+    'reload_config': reload_config,
+    'show_leaderboard': show_leaderboard,
+    'rebuild_leaderboard': rebuild_leaderboard,
+    'start_profiling': start_profiling,
+    'ping': ping,
+}
@@ -1,11 +1,11 @@
-import datetime
 import logging
 import os
-from typing import Dict, List, Union
+import threading
+from types import MappingProxyType
+from typing import FrozenSet, Mapping, NamedTuple, Tuple
 
 from praw import Reddit  # type: ignore
 from praw.models import Subreddit  # type: ignore
-from praw.models.reddit.subreddit import ModeratorRelationship  # type: ignore
 from slackclient import SlackClient  # type: ignore
 
 from tor import __root__, __version__, __SELF_NAME__
@@ -20,6 +20,51 @@ except ImportError:
     bugsnag = None
 
 
+class ConfigSnapshot(NamedTuple):
+    """
+    Everything the bot loads from the wiki and the mod list, as one immutable
+    value. A reload builds a whole new snapshot and swaps it in, so nobody
+    ever sees a half-loaded configuration.
+    """
+    # Case-folded names of the mods of ToR
+    tor_mods: FrozenSet[str] = frozenset()
+
+    # Subreddits to look for new posts on, in the order they're listed
+    subreddits_to_check: Tuple[str, ...] = ()
+    subreddits_domain_filter_bypass: FrozenSet[str] = frozenset()
+    no_link_header_subs: FrozenSet[str] = frozenset()
+    upvote_filter_subs: Mapping[str, int] = MappingProxyType({})
+
+    video_domains: FrozenSet[str] = frozenset()
+    audio_domains: FrozenSet[str] = frozenset()
+    image_domains: FrozenSet[str] = frozenset()
+
+    video_formatting: str = ''
+    audio_formatting: str = ''
+    image_formatting: str = ''
+    other_formatting: str = ''
+
+    # Templating string for the header of the bot post
+    header: str = ''
+
+    no_gifs: Tuple[str, ...] = ()
+
+
+class _from_snapshot(object):
+    """
+    Read-only attribute that's looked up on the current snapshot.
+    """
+
+    def __set_name__(self, owner, name: str) -> None:
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return getattr((instance or owner).snapshot, self.name)
+
+    def __set__(self, instance, value) -> None:
+        raise AttributeError(f'{self.name} comes from the config snapshot; use update_snapshot()')
+
+
 class Config(object):
     """
     A singleton object for checking global configuration from
@@ -28,49 +73,126 @@ class Config(object):
 
     r: Reddit
 
-    # List of mods of ToR, fetched later using PRAW
-    tor_mods: Union[List[str], ModeratorRelationship] = []
+    # The configuration loaded from the wiki and the mod list
+    snapshot = ConfigSnapshot()
+    _snapshot_lock = threading.Lock()
 
-    # A collection of Subreddit objects, injected later based on
-    # subreddit-specific rules
-    subreddits_to_check: List[str] = []
-    subreddits_domain_filter_bypass: List[str] = []
+    tor_mods = _from_snapshot()
+    subreddits_to_check = _from_snapshot()
+    subreddits_domain_filter_bypass = _from_snapshot()
+    header = _from_snapshot()
+    no_gifs = _from_snapshot()
 
     # API keys for later overwriting based on contents of filesystem
     bugsnag_api_key = ''
 
-    # Templating string for the header of the bot post
-    header = ''
-
-    no_gifs: List[str] = []
-
     perform_header_check = True
     debug_mode = False
 
+    # How jobs are handed to the OCR bot: 'list' for the `ocr_ids` list, or
+    # 'stream' for the consumer group based queue in tor.helpers.ocr_queue
+    ocr_dispatch_mode = os.getenv('OCR_DISPATCH_MODE', 'list')
+
+    # Number of threads working through the inbox at once. Items for the same
+    # post are always handled by one thread, in order.
+    inbox_workers = int(os.getenv('INBOX_WORKERS', '8'))
+
+    # How often the mod list is fetched again, in seconds
+    mod_refresh_interval = int(os.getenv('MOD_REFRESH_INTERVAL', '600'))
+
+    # Overrides for how often each task runs; see tor.core.scheduler
+    schedule_path = os.getenv('SCHEDULE_PATH', 'schedule.json')
+
+    # Where /metrics is served; a port of 0 turns it off
+    metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+    metrics_port = int(os.getenv('METRICS_PORT', '9110'))
+
+    # Where profiles from `--profile` / `!profile` are saved, and how they're
+    # taken: 'sample' or 'cprofile'
+    profile_dir = os.getenv('PROFILE_DIR', 'profiles')
+    profile_mode = os.getenv('PROFILE_MODE', 'sample')
+
+    # Enough connections for every thread of the subreddit scan
+    http_pool_size = 50
+
+    # Set by `--dry-run` / `--replay`: a tor.core.dry_run.DryRun that every
+    # write is captured by instead of being sent
+    dry_run = None
+
     # Name of the bot
     name = __SELF_NAME__
     bot_version = __version__
 
-    last_post_scan_time = datetime.datetime(1970, 1, 1, 1, 1, 1)
-
     @cached_property
     def redis(self):
         """
         Lazy-loaded redis connection
         """
-        from redis import StrictRedis
         import redis.exceptions
+        from tor.core.dry_run import DryRunRedis
+        from tor.core.metrics import TimedRedis
 
         try:
             url = os.environ.get('REDIS_CONNECTION_URL',
                                  'redis://localhost:6379/0')
-            conn = StrictRedis.from_url(url)
+            if self.dry_run:
+                conn = DryRunRedis.from_url(url)
+                conn.journal = self.dry_run.journal
+                conn.overlay = self.dry_run.overlay
+            else:
+                conn = TimedRedis.from_url(url)
             conn.ping()
         except redis.exceptions.ConnectionError:
             logging.fatal("Redis server is not running")
             raise
         return conn
 
+    @cached_property
+    def blacklist(self):
+        """
+        Local copy of the users the bot won't interact with
+        """
+        from tor.helpers.cached_sets import CachedRedisSet
+
+        return CachedRedisSet(self.redis, 'blacklist')
+
+    @cached_property
+    def accepted_coc(self):
+        """
+        Local copy of the users who have accepted the Code of Conduct
+        """
+        from tor.helpers.cached_sets import CachedRedisSet
+
+        return CachedRedisSet(self.redis, 'accepted_CoC')
+
+    @cached_property
+    def post_states(self):
+        """
+        The authoritative state of our posts; flair only mirrors it
+        """
+        from tor.core.post_state import PostStateStore
+
+        return PostStateStore(self.redis)
+
+    @cached_property
+    def flair_writer(self):
+        """
+        Applies post flair in the background, one change at a time and in the
+        order they were made
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix='flair')
+
+    @cached_property
+    def commands(self):
+        """
+        The admin commands, loaded from commands.json
+        """
+        from tor.core.admin_commands import CommandRegistry
+
+        return CommandRegistry(os.getenv('COMMANDS_PATH', 'commands.json'))
+
     @cached_property
     def tor(self) -> Subreddit:
         if self.debug_mode:
@@ -78,21 +200,101 @@ class Config(object):
         else:
             return self.r.subreddit('transcribersofreddit')
 
+    @cached_property
+    def wiki_cache(self):
+        """
+        Lazy-loaded, revision-aware copy of the subreddit wiki
+        """
+        from tor.core.wiki import WikiCache
+
+        return WikiCache(os.getenv('WIKI_SNAPSHOT_PATH', 'wiki_snapshot.json'))
+
     @cached_property
     def modchat(self):
+        if self.dry_run:
+            from tor.core.dry_run import DryRunSlackClient
+
+            return DryRunSlackClient(self.dry_run.journal)
         return SlackClient(os.getenv('SLACK_API_KEY', None))
 
+    @cached_property
+    def http(self):
+        """
+        HTTP session shared by PRAW and the subreddit scan
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        if self.dry_run:
+            self.dry_run.mount(session, self.http_pool_size)
+        else:
+            adapter = HTTPAdapter(pool_connections=self.http_pool_size, pool_maxsize=self.http_pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+    @cached_property
+    def modchat_dispatcher(self):
+        """
+        Background sender for mod chat messages
+        """
+        from tor.helpers.modchat import ModchatDispatcher
+
+        return ModchatDispatcher(
+            self.modchat,
+            max_queue_size=int(os.getenv('MODCHAT_QUEUE_SIZE', '1000')),
+        )
+
+    def publish_snapshot(self, snapshot: ConfigSnapshot) -> None:
+        """
+        Swap in a whole new configuration.
+
+        :param snapshot: the new configuration.
+        """
+        with self._snapshot_lock:
+            self.snapshot = snapshot
+
+    def update_snapshot(self, **changes) -> ConfigSnapshot:
+        """
+        Publish a copy of the current snapshot with some values replaced.
+
+        :param changes: the fields of `ConfigSnapshot` to replace.
+        :return: the new snapshot.
+        """
+        with self._snapshot_lock:
+            self.snapshot = self.snapshot._replace(**changes)
+            return self.snapshot
+
+    @cached_property
+    def traces(self):
+        """
+        When each post reached each stage, for `tor-trace`
+        """
+        from tor.core.trace import LifecycleTrace
+
+        return LifecycleTrace(self.redis)
+
+    @cached_property
+    def profiler(self):
+        """
+        Profiles the next few runs of the scheduled tasks on request
+        """
+        from tor.core.profiling import Profiler
+
+        return Profiler(self.profile_dir, self.profile_mode)
+
     # Compatibility
     core_version = __version__
-    video_domains: List[str] = []
-    audio_domains: List[str] = []
-    image_domains: List[str] = []
-    video_formatting = ''
-    audio_formatting = ''
-    image_formatting = ''
-    other_formatting = ''
-    upvote_filter_subs: Dict[str, int] = {}
-    no_link_header_subs: List[str] = []
+    video_domains = _from_snapshot()
+    audio_domains = _from_snapshot()
+    image_domains = _from_snapshot()
+    video_formatting = _from_snapshot()
+    audio_formatting = _from_snapshot()
+    image_formatting = _from_snapshot()
+    other_formatting = _from_snapshot()
+    upvote_filter_subs = _from_snapshot()
+    no_link_header_subs = _from_snapshot()
 
 
 try:
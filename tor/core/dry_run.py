@@ -0,0 +1,517 @@
+"""
+Dry-run mode: the bot runs its real scan, inbox and validation code, but
+nothing it does leaves the machine. Reads go to Reddit (or come from a
+recording), and every write is captured in a local journal instead:
+
+- Requests to Reddit other than GETs (submit, reply, flair, mark as read
+  and so on) are answered with a made-up success by `DryRunAdapter`, which
+  is mounted on the HTTP session PRAW and the subreddit scan use. The few
+  POSTs that only read, like listing the flair choices, are let through.
+- Redis commands that would change something are answered by `DryRunRedis`
+  without being sent. What they would have done to strings, sets and hash
+  fields is kept in an `Overlay`, so later reads in the same run see it
+  (a post we "posted" isn't posted again, a checkpointed inbox item isn't
+  handled twice). Lua scripts are run step by step by the Python
+  functions handed to `DryRunRedis.add_script`, so their writes are held
+  back the same way.
+- Inbox items we would have marked as read are left out of the unread
+  listing from then on.
+- Slack messages go to `DryRunSlackClient`.
+
+Live responses can be saved with `--record PATH` and served again with
+`--replay PATH`, so the same traffic can be pushed through different
+versions of the bot. When it exits, a report of the throughput and every
+kind of action that would have been taken is logged and added to the
+journal.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from redis.client import StrictPipeline
+from redis.exceptions import ResponseError
+
+from tor.core import metrics
+from tor.core.metrics import TimedRedis
+
+log = logging.getLogger(__name__)
+
+# Redis commands that only read, and so are still sent in a dry run
+READ_COMMANDS = frozenset({
+    'DBSIZE', 'EXISTS', 'GET', 'GETRANGE', 'HEXISTS', 'HGET', 'HGETALL', 'HKEYS', 'HLEN', 'HMGET',
+    'HSCAN', 'HVALS', 'INFO', 'KEYS', 'LINDEX', 'LLEN', 'LRANGE', 'MGET', 'PING', 'PTTL', 'SCAN',
+    'SCARD', 'SISMEMBER', 'SMEMBERS', 'SRANDMEMBER', 'SSCAN', 'STRLEN', 'TIME', 'TTL', 'TYPE',
+    'UNWATCH', 'WATCH', 'XINFO', 'XLEN', 'XPENDING', 'XRANGE', 'XREVRANGE', 'ZCARD', 'ZCOUNT',
+    'ZRANGE', 'ZRANGEBYSCORE', 'ZRANK', 'ZREVRANGE', 'ZREVRANGEBYSCORE', 'ZREVRANK', 'ZSCAN',
+    'ZSCORE',
+})
+
+# What redis-py would have handed back for writes that don't return a count
+TRUE_REPLY_COMMANDS = frozenset({
+    'EXPIRE', 'EXPIREAT', 'HMSET', 'LTRIM', 'MSET', 'PEXPIRE', 'RENAME', 'SET', 'SETEX',
+})
+NONE_REPLY_COMMANDS = frozenset({'BLPOP', 'BRPOP', 'LPOP', 'RPOP', 'SPOP', 'XREADGROUP'})
+
+# Reddit endpoints that are POSTed to but only read, so they're still sent
+# (the flair choices live under /r/<subreddit>/ as well)
+READ_ONLY_POSTS = ('/api/flairselector', '/api/morechildren')
+
+
+class Journal(object):
+    """
+    Every write that was held back, one JSON object per line.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.counts: 'Counter[Tuple[str, str]]' = Counter()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, target: str, action: str, **detail: Any) -> None:
+        entry = dict(detail, at=time.time(), target=target, action=action)
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            self.counts[(target, action)] += 1
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class Overlay(object):
+    """
+    What the Redis writes held back in a dry run would have changed, laid
+    over what's really in Redis. Strings, sets and hash fields are covered,
+    which is where the bot keeps its own state; anything else is read
+    straight from Redis.
+
+    Usage:
+    overlay.write(('SADD', 'complete_post_ids', 't3_abc'))
+    overlay.read(('SISMEMBER', 'complete_post_ids', 't3_abc'), False)  # True
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._strings: Dict[bytes, bytes] = {}
+        self._added: Dict[bytes, Set[bytes]] = defaultdict(set)
+        self._removed: Dict[bytes, Set[bytes]] = defaultdict(set)
+        self._fields: Dict[bytes, Dict[bytes, bytes]] = defaultdict(dict)
+        self._removed_fields: Dict[bytes, Set[bytes]] = defaultdict(set)
+        # Keys that were deleted, so whatever Redis has for them is ignored
+        self._deleted: Set[bytes] = set()
+
+    def write(self, args) -> None:
+        command = str(args[0]).upper()
+        if len(args) < 2:
+            return
+        key = _bytes(args[1])
+        values = [_bytes(value) for value in args[2:]]
+        with self._lock:
+            if command == 'DEL':
+                for deleted in [key] + values:
+                    self._deleted.add(deleted)
+                    self._strings.pop(deleted, None)
+                    self._added.pop(deleted, None)
+                    self._removed.pop(deleted, None)
+                    self._fields.pop(deleted, None)
+                    self._removed_fields.pop(deleted, None)
+            elif command == 'SET':
+                self._strings[key] = values[0]
+            elif command == 'SADD':
+                self._added[key].update(values)
+                self._removed[key].difference_update(values)
+            elif command == 'SREM':
+                self._removed[key].update(values)
+                self._added[key].difference_update(values)
+            elif command in ('HSET', 'HMSET'):
+                self._fields[key].update(zip(values[::2], values[1::2]))
+                self._removed_fields[key].difference_update(values[::2])
+            elif command == 'HDEL':
+                for field in values:
+                    self._fields[key].pop(field, None)
+                self._removed_fields[key].update(values)
+
+    def read(self, args, result: Any) -> Any:
+        """
+        :param args: the read command that was sent.
+        :param result: what Redis answered.
+        :return: the answer with the held back writes applied.
+        """
+        command = str(args[0]).upper()
+        if len(args) < 2:
+            return result
+        key = _bytes(args[1])
+        with self._lock:
+            deleted = key in self._deleted
+            if command == 'GET':
+                return self._strings.get(key, None if deleted else result)
+            if command == 'SISMEMBER':
+                member = _bytes(args[2])
+                if member in self._added.get(key, ()):
+                    return True
+                if deleted or member in self._removed.get(key, ()):
+                    return False
+                return result
+            if command == 'SMEMBERS':
+                members = set() if deleted else set(result)
+                return (members | self._added.get(key, set())) - self._removed.get(key, set())
+            fields = self._fields.get(key, {})
+            removed = self._removed_fields.get(key, set())
+
+            def field(name: Any, value: Any) -> Any:
+                name = _bytes(name)
+                if name in fields:
+                    return fields[name]
+                return None if deleted or name in removed else value
+
+            if command == 'HGET':
+                return field(args[2], result)
+            if command == 'HMGET':
+                return [field(name, value) for name, value in zip(args[2:], result)]
+            if command == 'HGETALL':
+                values = {} if deleted else {name: value for name, value in dict(result).items() if name not in removed}
+                values.update(fields)
+                return values
+        return result
+
+
+def _bytes(value: Any) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _request_body(request: requests.PreparedRequest) -> str:
+    return request.body.decode() if isinstance(request.body, bytes) else (request.body or '')
+
+
+def _request_key(request: requests.PreparedRequest) -> str:
+    if request.method in ('GET', 'HEAD'):
+        return f'{request.method} {request.url}'
+    # The POSTs that only read say what they're after in the body
+    return f'{request.method} {request.url} {_request_body(request)}'
+
+
+def _request_path(request: requests.PreparedRequest) -> str:
+    # PRAW asks for 'api/submit/', the subreddit scan for 'new.json'
+    return urlsplit(str(request.url)).path.rstrip('/') or '/'
+
+
+def _build_response(request: requests.PreparedRequest, status: int, body: str,
+                    content_type='application/json; charset=UTF-8') -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response._content = body.encode()
+    response.headers = CaseInsensitiveDict({'Content-Type': content_type, 'Content-Length': str(len(response._content))})
+    response.encoding = 'utf-8'
+    response.url = str(request.url)
+    response.request = request
+    return response
+
+
+class Recording(object):
+    """
+    Responses to requests that only read, saved as JSON lines so they can be played
+    back. A request that was seen more than once gets its responses back in
+    the same order, and then the last one again.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._responses: Dict[str, List[Dict]] = defaultdict(list)
+        self._served: 'Counter[str]' = Counter()
+
+    def load(self) -> 'Recording':
+        with open(self.path) as recording:
+            for line in recording:
+                entry = json.loads(line)
+                self._responses[entry['key']].append(entry)
+        log.info(f'Loaded {sum(len(found) for found in self._responses.values())} recorded responses from {self.path}')
+        return self
+
+    def save(self, request: requests.PreparedRequest, response: requests.Response) -> None:
+        entry = {
+            'key': _request_key(request),
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type', ''),
+            'body': response.text,
+        }
+        with self._lock:
+            with open(self.path, 'a') as recording:
+                recording.write(json.dumps(entry) + '\n')
+
+    def response_for(self, request: requests.PreparedRequest) -> requests.Response:
+        key = _request_key(request)
+        with self._lock:
+            found = self._responses.get(key)
+            if not found:
+                log.warning(f'Nothing recorded for {key}')
+                return _build_response(request, 404, '{}')
+            entry = found[min(self._served[key], len(found) - 1)]
+            self._served[key] += 1
+        return _build_response(request, entry['status'], entry['body'], entry['content_type'])
+
+
+class DryRunAdapter(HTTPAdapter):
+    """
+    Lets requests that only read through (or answers them from a recording)
+    and answers everything else itself, after writing it to the journal.
+    """
+
+    def __init__(self, journal: Journal, record: Optional[Recording] = None,
+                 replay: Optional[Recording] = None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.journal = journal
+        self.record = record
+        self.replay = replay
+        self._ids = 0
+        self._ids_lock = threading.Lock()
+        # Inbox items we would have marked as read
+        self._read: Set[str] = set()
+
+    def send(self, request, **kwargs):
+        if request.method not in ('GET', 'HEAD') and not _request_path(request).endswith(READ_ONLY_POSTS):
+            if _request_path(request) == '/api/v1/access_token':
+                # Logging in doesn't change anything, and we can't read without it
+                if self.replay is None:
+                    return super().send(request, **kwargs)
+                return _build_response(request, 200, json.dumps({
+                    'access_token': 'dry-run', 'token_type': 'bearer', 'expires_in': 3600, 'scope': '*',
+                }))
+            return self._hold_back(request)
+
+        if self.replay is not None:
+            response = self.replay.response_for(request)
+        else:
+            response = super().send(request, **kwargs)
+            if self.record is not None:
+                self.record.save(request, response)
+        if _request_path(request) == '/message/unread':
+            return self._hide_read(request, response)
+        return response
+
+    def _hide_read(self, request: requests.PreparedRequest, response: requests.Response) -> requests.Response:
+        """
+        Leave out of the unread listing whatever we would have marked as
+        read, so it isn't handled again on the next inbox check.
+        """
+        with self._ids_lock:
+            read = set(self._read)
+        if response.status_code != 200 or not read:
+            return response
+
+        listing = response.json()
+        children = listing['data']['children']
+        listing['data']['children'] = [child for child in children if child['data'].get('name') not in read]
+        return _build_response(
+            request, response.status_code, json.dumps(listing), response.headers.get('Content-Type', '')
+        )
+
+    def _next_id(self) -> str:
+        with self._ids_lock:
+            self._ids += 1
+            return f'dryrun{self._ids}'
+
+    def _hold_back(self, request: requests.PreparedRequest) -> requests.Response:
+        path = _request_path(request)
+        data = {name: value for name, value in parse_qsl(_request_body(request)) if name != 'api_type'}
+        self.journal.record('reddit', f'{request.method} {path}', data=data)
+
+        if path == '/api/read_message':
+            with self._ids_lock:
+                self._read.update(fullname for fullname in data.get('id', '').split(',') if fullname)
+
+        if path == '/api/submit':
+            post_id = self._next_id()
+            reply: Dict = {'json': {'errors': [], 'data': {
+                'id': post_id,
+                'name': f't3_{post_id}',
+                'url': f'https://www.reddit.com/r/{data.get("sr", "dryrun")}/comments/{post_id}/dry_run/',
+            }}}
+        elif path == '/api/comment':
+            comment_id = self._next_id()
+            reply = {'json': {'errors': [], 'data': {'things': [{'kind': 't1', 'data': {
+                'id': comment_id,
+                'name': f't1_{comment_id}',
+                'body': data.get('text', ''),
+                'parent_id': data.get('thing_id', ''),
+                'link_id': data.get('thing_id', '') if data.get('thing_id', '').startswith('t3_') else '',
+            }}]}}}
+        else:
+            reply = {}
+        return _build_response(request, 200, json.dumps(reply))
+
+
+class DryRunPipeline(StrictPipeline):
+    conn: 'DryRunRedis'
+
+    def immediate_execute_command(self, *args, **options):
+        if str(args[0]).upper() in READ_COMMANDS:
+            return self.conn.overlay.read(args, super().immediate_execute_command(*args, **options))
+        return _fake_write(self.conn, args)
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        reads = StrictPipeline(self.connection_pool, self.response_callbacks, False, self.shard_hint)
+        is_read = [str(args[0]).upper() in READ_COMMANDS for args, _options in stack]
+        try:
+            for (args, options), read in zip(stack, is_read):
+                if read:
+                    reads.execute_command(*args, **options)
+            read_results = iter(reads.execute(raise_on_error))
+            # Nothing really changes in Redis, so the reads can all be sent
+            # first and the writes laid over them in order
+            return [
+                self.conn.overlay.read(args, next(read_results)) if read else _fake_write(self.conn, args)
+                for (args, _options), read in zip(stack, is_read)
+            ]
+        finally:
+            self.reset()
+
+
+class DryRunRedis(TimedRedis):
+    """
+    Sends only the commands that read, and journals the rest. Writes are
+    answered with what Redis would most likely have said, and kept in
+    `overlay` so that later reads see them.
+    """
+    journal: Journal
+    overlay: Overlay
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # What each Lua script does, by SHA1, as a Python function taking
+        # (redis, keys, args); see `add_script`
+        self.scripts: Dict[str, Callable] = {}
+        self.scripts_lock = threading.Lock()
+
+    def add_script(self, source: str, func: Callable) -> None:
+        """
+        Say what a script does, so that calls to it can be run step by step
+        here instead of being sent.
+        """
+        self.scripts[hashlib.sha1(source.encode()).hexdigest()] = func
+
+    def execute_command(self, *args, **options):
+        if str(args[0]).upper() in READ_COMMANDS:
+            return self.overlay.read(args, super().execute_command(*args, **options))
+        return _fake_write(self, args)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = DryRunPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.conn = self
+        return pipe
+
+
+def _fake_write(conn: DryRunRedis, args) -> Any:
+    command = str(args[0]).upper()
+    if command in ('MULTI', 'EXEC', 'DISCARD'):
+        return True
+    if command == 'EVALSHA':
+        # Its writes are journaled one by one as it goes
+        return _run_script(conn, args)
+    conn.journal.record('redis', command, args=[str(arg) for arg in args[1:]])
+
+    if command in ('INCR', 'INCRBY', 'HINCRBY'):
+        # Counts get shown to people (flair, for one), so make them add up
+        amount = int(args[-1]) if command != 'INCR' else 1
+        if command == 'HINCRBY':
+            total = int(conn.hget(args[1], args[2]) or 0) + amount
+            conn.overlay.write(('HSET', args[1], args[2], total))
+        else:
+            total = int(conn.get(args[1]) or 0) + amount
+            conn.overlay.write(('SET', args[1], total))
+        return total
+    if command == 'HSETNX':
+        if conn.hget(args[1], args[2]) is not None:
+            return 0
+        conn.overlay.write(('HSET',) + tuple(args[1:]))
+        return 1
+
+    conn.overlay.write(args)
+    if command in TRUE_REPLY_COMMANDS:
+        return True
+    if command in NONE_REPLY_COMMANDS:
+        return None
+    return 1
+
+
+def _run_script(conn: DryRunRedis, args) -> Any:
+    sha, numkeys = str(args[1]), int(args[2])
+    script = conn.scripts.get(sha)
+    if script is None:
+        raise ResponseError(f'Script {sha} has to be added with add_script to be run in a dry run')
+    # One at a time, since there's nothing making each step-by-step run atomic
+    with conn.scripts_lock:
+        return script(conn, list(args[3:3 + numkeys]), list(args[3 + numkeys:]))
+
+
+class DryRunSlackClient(object):
+    def __init__(self, journal: Journal) -> None:
+        self.journal = journal
+
+    def api_call(self, method: str, **kwargs) -> Dict:
+        self.journal.record('slack', method, **kwargs)
+        return {'ok': True}
+
+
+class DryRun(object):
+    """
+    Everything a dry run needs, in one place for the config object.
+
+    Usage:
+    config.dry_run = DryRun('journal.jsonl', replay='traffic.jsonl')
+    """
+
+    def __init__(self, journal_path: str, record: Optional[str] = None, replay: Optional[str] = None) -> None:
+        self.journal = Journal(journal_path)
+        self.overlay = Overlay()
+        self.record = Recording(record) if record else None
+        self.replay = Recording(replay).load() if replay else None
+
+    def mount(self, session: requests.Session, pool_size: int) -> None:
+        adapter = DryRunAdapter(
+            self.journal, record=self.record, replay=self.replay,
+            pool_connections=pool_size, pool_maxsize=pool_size,
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def report(self) -> List[str]:
+        """
+        :return: lines saying how much work got done, how fast, and what
+            would have been written.
+        """
+        elapsed = max(time.time() - self.journal.started, 1e-9)
+        lines = [f'Dry run for {elapsed:.0f}s; journal in {self.journal.path}']
+
+        for (task,), (count, total) in sorted(metrics.TASK_DURATION.totals().items()):
+            lines.append(f'  task {task}: {count} runs, {count / elapsed * 60:.1f}/min, avg {total / count:.2f}s')
+        for (outcome,), posts in sorted(metrics.POSTS.totals().items()):
+            lines.append(f'  posts {outcome}: {posts:.0f} ({posts / elapsed:.2f}/s)')
+        replies = sum(metrics.REPLY_INTENTS.totals().values())
+        lines.append(f'  inbox replies handled: {replies:.0f} ({replies / elapsed:.2f}/s)')
+
+        lines.append('Would have written:')
+        for (target, action), count in sorted(self.journal.counts.items()):
+            lines.append(f'  {target} {action}: {count}')
+        return lines
+
+    def finish(self) -> None:
+        lines = self.report()
+        log.info('\n'.join(lines))
+        self.journal.record('report', 'summary', lines=lines)
+        self.journal.close()
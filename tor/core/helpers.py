@@ -1,19 +1,26 @@
+import functools
 import logging
 import re
 import signal
 import sys
+import threading
 import time
-from typing import List
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Union
 
+from praw import Reddit  # type: ignore
 from praw.exceptions import APIException  # type: ignore
-from praw.models import Comment, Submission, Subreddit  # type: ignore
-from prawcore.exceptions import RequestException, ServerError, Forbidden, NotFound  # type: ignore
+from praw.models import Comment, Submission  # type: ignore
 
 import tor.core
 from tor.core import __version__
 from tor.core.config import config, Config
+from tor.core.metrics import record_rate_limit
 from tor.strings import translation
 
+if TYPE_CHECKING:
+    from tor.core.scheduler import Task  # noqa: F401
+
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +30,11 @@ subreddit_regex = re.compile(
 )
 i18n = translation()
 
+# Reddit objects handed out during the current scope, keyed by fullname. Each
+# thread has its own; threads started during a run are handed their run's.
+_object_scope = threading.local()
+_object_scope_lock = threading.Lock()
+
 
 class flair(object):
     unclaimed = 'Unclaimed'
@@ -68,7 +80,8 @@ def clean_list(items: List[str]) -> List[str]:
 
 def send_to_modchat(message: str, cfg: Config, channel='general') -> None:
     """
-    Sends a message to the ToR mod chat.
+    Sends a message to the ToR mod chat. The message is queued and sent in
+    the background, so this never waits on Slack.
 
     :param message: String; the message that is to be encoded
     :param cfg: the global config dict.
@@ -76,16 +89,7 @@ def send_to_modchat(message: str, cfg: Config, channel='general') -> None:
     :return: None.
     """
     if cfg.modchat:
-        try:
-            cfg.modchat.api_call(
-                'chat.postMessage',
-                channel=channel,
-                text=message
-            )
-        except Exception as e:
-            log.error(f'Failed to send message to modchat #{channel}: '
-                      f'\'{message}\'')
-            log.error(e)
+        cfg.modchat_dispatcher.send(channel, message)
 
 
 def is_our_subreddit(subreddit_name: str, cfg: Config) -> bool:
@@ -117,47 +121,161 @@ def clean_id(post_id: str) -> str:
     return post_id[post_id.index('_') + 1:]
 
 
-def get_parent_post_id(post: Comment, subreddit: Subreddit) -> Submission:
+class _SerializedSession(object):
+    """
+    Lets one request at a time through a prawcore session.
+    """
+
+    def __init__(self, session) -> None:
+        self._session = session
+        self._lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self._lock:
+            return self._session.request(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._session, name)
+
+
+def serialize_requests(r: Reddit) -> Reddit:
+    """
+    PRAW keeps its rate limiter and access token on a session that isn't
+    safe to use from several threads at once, and the inbox workers and
+    scheduled tasks all share one Reddit instance. This makes its requests
+    take turns; everything else those threads do still runs side by side.
+
+    :param r: the instantiated reddit object, before it has been used.
+    :return: the same reddit object.
+    """
+    sessions: Dict[int, _SerializedSession] = {}
+    for name in ('_core', '_authorized_core', '_read_only_core'):
+        session = getattr(r, name, None)
+        if session is not None:
+            # `_core` is one of the other two; keep them the same object
+            sessions.setdefault(id(session), _SerializedSession(session))
+            setattr(r, name, sessions[id(session)])
+    return r
+
+
+@contextmanager
+def reddit_object_scope(objects: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    While this is active, `get_submission` and `get_comment` hand back the
+    same object every time they're asked for the same ID, so anything that
+    has been loaded once is never requested from Reddit again. Meant to wrap
+    one run of a task; everything is forgotten when it ends. Runs of other
+    tasks going on at the same time have scopes of their own.
+
+    The scope belongs to the thread that opened it. To share it with worker
+    threads, wrap what they run with `in_object_scope`.
+
+    Usage:
+    with reddit_object_scope():
+        check_inbox(config)
+
+    :param objects: the objects of a scope that's already open, to join it
+        instead of starting a new one.
+    :return: the objects in the scope.
+    """
+    outer = getattr(_object_scope, 'objects', None)
+    _object_scope.objects = {} if objects is None else objects
+    try:
+        yield _object_scope.objects
+    finally:
+        _object_scope.objects = outer
+
+
+def in_object_scope(func: Callable) -> Callable:
+    """
+    Wrap `func` so that it runs in the object scope of whoever called this,
+    even on another thread.
+
+    Usage:
+    executor.submit(in_object_scope(_process_shard), items, cfg)
+    """
+    objects = getattr(_object_scope, 'objects', None)
+    if objects is None:
+        return func
+
+    @functools.wraps(func)
+    def run_in_scope(*args, **kwargs):
+        with reddit_object_scope(objects):
+            return func(*args, **kwargs)
+
+    return run_in_scope
+
+
+def _scoped(fullname: str, create: Callable[[], Any]) -> Any:
+    scope = getattr(_object_scope, 'objects', None)
+    if scope is None:
+        return create()
+
+    with _object_scope_lock:
+        if fullname not in scope:
+            scope[fullname] = create()
+        return scope[fullname]
+
+
+def get_submission(r: Reddit, submission_id: str) -> Submission:
+    """
+    :param r: the instantiated reddit object
+    :param submission_id: String; the ID of the submission, with or without
+        the `t3_` prefix.
+    :return: the submission, shared with everyone else in the same
+        `reddit_object_scope`.
+    """
+    submission_id = clean_id(submission_id) if '_' in submission_id else submission_id
+    return _scoped(f't3_{submission_id}', lambda: r.submission(id=submission_id))
+
+
+def get_comment(r: Reddit, comment_id: str) -> Comment:
+    """
+    :param r: the instantiated reddit object
+    :param comment_id: String; the ID of the comment, with or without the
+        `t1_` prefix.
+    :return: the comment, shared with everyone else in the same
+        `reddit_object_scope`.
+    """
+    comment_id = clean_id(comment_id) if '_' in comment_id else comment_id
+    return _scoped(f't1_{comment_id}', lambda: r.comment(id=comment_id))
+
+
+def get_parent_post_id(post: Comment, r: Reddit) -> Submission:
     """
     Takes any given comment object and returns the object of the
-    original post, no matter how far up the chain it is. This is
-    a very time-intensive function because of how Reddit handles
-    rate limiting and the fact that you can't just request the
-    top parent -- you have to just loop your way to the top.
+    original post, no matter how far up the chain it is.
+
+    Every comment knows which submission it belongs to, so there's no need
+    to walk up the comment tree. Comments from the inbox have no `link_id`,
+    but PRAW works the submission out from their `context` without asking
+    Reddit.
 
     :param post: comment object
     :param r: the instantiated reddit object
     :return: submission object of the top post.
     """
-    if not post.is_root:
-        parent = subreddit.comment(id=clean_id(post.parent_id))
-        return get_parent_post_id(parent, subreddit)
-    else:
-        return subreddit.submission(id=clean_id(post.parent_id))
+    return get_submission(r, post.submission.id)
 
 
 def get_wiki_page(pagename: str, cfg: Config) -> str:
     """
-    Return the contents of a given wiki page.
+    Return the contents of a given wiki page. The page is served from the
+    wiki cache and is only downloaded again if it has a new revision.
 
     :param pagename: String. The name of the page to be requested.
     :param cfg: Dict. Global config object.
-    :param return_on_fail: Any value to return when nothing is found
-        at the requested page. This allows us to specify returns for
-        easier work in debug mode.
-    :param subreddit: Object. A specific PRAW Subreddit object if we
-        want to interact with a different sub.
-    :return: String or None. The content of the requested page if
-        present else None.
+    :return: String. The content of the requested page if present, else an
+        empty string.
     """
     log.debug(f'Retrieving wiki page {pagename}')
-    try:
-        return cfg.tor.wiki[pagename].content_md
-    except NotFound:
-        return ''
+    return cfg.wiki_cache.get(pagename, cfg.tor)
 
 
-def handle_rate_limit(exc: APIException) -> None:
+def rate_limit_delay(exc: APIException) -> int:
+    """
+    :return: how many seconds Reddit asked us to wait for, plus one for luck.
+    """
     time_map = {
         'second': 1,
         'minute': 60,
@@ -166,26 +284,35 @@ def handle_rate_limit(exc: APIException) -> None:
     matches = re.search(_pattern, exc.message)
     if not matches:
         log.error(f'Unable to parse rate limit message {exc.message!r}')
-        return
-    delay = matches[0] * time_map[matches[1]]
-    time.sleep(delay + 1)
+        return 0
+    unit = matches['unit'].lower().rstrip('s')
+    return int(matches['number']) * time_map.get(unit, 60) + 1
 
 
-def run_until_dead(func):
+def handle_rate_limit(exc: APIException) -> None:
+    delay = rate_limit_delay(exc)
+    record_rate_limit('reddit', delay)
+    time.sleep(delay)
+
+
+def run_until_dead(tasks: Union[Callable, List['Task']]) -> None:
     """
     The official method that replaces all that ugly boilerplate required to
-    start up a bot under the TranscribersOfReddit umbrella. This method handles
-    communication issues with Reddit, timeouts, and handles CTRL+C and
-    unexpected crashes.
-
-    :param func: The function that you want to run; this will automatically be
-        passed the config object. Historically, this is the only thing needed
-        to start a bot.
-    :param exceptions: A tuple of exception classes to guard against. These are
-        a set of PRAW connection errors (timeouts and general connection
-        issues) but they can be overridden with a passed-in set.
+    start up a bot under the TranscribersOfReddit umbrella. Every task is run
+    on its own schedule by a `Scheduler`, which handles communication issues
+    with Reddit and timeouts, and restarts a task on its own if it crashes.
+    CTRL+C stops everything after the runs that are going on have finished.
+
+    :param tasks: List of `Task`s to run. A plain function is also accepted;
+        it's run over and over, and will automatically be passed the config
+        object. Historically, this is the only thing needed to start a bot.
     :return: None.
     """
+    from tor.core.scheduler import Scheduler, Task
+
+    if callable(tasks):
+        tasks = [Task(tasks.__name__, tasks, interval=0)]
+    scheduler = Scheduler(config, tasks, profiler=config.profiler)
 
     def double_ctrl_c_handler(*args, **kwargs) -> None:
         if not tor.core.is_running:
@@ -193,28 +320,16 @@ def run_until_dead(func):
             sys.exit(1)
 
         log.info(
-            '\rUser triggered command line shutdown. Will terminate after current loop.'
+            '\rUser triggered command line shutdown. Will terminate after current runs.'
         )
         tor.core.is_running = False
+        scheduler.stop()
 
     # handler for CTRL+C
     signal.signal(signal.SIGINT, double_ctrl_c_handler)
 
     try:
-        while tor.core.is_running:
-            try:
-                func(config)
-            except APIException as e:
-                if e.error_type == 'RATELIMIT':
-                    log.warning(
-                        'Ratelimit - artificially limited by Reddit. Sleeping'
-                        ' for requested time!'
-                    )
-                    handle_rate_limit(e)
-            except (RequestException, ServerError, Forbidden) as e:
-                log.warning(f'{e} - Issue communicating with Reddit. Sleeping for 60s!')
-                time.sleep(60)
-
+        scheduler.run()
         log.info('User triggered shutdown. Shutting down.')
         sys.exit(0)
 
@@ -1,5 +1,9 @@
 import logging
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Pattern, Set, Tuple
 
 from praw.exceptions import ClientException  # type: ignore
 from praw.models import Comment, Message  # type: ignore
@@ -8,7 +12,8 @@ from praw.models.reddit.mixins import InboxableMixin  # type: ignore
 from tor.core import validation
 from tor.core.admin_commands import process_command, process_override
 from tor.core.config import Config
-from tor.core.helpers import send_to_modchat, is_our_subreddit, _
+from tor.core.helpers import in_object_scope, send_to_modchat, is_our_subreddit, _
+from tor.core.metrics import INBOX_BACKLOG, REPLY_INTENTS
 from tor.core.user_interaction import (process_claim, process_coc,
                                        process_done, process_message,
                                        process_thanks, process_unclaim,
@@ -23,6 +28,155 @@ MOD_SUPPORT_PHRASES = [
 
 log = logging.getLogger(__name__)
 
+# Reddit marks at most 25 items as read per request
+MARK_READ_BATCH_SIZE = 25
+
+# Fullnames of inbox items that have been handled but not yet marked as read.
+# If the bot dies between the two, these are skipped on the next pass instead
+# of being handled a second time.
+INBOX_CHECKPOINT_KEY = 'inbox_handled'
+INBOX_CHECKPOINT_TTL = 60 * 60 * 24
+
+
+class intent(object):
+    mod_intervention = 'mod_intervention'
+    wrong_post_location = 'wrong_post_location'
+    accept_coc = 'accept_coc'
+    unclaim = 'unclaim'
+    claim = 'claim'
+    done = 'done'
+    thanks = 'thanks'
+    override = 'override'
+    unhandled = 'unhandled'
+
+
+# What a reply has to contain to trigger each intent, highest priority first.
+# Keywords are matched against the lowercased body of the reply.
+INTENT_KEYWORDS: List[Tuple[str, Tuple[str, ...]]] = [
+    (intent.wrong_post_location, ('image transcription',)),
+    (intent.accept_coc, ('i accept',)),
+    (intent.unclaim, ('unclaim', 'cancel')),
+    (intent.claim, ('claim', 'dibs')),
+    (intent.done, ('done', 'deno', 'doen')),
+    (intent.thanks, ('thank',)),  # trigger on "thanks" and "thank you"
+    (intent.override, ('!override',)),
+]
+
+
+def _literal_text(regex: Pattern) -> Optional[str]:
+    """
+    If the regex is just a case-insensitive piece of plain text, return that
+    text in lowercase.
+    """
+    if regex.flags & re.IGNORECASE and re.escape(regex.pattern) == regex.pattern:
+        return regex.pattern.lower()
+    return None
+
+
+def _literal(name: str, text: str) -> str:
+    # Only the first character is consumed, so the next match can start
+    # inside this one, the way 'claim' is inside 'unclaim'. Starting every
+    # alternative with a plain character also lets the regex engine skip
+    # straight to the places where one could match.
+    return f'{re.escape(text[0])}(?=(?P<{name}>{re.escape(text[1:])}))'
+
+
+def _phrase(name: str, regex: Pattern) -> str:
+    literal = _literal_text(regex)
+    if literal:
+        return _literal(name, literal)
+    return f'(?=(?P<{name}>{regex.pattern}))'
+
+
+# Longest first: only one keyword is matched at each position, so one that
+# starts another (like 'claim' and 'claimed' would) is picked up through
+# `_PREFIXES` instead
+_KEYWORDS = sorted(
+    (keyword for _, keywords in INTENT_KEYWORDS for keyword in keywords), key=len, reverse=True
+)
+_PREFIXES = {
+    keyword: frozenset(other for other in _KEYWORDS if keyword.startswith(other))
+    for keyword in _KEYWORDS
+}
+
+# Every phrase in MOD_SUPPORT_PHRASES (group `m<n>`) and every keyword in
+# INTENT_KEYWORDS (group `k<n>`) in one regex, run once over the lowercased
+# body. Phrases go first, since they decide the outcome if they match at all.
+_MATCHER = re.compile('|'.join(
+    [_phrase(f'm{index}', regex) for index, regex in enumerate(MOD_SUPPORT_PHRASES)]
+    + [_literal(f'k{index}', keyword) for index, keyword in enumerate(_KEYWORDS)]
+))
+
+
+class ReplyIntent(NamedTuple):
+    # The intent that wins out based on the priority above
+    intent: str
+    # Every intent the reply matched, regardless of priority; the footer
+    # check is only done when it could change the outcome
+    matched: FrozenSet[str]
+    keywords: FrozenSet[str]
+    mod_phrases: List[str]
+
+    @property
+    def alt_text(self) -> bool:
+        # "deno" and "doen" get a little extra text to ease false positives
+        return 'done' not in self.keywords
+
+
+def _scan(body: str) -> Tuple[FrozenSet[str], List[str]]:
+    """
+    Walk the body once, picking up every keyword and the first match of every
+    mod support phrase (as it was written).
+
+    :return: the keywords (in lowercase) and the phrases found.
+    """
+    lowered = body.lower()
+    # Lowercasing only changes the length of a few unusual characters
+    original = body if len(body) == len(lowered) else lowered
+
+    keywords: Set[str] = set()
+    phrases: Dict[int, str] = {}
+    for match in _MATCHER.finditer(lowered):
+        # Every alternative is one named group, so this is never None
+        name = str(match.lastgroup)
+        if name[0] == 'k':
+            keywords.update(_PREFIXES[_KEYWORDS[int(name[1:])]])
+        elif int(name[1:]) not in phrases:
+            phrases[int(name[1:])] = original[match.start():match.end(name)]
+    return frozenset(keywords), [phrases[index] for index in sorted(phrases)]
+
+
+def classify_reply(reply: Comment, cfg: Config) -> ReplyIntent:
+    """
+    Works out everything a reply could be asking for in one pass over the
+    body. The footer check is left until last, and only done if nothing more
+    important has already decided the outcome.
+
+    :param reply: the Comment object from the inbox.
+    :param cfg: the global config object.
+    :return: ReplyIntent with the winning intent and everything that matched.
+    """
+    keywords, mod_phrases = _scan(reply.body)
+
+    matched = {
+        name for name, triggers in INTENT_KEYWORDS
+        if any(keyword in keywords for keyword in triggers)
+    }
+    if mod_phrases:
+        matched.add(intent.mod_intervention)
+
+    decided = matched & {intent.mod_intervention, intent.wrong_post_location}
+    if not decided and validation._footer_check(reply, cfg):
+        matched.add(intent.wrong_post_location)
+
+    winner = intent.unhandled
+    for name in [intent.mod_intervention] + [name for name, _ in INTENT_KEYWORDS]:
+        if name in matched:
+            winner = name
+            break
+
+    return ReplyIntent(winner, frozenset(matched), keywords, mod_phrases)
+
 
 def forward_to_slack(item: InboxableMixin, cfg: Config) -> None:
     username = str(item.author.name)
@@ -40,20 +194,17 @@ def forward_to_slack(item: InboxableMixin, cfg: Config) -> None:
     )
 
 
-def process_mod_intervention(post: Comment, cfg: Config) -> None:
+def process_mod_intervention(post: Comment, cfg: Config, phrase_list: Optional[List[str]] = None) -> None:
     """
     Triggers an alert in slack with a link to the comment if there is something
     offensive or in need of moderator intervention
-    """
-    # Collect all offenses (noted by the above regular expressions) from the
-    # original
-    phrase_list = []
-    for regex in MOD_SUPPORT_PHRASES:
-        matches = regex.search(post.body)
-        if not matches:
-            continue
 
-        phrase_list.append(matches.group())
+    :param phrase_list: the offending phrases, if they've already been found.
+    """
+    if phrase_list is None:
+        # Collect all offenses (noted by the above regular expressions) from
+        # the original
+        _keywords, phrase_list = _scan(post.body)
 
     if len(phrase_list) == 0:
         # Nothing offensive here, why did this function get triggered?
@@ -72,31 +223,31 @@ def process_mod_intervention(post: Comment, cfg: Config) -> None:
 
 def process_reply(reply: Comment, cfg: Config) -> None:
     try:
-        r_body = reply.body.lower()  # cache that thing
+        classified = classify_reply(reply, cfg)
+        REPLY_INTENTS.inc(intent=classified.intent)
 
-        if any([regex.search(reply.body) for regex in MOD_SUPPORT_PHRASES]):
-            process_mod_intervention(reply, cfg)
+        if classified.intent == intent.mod_intervention:
+            process_mod_intervention(reply, cfg, classified.mod_phrases)
 
-        elif 'image transcription' in r_body or validation._footer_check(reply, cfg):
+        elif classified.intent == intent.wrong_post_location:
             process_wrong_post_location(reply, cfg)
 
-        elif 'i accept' in r_body:
+        elif classified.intent == intent.accept_coc:
             process_coc(reply, cfg)
 
-        elif 'unclaim' in r_body or 'cancel' in r_body:
+        elif classified.intent == intent.unclaim:
             process_unclaim(reply, cfg)
 
-        elif 'claim' in r_body or 'dibs' in r_body:
+        elif classified.intent == intent.claim:
             process_claim(reply, cfg)
 
-        elif 'done' in r_body or 'deno' in r_body or 'doen' in r_body:
-            alt_text = True if 'done' not in r_body else False
-            process_done(reply, cfg, alt_text_trigger=alt_text)
+        elif classified.intent == intent.done:
+            process_done(reply, cfg, alt_text_trigger=classified.alt_text)
 
-        elif 'thank' in r_body:  # trigger on "thanks" and "thank you"
+        elif classified.intent == intent.thanks:
             process_thanks(reply, cfg)
 
-        elif '!override' in r_body:
+        elif classified.intent == intent.override:
             process_override(reply, cfg)
 
         else:
@@ -137,50 +288,153 @@ def process_mention(mention: Comment) -> None:
         pass
 
 
+def process_inbox_item(item: InboxableMixin, cfg: Config) -> None:
+    """
+    Routes a single unread inbox item to whatever handles it.
+
+    :param item: the Comment or Message from the inbox.
+    :param cfg: the global config object.
+    :return: None.
+    """
+    # Very rarely we may actually get a message from Reddit itself.
+    # In this case, there will be no author attribute.
+    author_name = item.author.name if item.author else None
+
+    if author_name is None:
+        send_to_modchat(
+            f'We received a message without an author -- '
+            f'*{item.subject}*:\n{item.body}', cfg
+        )
+
+    elif author_name == 'transcribot':
+        # bot responses shouldn't trigger workflows in other bots
+        log.info('Skipping response from our OCR bot')
+
+    elif author_name in cfg.blacklist:
+        log.info(f'Skipping inbox item from {author_name!r} who is on the blacklist')
+
+    elif isinstance(item, Comment) and is_our_subreddit(item.subreddit.name, cfg):
+        process_reply(item, cfg)
+    elif isinstance(item, Comment):
+        log.info(f'Received username mention! ID {item}')
+        process_mention(item)
+
+    elif isinstance(item, Message):
+        if item.subject[0] == '!':
+            process_command(item, cfg)
+        else:
+            process_message(item, cfg)
+
+    else:
+        # We don't know what the heck this is, so just send it onto
+        # slack for manual triage.
+        forward_to_slack(item, cfg)
+
+
+class MarkReadBatch(object):
+    """
+    Collects handled inbox items from any number of worker threads and marks
+    them as read in batches of `MARK_READ_BATCH_SIZE`.
+    """
+
+    def __init__(self, cfg: Config) -> None:
+        self.cfg = cfg
+        self._items: List[InboxableMixin] = []
+        self._lock = threading.Lock()
+
+    def add(self, item: InboxableMixin) -> None:
+        with self._lock:
+            self._items.append(item)
+            if len(self._items) < MARK_READ_BATCH_SIZE:
+                return
+            items, self._items = self._items, []
+        self._mark_read(items)
+
+    def flush(self) -> None:
+        with self._lock:
+            items, self._items = self._items, []
+        self._mark_read(items)
+
+    def _mark_read(self, items: List[InboxableMixin]) -> None:
+        if not items:
+            return
+        self.cfg.r.inbox.mark_read(items)
+        self.cfg.redis.srem(INBOX_CHECKPOINT_KEY, *[item.fullname for item in items])
+
+
+def _shard_key(item: InboxableMixin) -> str:
+    """
+    Items that share a key are handled one after another, in the order they
+    arrived. Comments are keyed by the submission they belong to so that
+    claim / done / unclaim on a post keep their meaning; DMs are keyed by
+    their author.
+    """
+    if isinstance(item, Comment):
+        # Inbox comments have no `link_id`, but PRAW works the submission
+        # out from their `context` without asking Reddit
+        return item.submission.fullname
+    if isinstance(item, Message) and item.author:
+        return f'u/{str(item.author.name).casefold()}'
+    return item.fullname
+
+
+def _process_shard(items: List[InboxableMixin], cfg: Config, batch: MarkReadBatch) -> None:
+    for item in items:
+        # If this raises, the rest of the shard is left unread so that the
+        # items are still handled in order on the next pass.
+        process_inbox_item(item, cfg)
+
+        pipe = cfg.redis.pipeline()
+        pipe.sadd(INBOX_CHECKPOINT_KEY, item.fullname)
+        pipe.expire(INBOX_CHECKPOINT_KEY, INBOX_CHECKPOINT_TTL)
+        pipe.execute()
+
+        # No matter what, we want to mark this as read so we don't
+        # re-process it.
+        batch.add(item)
+
+
 def check_inbox(cfg: Config) -> None:
     """
     Goes through all the unread messages in the inbox. It deliberately
     leaves mail which does not fit into either category so that it can
     be read manually at a later point.
 
+    Items are split up by the post they belong to (or the author, for DMs)
+    and each of those groups is worked through by its own thread, oldest
+    first. Handled items are marked as read in batches.
+
     :return: None.
     """
-    # Sort inbox, then act on it
-    # Invert the inbox so we're processing oldest first!
-    for item in reversed(list(cfg.r.inbox.unread(limit=None))):
-        # Very rarely we may actually get a message from Reddit itself.
-        # In this case, there will be no author attribute.
-        author_name = item.author.name if item.author else None
-
-        if author_name is None:
-            send_to_modchat(
-                f'We received a message without an author -- '
-                f'*{item.subject}*:\n{item.body}', cfg
-            )
-
-        elif author_name == 'transcribot':
-            # bot responses shouldn't trigger workflows in other bots
-            log.info('Skipping response from our OCR bot')
-
-        elif cfg.redis.sismember('blacklist', author_name):
-            log.info(f'Skipping inbox item from {author_name!r} who is on the blacklist')
-
-        elif isinstance(item, Comment) and is_our_subreddit(item.subreddit.name, cfg):
-            process_reply(item, cfg)
-        elif isinstance(item, Comment):
-            log.info(f'Received username mention! ID {item}')
-            process_mention(item)
-
-        elif isinstance(item, Message):
-            if item.subject[0] == '!':
-                process_command(item, cfg)
-            else:
-                process_message(item, cfg)
+    # Reddit only hands out the unread listing newest first (and caps it at
+    # 1000 items), so the listing has to be walked to the end before we can
+    # start on the oldest item. Invert it so we're processing oldest first!
+    unread = list(cfg.r.inbox.unread(limit=None))
+    unread.reverse()
+    INBOX_BACKLOG.set(len(unread))
+    if not unread:
+        return
+
+    already_handled = {
+        fullname.decode() for fullname in cfg.redis.smembers(INBOX_CHECKPOINT_KEY)
+    }
+    batch = MarkReadBatch(cfg)
 
+    shards: Dict[str, List[InboxableMixin]] = OrderedDict()
+    for item in unread:
+        if item.fullname in already_handled:
+            log.info(f'Skipping {item.fullname}; it was handled before it could be marked as read')
+            batch.add(item)
         else:
-            # We don't know what the heck this is, so just send it onto
-            # slack for manual triage.
-            forward_to_slack(item, cfg)
+            shards.setdefault(_shard_key(item), []).append(item)
 
-        # No matter what, we want to mark this as read so we don't re-process it.
-        item.mark_read()
+    try:
+        with ThreadPoolExecutor(max_workers=cfg.inbox_workers) as executor:
+            jobs = [executor.submit(in_object_scope(_process_shard), items, cfg, batch) for items in shards.values()]
+
+        # Every shard has had its chance to finish by now; surface the first
+        # failure (if any) the same way a single-threaded loop would have.
+        for job in jobs:
+            job.result()
+    finally:
+        batch.flush()
@@ -1,13 +1,39 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, Set
 
 from bugsnag.handlers import BugsnagHandler  # type: ignore
 
-from tor.core.config import Config
-from tor.core.helpers import clean_list, get_wiki_page
+from tor.core.config import Config, ConfigSnapshot
+from tor.core.helpers import clean_list
 
 # Use a logger local to this module
 log = logging.getLogger(__name__)
 
+# Every wiki page that makes up the bot's configuration. These are all fetched
+# up front so that nothing is applied to the config until we have all of them.
+WIKI_PAGES = [
+    'domains',
+    'subreddits',
+    'subreddits/upvote-filtered',
+    'subreddits/domain-filter-bypass',
+    'subreddits/no-link-header',
+    'format/audio',
+    'format/video',
+    'format/images',
+    'format/other',
+    'format/header',
+    'usefulgifs/no',
+]
+
+# Enough workers to request every page (plus the mod list) at the same time,
+# but still a hard ceiling so a growing list of pages can't hammer Reddit.
+MAX_INITIALIZE_WORKERS = 12
+
+WikiPages = Dict[str, str]
+
 
 def configure_logging(cfg: Config, log_name='transcribersofreddit.log') -> None:
     # will intercept anything error level or above
@@ -24,91 +50,188 @@ def configure_logging(cfg: Config, log_name='transcribersofreddit.log') -> None:
     log.info('*' * 50)
 
 
-def populate_header(cfg: Config) -> None:
-    cfg.header = get_wiki_page('format/header', cfg)
-
-
-def populate_formatting(cfg: Config) -> None:
+def parse_formatting(pages: WikiPages) -> Dict[str, str]:
     """
-    Grabs the contents of the three wiki pages that contain the
-    formatting examples and stores them in the cfg object.
+    Takes the contents of the wiki pages that contain the formatting
+    examples and the header of the bot post.
 
-    :return: None.
+    :return: Dict of `ConfigSnapshot` field to its text.
     """
-    cfg.audio_formatting = get_wiki_page('format/audio', cfg)
-    cfg.video_formatting = get_wiki_page('format/video', cfg)
-    cfg.image_formatting = get_wiki_page('format/images', cfg)
-    cfg.other_formatting = get_wiki_page('format/other', cfg)
+    return {
+        'audio_formatting': pages['format/audio'],
+        'video_formatting': pages['format/video'],
+        'image_formatting': pages['format/images'],
+        'other_formatting': pages['format/other'],
+        'header': pages['format/header'],
+    }
 
 
-def populate_domain_lists(cfg: Config) -> None:
+def parse_domain_lists(pages: WikiPages) -> Dict[str, FrozenSet[str]]:
     """
-    Loads the approved content domains into the config object from the
-    wiki page.
+    Reads the approved content domains from the wiki page.
 
-    :return: None.
+    :return: Dict of `ConfigSnapshot` field to the domains in it.
     """
+    domain_lists: Dict[str, Set[str]] = {
+        'video_domains': set(),
+        'audio_domains': set(),
+        'image_domains': set(),
+    }
 
-    domain_string = get_wiki_page('domains', cfg)
+    domain_string = pages['domains']
     domains = ''.join(domain_string.splitlines()).split('---')
 
     for domainset in domains:
-        domain_list = domainset[domainset.index('['):].strip('[]').split(', ')
-        current_domain_list = []
         if domainset.startswith('video'):
-            current_domain_list = cfg.video_domains
+            current_domain_list = domain_lists['video_domains']
         elif domainset.startswith('audio'):
-            current_domain_list = cfg.audio_domains
+            current_domain_list = domain_lists['audio_domains']
         elif domainset.startswith('images'):
-            current_domain_list = cfg.image_domains
+            current_domain_list = domain_lists['image_domains']
+        else:
+            continue
 
-        current_domain_list += domain_list
-        # [current_domain_list.append(x) for x in domain_list]
+        domain_list = domainset[domainset.index('['):].strip('[]').split(', ')
+        current_domain_list.update(clean_list(domain_list))
         log.debug(f'Domain list populated: {current_domain_list}')
 
+    return {field: frozenset(domain_list) for field, domain_list in domain_lists.items()}
 
-def populate_subreddit_lists(cfg: Config) -> None:
-    """
-    Gets the list of subreddits to monitor and loads it into memory.
 
-    :return: None.
+def parse_subreddit_lists(pages: WikiPages) -> Dict[str, Any]:
     """
+    Reads the subreddits to monitor and the ones with special rules.
 
-    cfg.subreddits_to_check = get_wiki_page('subreddits', cfg).splitlines()
-    cfg.subreddits_to_check = clean_list(cfg.subreddits_to_check)
-    log.debug(f'Created list of subreddits from wiki: {cfg.subreddits_to_check}')
+    :return: Dict of `ConfigSnapshot` field to its value.
+    """
+    subreddits_to_check = tuple(clean_list(pages['subreddits'].splitlines()))
+    log.debug(f'Created list of subreddits from wiki: {subreddits_to_check}')
 
-    for line in get_wiki_page('subreddits/upvote-filtered', cfg).splitlines():
+    upvote_filter_subs = {}
+    for line in pages['subreddits/upvote-filtered'].splitlines():
         if ',' in line:
             sub, threshold = line.split(',')
-            cfg.upvote_filter_subs[sub] = int(threshold)
+            upvote_filter_subs[sub.strip()] = int(threshold)
+    log.debug(f'Retrieved subreddits subject to the upvote filter: {upvote_filter_subs}')
 
-    log.debug(f'Retrieved subreddits subject to the upvote filter: {cfg.upvote_filter_subs}')
+    subreddits_domain_filter_bypass = frozenset(clean_list(
+        pages['subreddits/domain-filter-bypass'].splitlines()))
+    log.debug(f'Retrieved subreddits that bypass the domain filter: {subreddits_domain_filter_bypass}')
 
-    cfg.subreddits_domain_filter_bypass = clean_list(
-        get_wiki_page('subreddits/domain-filter-bypass', cfg).splitlines())
-    log.debug(f'Retrieved subreddits that bypass the domain filter: {cfg.subreddits_domain_filter_bypass}')
+    no_link_header_subs = frozenset(clean_list(
+        pages['subreddits/no-link-header'].splitlines()))
+    log.debug(f'Retrieved subreddits that get no link header: {no_link_header_subs}')
 
-    cfg.no_link_header_subs = clean_list(
-        get_wiki_page('subreddits/no-link-header', cfg).splitlines())
-    log.debug(f'Retrieved subreddits subject to the upvote filter: {cfg.no_link_header_subs}')
+    return {
+        'subreddits_to_check': subreddits_to_check,
+        'upvote_filter_subs': MappingProxyType(upvote_filter_subs),
+        'subreddits_domain_filter_bypass': subreddits_domain_filter_bypass,
+        'no_link_header_subs': no_link_header_subs,
+    }
 
 
-def populate_gifs(cfg: Config) -> None:
-    cfg.no_gifs = get_wiki_page('usefulgifs/no', cfg).splitlines()
+def build_snapshot(pages: WikiPages, tor_mods: FrozenSet[str]) -> ConfigSnapshot:
+    """
+    Build a whole configuration out of the wiki pages and the mod list. It
+    only depends on its arguments, so building it twice from the same pages
+    gives the same snapshot.
+
+    :param pages: the contents of every page in `WIKI_PAGES`.
+    :param tor_mods: the case-folded names of the mods.
+    :return: the new snapshot.
+    """
+    fields: Dict[str, Any] = {
+        'tor_mods': tor_mods,
+        'no_gifs': tuple(clean_list(pages['usefulgifs/no'].splitlines())),
+    }
+    fields.update(parse_domain_lists(pages))
+    fields.update(parse_subreddit_lists(pages))
+    fields.update(parse_formatting(pages))
+    return ConfigSnapshot(**fields)
 
 
-def initialize(cfg: Config) -> None:
-    populate_domain_lists(cfg)
-    log.debug('Domains loaded.')
-    populate_subreddit_lists(cfg)
-    log.debug('Subreddits loaded.')
-    populate_formatting(cfg)
-    log.debug('Formatting loaded.')
-    populate_header(cfg)
-    log.debug('Header loaded.')
+def fetch_moderators(cfg: Config) -> FrozenSet[str]:
+    """
+    :return: the case-folded names of everyone who moderates ToR.
+    """
     # this call returns a full list rather than a generator. Praw is weird.
-    cfg.tor_mods = cfg.tor.moderator()
-    log.debug('Mod list loaded.')
-    populate_gifs(cfg)
-    log.debug('Gifs loaded.')
+    return frozenset(str(mod).casefold() for mod in cfg.tor.moderator())
+
+
+def refresh_moderators(cfg: Config) -> None:
+    """
+    Fetch the mod list again and swap it in whole, so mod changes don't need
+    a restart or `!reload`. Runs as a scheduled task every
+    `cfg.mod_refresh_interval` seconds by default.
+
+    :param cfg: the global config object.
+    :return: None.
+    """
+    tor_mods = fetch_moderators(cfg)
+    if tor_mods != cfg.tor_mods:
+        log.info(f'Mod list changed: {len(cfg.tor_mods)} -> {len(tor_mods)} mods')
+    cfg.update_snapshot(tor_mods=tor_mods)
+
+
+def initialize(cfg: Config, revalidate=True) -> None:
+    """
+    Loads the bot configuration from the wiki and the mod list from Reddit.
+
+    :param cfg: the global config object.
+    :param revalidate: if False, trust whatever is already in the wiki cache
+        (e.g. from the snapshot on disk) and only download missing pages.
+    :return: None.
+    """
+    wiki = cfg.wiki_cache
+
+    # Every page (and the mod list) is its own round trip to Reddit, so grab
+    # them all side by side instead of one after another. If any of them
+    # fails, `.result()` re-raises here before anything has been applied.
+    with ThreadPoolExecutor(max_workers=MAX_INITIALIZE_WORKERS) as executor:
+        mods_job = executor.submit(fetch_moderators, cfg)
+        if revalidate:
+            stale = wiki.stale_pages(WIKI_PAGES, cfg.tor)
+        else:
+            stale = [pagename for pagename in WIKI_PAGES if pagename not in wiki]
+        page_jobs = [executor.submit(wiki.fetch, pagename, cfg.tor) for pagename in stale]
+
+    for job in page_jobs:
+        job.result()
+    tor_mods = mods_job.result()
+    log.debug(f'Mod list retrieved; downloaded {len(stale)} of {len(WIKI_PAGES)} wiki pages.')
+
+    if stale:
+        wiki.save_snapshot(cfg.tor)
+
+    pages: WikiPages = {pagename: wiki.content(pagename) for pagename in WIKI_PAGES}
+
+    # Nothing gets applied until everything above has come back successfully,
+    # and then all of it is swapped in at once
+    cfg.publish_snapshot(build_snapshot(pages, tor_mods))
+    log.debug('Configuration loaded.')
+
+
+def initialize_from_snapshot(cfg: Config) -> bool:
+    """
+    Warm start: if there is a wiki snapshot on disk, load the configuration
+    from it right away and then revalidate against Reddit in the background.
+
+    :param cfg: the global config object.
+    :return: True if the snapshot was used, False if a regular
+        `initialize()` is still needed.
+    """
+    if not cfg.wiki_cache.load_snapshot(cfg.tor):
+        return False
+
+    initialize(cfg, revalidate=False)
+    log.info('Initialized from wiki snapshot, revalidating in the background.')
+
+    def revalidate() -> None:
+        try:
+            initialize(cfg)
+            log.info('Wiki snapshot revalidated.')
+        except Exception as e:
+            log.error(f'{e} - Unable to revalidate wiki snapshot; running with the last known config.')
+
+    threading.Thread(target=revalidate, name='wiki-revalidate', daemon=True).start()
+    return True
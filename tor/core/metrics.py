@@ -0,0 +1,316 @@
+"""
+Counters, gauges and latency histograms for the busy parts of the bot,
+served on a local HTTP endpoint in the Prometheus text format:
+
+    curl http://127.0.0.1:9110/metrics
+
+Every metric is defined at the bottom of this module so there's one place to
+look for what's measured. Reddit, Redis and Slack calls are timed where they
+leave the bot (the requestor, the Redis client and the modchat dispatcher),
+so nothing else has to remember to do it.
+"""
+import logging
+import math
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from prawcore.requestor import Requestor  # type: ignore
+from redis import StrictRedis
+from redis.client import StrictPipeline
+
+log = logging.getLogger(__name__)
+
+# Seconds; wide enough for a Redis command at one end and a full scan of
+# every subreddit at the other
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric(object):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional['Registry'] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} needs the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+        ] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    Usage:
+    requests = Counter('requests_total', 'Requests handled', ['method'])
+    requests.inc(method='GET')
+    """
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def totals(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in values
+        ]
+
+
+class Gauge(Counter):
+    """
+    A value that can go up and down, like the size of a backlog.
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Usage:
+    latency = Histogram('request_seconds', 'Time taken by requests', ['method'])
+    with latency.time(method='GET'):
+        ...
+    """
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label set: the count in each bucket (not cumulative), the sum
+        # and the count of everything observed
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+        return values[2] if values else 0
+
+    def totals(self) -> Dict[LabelValues, Tuple[int, float]]:
+        """
+        :return: (count, sum) of what was observed, for every label set.
+        """
+        with self._lock:
+            return {key: (count, total) for key, (_counts, total, count) in self._values.items()}
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(upper),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry(object):
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> None:
+        if any(existing.name == metric.name for existing in self.metrics):
+            raise ValueError(f'There is already a metric called {metric.name}')
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # Being scraped every few seconds isn't news
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(host: str, port: int) -> Optional[HTTPServer]:
+    """
+    Serve `/metrics` from a background thread. Metrics are nice to have, so
+    if the port can't be used (say, a second bot on the same machine) the
+    bot carries on without them.
+
+    :param host: the address to listen on; keep it local unless something
+        else is in front of it.
+    :param port: the port to listen on.
+    :return: the server, mostly so tests can shut it down, or None if it
+        couldn't be started.
+    """
+    try:
+        server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        log.error(f'{e} - unable to serve metrics on {host}:{port}; carrying on without them')
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info(f'Serving metrics on http://{host}:{server.server_port}/metrics')
+    return server
+
+
+class TimedRequestor(Requestor):
+    """
+    Times every HTTP request PRAW makes. Use with
+    `Reddit(..., requestor_class=TimedRequestor)`.
+    """
+
+    def request(self, method, *args, **kwargs):
+        started = time.monotonic()
+        status = 'error'
+        try:
+            response = super().request(method, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            REDDIT_REQUESTS.observe(time.monotonic() - started, method=method.upper(), status=status)
+
+
+class TimedPipeline(StrictPipeline):
+    def execute(self, *args, **kwargs):
+        with REDIS_COMMANDS.time(command='PIPELINE'):
+            return super().execute(*args, **kwargs)
+
+
+class TimedRedis(StrictRedis):
+    """
+    A Redis client that times every command it sends.
+    """
+
+    def execute_command(self, *args, **options):
+        with REDIS_COMMANDS.time(command=str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+TASK_DURATION = Histogram(
+    'tor_task_duration_seconds', 'Time taken by each run of a scheduled task', ['task'])
+TASK_RUNS = Counter(
+    'tor_task_runs_total', 'Runs of each scheduled task, by how they ended', ['task', 'outcome'])
+TASKS_OVERRUNNING = Gauge(
+    'tor_tasks_overrunning', 'Runs that timed out but are still going, each holding one of its task\'s slots', ['task'])
+SUBREDDIT_FETCH_DURATION = Histogram(
+    'tor_subreddit_fetch_seconds', 'Time taken to fetch the newest posts of a subreddit', ['subreddit'])
+SUBREDDIT_FETCH_ERRORS = Counter(
+    'tor_subreddit_fetch_errors_total', 'Failed fetches of the newest posts of a subreddit', ['subreddit'])
+POSTS = Counter(
+    'tor_posts_total', 'Posts seen by the subreddit scan, by what happened to them', ['outcome'])
+INBOX_BACKLOG = Gauge(
+    'tor_inbox_backlog', 'Unread inbox items found by the last inbox check')
+REPLY_INTENTS = Counter(
+    'tor_reply_intents_total', 'Replies handled, by what they were asking for', ['intent'])
+REDDIT_REQUESTS = Histogram(
+    'tor_reddit_request_seconds', 'Time taken by requests to Reddit', ['method', 'status'])
+REDIS_COMMANDS = Histogram(
+    'tor_redis_command_seconds', 'Time taken by Redis commands', ['command'])
+SLACK_CALLS = Histogram(
+    'tor_slack_call_seconds', 'Time taken by calls to the Slack API', ['method', 'outcome'])
+RATE_LIMIT_SLEEPS = Counter(
+    'tor_rate_limit_sleeps_total', 'Times we backed off because of a rate limit', ['source'])
+RATE_LIMIT_SLEEP_SECONDS = Counter(
+    'tor_rate_limit_sleep_seconds_total', 'Time spent backing off because of a rate limit', ['source'])
+
+
+def record_rate_limit(source: str, seconds: float) -> None:
+    RATE_LIMIT_SLEEPS.inc(source=source)
+    RATE_LIMIT_SLEEP_SECONDS.inc(seconds, source=source)
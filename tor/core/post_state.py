@@ -0,0 +1,292 @@
+"""
+The authoritative state of every post we make on ToR, kept in Redis.
+
+Each post has a hash at `::post::{fullname}` holding its state (unclaimed,
+in progress or completed), who claimed it, the fullname of the original post
+and when each of those things happened. Every change goes through a Lua
+script, so checking the current state and moving to the next one is a single
+atomic step; two people claiming the same post at the same moment can't both
+win.
+
+The flair on Reddit only mirrors this record. Posts made before the record
+existed are bootstrapped from their flair the first time they're touched.
+"""
+import logging
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from praw.models import Submission  # type: ignore
+from redis import StrictRedis
+
+from tor import __BOT_NAMES__
+from tor.core.config import Config
+from tor.core.helpers import flair
+
+log = logging.getLogger(__name__)
+
+# Posts are long gone from the queue by then; every change resets the clock.
+POST_STATE_TTL = 60 * 60 * 24 * 30
+
+
+class state(object):
+    unclaimed = 'unclaimed'
+    in_progress = 'in_progress'
+    completed = 'completed'
+
+
+# The flair that mirrors each state on Reddit
+STATE_FLAIR = {
+    state.unclaimed: flair.unclaimed,
+    state.in_progress: flair.in_progress,
+    state.completed: flair.completed,
+}
+
+_INIT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return {0, redis.call('HGETALL', KEYS[1])}
+end
+redis.call('HMSET', KEYS[1],
+    'state', ARGV[1], 'origin', ARGV[2], 'claimant', ARGV[3],
+    'created_at', ARGV[4], 'updated_at', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return {1, redis.call('HGETALL', KEYS[1])}
+"""
+
+# ARGV: expected state, new state, timestamp, TTL, then field / value pairs to
+# set alongside the new state. An empty value removes the field instead.
+_TRANSITION_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'state')
+if not current then
+    return {-1, {}}
+end
+if current ~= ARGV[1] then
+    return {0, redis.call('HGETALL', KEYS[1])}
+end
+redis.call('HMSET', KEYS[1], 'state', ARGV[2], 'updated_at', ARGV[3])
+for i = 5, #ARGV, 2 do
+    if ARGV[i + 1] == '' then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    else
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {1, redis.call('HGETALL', KEYS[1])}
+"""
+
+
+def _flatten(fields: Dict[bytes, bytes]) -> List[bytes]:
+    return [item for pair in fields.items() for item in pair]
+
+
+def _init_locally(conn: StrictRedis, keys: List[str], args: List[Any]) -> List[Any]:
+    """
+    `_INIT_SCRIPT` as separate commands, for a Redis that can't run scripts
+    (a dry run, or the tests). Unlike the script this isn't atomic by itself,
+    so it's never used on a real Redis.
+    """
+    key = keys[0]
+    current = conn.hgetall(key)
+    if current:
+        return [0, _flatten(current)]
+    initial_state, origin, claimant, now, ttl = args
+    conn.hmset(key, {
+        'state': initial_state, 'origin': origin, 'claimant': claimant, 'created_at': now, 'updated_at': now,
+    })
+    conn.expire(key, ttl)
+    return [1, _flatten(conn.hgetall(key))]
+
+
+def _transition_locally(conn: StrictRedis, keys: List[str], args: List[Any]) -> List[Any]:
+    """
+    `_TRANSITION_SCRIPT` as separate commands, like `_init_locally`.
+    """
+    key = keys[0]
+    expected, new, now, ttl = args[:4]
+    fields = args[4:]
+    current = conn.hget(key, 'state')
+    if current is None:
+        return [-1, []]
+    if current.decode() != expected:
+        return [0, _flatten(conn.hgetall(key))]
+    conn.hmset(key, {'state': new, 'updated_at': now})
+    for name, value in zip(fields[::2], fields[1::2]):
+        if value == '':
+            conn.hdel(key, name)
+        else:
+            conn.hset(key, name, value)
+    conn.expire(key, ttl)
+    return [1, _flatten(conn.hgetall(key))]
+
+
+# What each script does, step by step, keyed by the script
+LOCAL_SCRIPTS = {
+    _INIT_SCRIPT: _init_locally,
+    _TRANSITION_SCRIPT: _transition_locally,
+}
+
+
+class PostState(NamedTuple):
+    state: str
+    claimant: str = ''
+    origin: str = ''
+    created_at: Optional[float] = None
+    claimed_at: Optional[float] = None
+    completed_at: Optional[float] = None
+
+
+class Transition(NamedTuple):
+    """
+    The outcome of a state change. `post` is the record after the change, or
+    the untouched record if the post wasn't in the expected state.
+    """
+    result: int
+    post: Optional[PostState]
+
+    @property
+    def ok(self) -> bool:
+        return self.result == 1
+
+    @property
+    def missing(self) -> bool:
+        return self.result == -1
+
+
+def state_from_flair(flair_text: Optional[str]) -> Optional[str]:
+    """
+    Work out the state of a post that we have no record of from its flair.
+
+    :param flair_text: the current flair text of the post, if any.
+    :return: the matching state, or None if the flair doesn't describe one
+        (like Meta posts).
+    """
+    # this can be either '' or None depending on how the API is feeling today
+    if not flair_text or flair.unclaimed in flair_text:
+        return state.unclaimed
+    if flair_text == flair.in_progress:
+        return state.in_progress
+    if flair_text == flair.completed:
+        return state.completed
+    return None
+
+
+def _parse(raw_fields: List[bytes]) -> Optional[PostState]:
+    if not raw_fields:
+        return None
+
+    fields: Dict[str, str] = dict(zip(
+        (key.decode() for key in raw_fields[::2]),
+        (value.decode() for value in raw_fields[1::2]),
+    ))
+
+    def timestamp(name: str) -> Optional[float]:
+        return float(fields[name]) if fields.get(name) else None
+
+    return PostState(
+        state=fields.get('state', state.unclaimed),
+        claimant=fields.get('claimant', ''),
+        origin=fields.get('origin', ''),
+        created_at=timestamp('created_at'),
+        claimed_at=timestamp('claimed_at'),
+        completed_at=timestamp('completed_at'),
+    )
+
+
+class PostStateStore(object):
+    """
+    Usage:
+    posts = PostStateStore(config.redis)
+    posts.init('t3_abc123', state.unclaimed, origin='t3_xyz789')
+    if posts.claim('t3_abc123', 'pam').ok:
+        ...
+    """
+
+    def __init__(self, redis_conn: StrictRedis, ttl=POST_STATE_TTL) -> None:
+        if not redis_conn:
+            raise ValueError('Missing Redis connection')
+
+        self.redis = redis_conn
+        self.ttl = ttl
+        # In a dry run (see tor.core.dry_run) the scripts can't be sent, so
+        # it's told how to run them step by step instead
+        add_script = getattr(redis_conn, 'add_script', None)
+        if add_script is not None:
+            for source, func in LOCAL_SCRIPTS.items():
+                add_script(source, func)
+        self._init = redis_conn.register_script(_INIT_SCRIPT)
+        self._transition = redis_conn.register_script(_TRANSITION_SCRIPT)
+
+    @staticmethod
+    def key(fullname: str) -> str:
+        return f'::post::{fullname}'
+
+    def get(self, fullname: str) -> Optional[PostState]:
+        raw = self.redis.hgetall(self.key(fullname))
+        return _parse([item for pair in raw.items() for item in pair])
+
+    def init(self, fullname: str, initial_state: str, origin='', claimant='') -> Optional[PostState]:
+        """
+        Create the record for a post unless it already has one.
+
+        :return: the record as it is now, whether or not it was created.
+        """
+        args = [initial_state, origin, claimant, time.time(), self.ttl]
+        _created, raw_fields = self._init(keys=[self.key(fullname)], args=args)
+        return _parse(raw_fields)
+
+    def claim(self, fullname: str, claimant: str) -> Transition:
+        now = time.time()
+        return self._change(
+            fullname, state.unclaimed, state.in_progress, now,
+            'claimant', claimant, 'claimed_at', now,
+        )
+
+    def unclaim(self, fullname: str) -> Transition:
+        return self._change(
+            fullname, state.in_progress, state.unclaimed, time.time(),
+            'claimant', '', 'claimed_at', '',
+        )
+
+    def complete(self, fullname: str) -> Transition:
+        now = time.time()
+        return self._change(fullname, state.in_progress, state.completed, now, 'completed_at', now)
+
+    def reopen(self, fullname: str) -> Transition:
+        """
+        Undo `complete`, for when the volunteer couldn't be credited, so
+        their `done` can be tried again.
+        """
+        return self._change(fullname, state.completed, state.in_progress, time.time(), 'completed_at', '')
+
+    def _change(self, fullname: str, expected: str, new: str, now: float, *fields) -> Transition:
+        result, raw_fields = self._transition(
+            keys=[self.key(fullname)],
+            args=[expected, new, now, self.ttl, *fields],
+        )
+        return Transition(int(result), _parse(raw_fields))
+
+
+def load_post_state(submission: Submission, cfg: Config) -> Optional[PostState]:
+    """
+    Look up the state of one of our posts, creating the record from its flair
+    if we've never seen it before.
+
+    :param submission: the post on ToR.
+    :param cfg: the global config object.
+    :return: the state of the post, or None if it isn't one of our posts or
+        it isn't a transcription request at all.
+    """
+    current = cfg.post_states.get(submission.fullname)
+    if current:
+        return current
+
+    # WAIT! Do we actually own this post?
+    if submission.author.name not in __BOT_NAMES__:
+        return None
+
+    initial_state = state_from_flair(submission.link_flair_text)
+    if not initial_state:
+        return None
+
+    log.info(f'Bootstrapping state of {submission.fullname} from its flair: {initial_state}')
+    return cfg.post_states.init(submission.fullname, initial_state)
@@ -1,11 +1,16 @@
 import logging
+import time
 from typing import Dict, Union
 
 from praw.models import Submission  # type: ignore
 
 from tor.core.config import Config
 from tor.core.helpers import _
-from tor.helpers.flair import flair, flair_post
+from tor.core.metrics import POSTS
+from tor.core.post_state import state
+from tor.core.trace import stage
+from tor.helpers.flair import flair, project_flair
+from tor.helpers.ocr_queue import OCRJobQueue
 from tor.helpers.reddit_ids import add_complete_post_id, has_been_posted
 from tor.helpers.youtube import (has_youtube_transcript, get_yt_video_id,
                                  is_transcribable_youtube_video, is_youtube_url)
@@ -14,7 +19,11 @@ from tor.strings import translation
 i18n = translation()
 log = logging.getLogger(__name__)
 
-PostSummary = Dict[str, Union[str, int, bool, None]]
+PostSummary = Dict[str, Union[str, int, float, bool, None]]
+
+# How long an OCR payload sticks around in 'list' mode if the OCR bot never
+# picks it up.
+OCR_PAYLOAD_TTL = 60 * 60 * 24 * 7
 
 
 def process_post(new_post: PostSummary, cfg: Config) -> None:
@@ -27,8 +36,11 @@ def process_post(new_post: PostSummary, cfg: Config) -> None:
     :return: None.
     """
     if not should_process_post(new_post, cfg):
+        POSTS.inc(outcome='skipped')
         return
 
+    discovered_at = time.time()
+
     log.info(f'Posting call for transcription on ID {new_post["name"]} posted by {new_post["author"]}')
 
     if new_post['domain'] in cfg.image_domains:
@@ -51,9 +63,19 @@ def process_post(new_post: PostSummary, cfg: Config) -> None:
         if not is_transcribable_youtube_video(str(new_post['url'])):
             # Not transcribable, so let's add it to the completed posts and skip over it forever
             add_complete_post_id(str(new_post['url']), cfg)
+            POSTS.inc(outcome='skipped')
             return
 
+    # Only traced once we know it's going to be posted, so skipped posts
+    # don't show up as stuck between being found and being posted
+    trace_fields = {'subreddit': str(new_post['subreddit'])}
+    if new_post.get('created_utc'):
+        # When it was posted on its own subreddit, which we only learn now
+        trace_fields[stage.created] = str(new_post['created_utc'])
+    cfg.traces.record(str(new_post['name']), stage.discovered, at=discovered_at, **trace_fields)
+
     request_transcription(new_post, content_type, content_format, cfg)
+    POSTS.inc(outcome='posted')
 
 
 def has_enough_upvotes(post: PostSummary, cfg: Config) -> bool:
@@ -146,7 +168,9 @@ def request_transcription(post: PostSummary, content_type: str, content_format:
     try:
         submission: Submission = cfg.tor.submit(title=title, url=url)
         submission.reply(_(intro))
-        flair_post(submission, flair.unclaimed)
+        cfg.post_states.init(submission.fullname, state.unclaimed, origin=str(post['name']))
+        cfg.traces.record(str(post['name']), stage.posted, tor_post=submission.fullname)
+        project_flair(submission, flair.unclaimed, cfg)
         add_complete_post_id(str(post['name']), cfg)
 
         cfg.redis.incr('total_posted', amount=1)
@@ -169,8 +193,13 @@ def queue_ocr_bot(post: PostSummary, submission: Submission, cfg: Config) -> Non
         # We only OCR images at this time
         return
 
-    # Set the payload for the job
-    cfg.redis.set(str(post['name']), submission.fullname)
+    if cfg.ocr_dispatch_mode == 'stream':
+        # One entry holds the whole payload, so there is nothing to clean up
+        OCRJobQueue(cfg.redis).publish(str(post['name']), submission.fullname)
+        return
 
-    # Queue up the job reference
-    cfg.redis.rpush('ocr_ids', str(post['name']))
+    # Set the payload for the job and queue up the job reference in one go
+    pipe = cfg.redis.pipeline()
+    pipe.set(str(post['name']), submission.fullname, ex=OCR_PAYLOAD_TTL)
+    pipe.rpush('ocr_ids', str(post['name']))
+    pipe.execute()
@@ -0,0 +1,254 @@
+"""
+Profiles the next few runs of the bot's scheduled tasks while it keeps
+running, so a slow production loop can be looked at without a debugger.
+
+Switch it on with `PROFILE_RUNS=N`, `tor-moderator --profile N`, or by
+sending the bot a `!profile` message whose body is `N [task ...]`.
+
+By default a sampler looks at every thread's stack a couple of hundred times
+a second and writes the result as folded stacks (`.folded`, the input format
+of flamegraph.pl and speedscope). Setting `PROFILE_MODE=cprofile`, or running
+on a Python without `sys._current_frames`, uses cProfile and writes a
+`.pstats` file instead. Either way a short list of the busiest functions is
+logged and sent back to whoever asked for it.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from types import FrameType
+from typing import Any, Callable, Dict, FrozenSet, List, Optional
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# How many functions go in the summary
+SUMMARY_SIZE = 10
+
+# Stacks that end in one of these are threads waiting for work, not doing it
+IDLE_FRAMES = frozenset({
+    ('threading', 'wait'),
+    ('threading', '_wait_for_tstate_lock'),
+    ('queue', 'get'),
+    ('selectors', 'select'),
+    ('socketserver', 'serve_forever'),
+})
+
+
+class mode(object):
+    sample = 'sample'
+    cprofile = 'cprofile'
+
+
+def _frame_name(frame) -> str:
+    module = frame.f_globals.get('__name__', '?')
+    return f'{module}:{frame.f_code.co_name}'.replace(';', ':')
+
+
+def _thread_group(name: str) -> str:
+    # 'task_3' and 'ThreadPoolExecutor-0_12' are the same job as their siblings
+    return re.sub(r'[-_]\d+(_\d+)?$', '', name)
+
+
+class _Sampler(object):
+    def __init__(self, interval: float, labels: Dict[int, str]) -> None:
+        self.interval = interval
+        self.labels = labels
+        self.stacks: 'Counter[str]' = Counter()
+        self.leaves: 'Counter[str]' = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if (frame.f_globals.get('__name__'), frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+
+            stack: List[str] = []
+            current: Optional[FrameType] = frame
+            while current is not None:
+                stack.append(_frame_name(current))
+                current = current.f_back
+            root = self.labels.get(ident) or _thread_group(names.get(ident, 'unknown'))
+            self.stacks[';'.join([root] + stack[::-1])] += 1
+            self.leaves[stack[0]] += 1
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as folded:
+            for stack, count in sorted(self.stacks.items()):
+                folded.write(f'{stack} {count}\n')
+
+    def summary(self) -> List[str]:
+        total = sum(self.leaves.values()) or 1
+        return [
+            f'{name}: {count} samples ({count / total:.0%})'
+            for name, count in self.leaves.most_common(SUMMARY_SIZE)
+        ]
+
+
+class Profiler(object):
+    """
+    Wraps the runs of scheduled tasks while a profile is being taken.
+
+    Usage:
+    profiler = Profiler('profiles')
+    profiler.start(5, reply=message)
+    func = profiler.wrap('inbox', check_inbox)  # counts as one of the 5
+    """
+
+    def __init__(self, out_dir: str, profile_mode: str = mode.sample,
+                 sample_interval: float = DEFAULT_SAMPLE_INTERVAL) -> None:
+        self.out_dir = out_dir
+        self.mode = profile_mode
+        if self.mode == mode.sample and not hasattr(sys, '_current_frames'):
+            log.warning('This Python has no sys._current_frames; profiling with cProfile instead')
+            self.mode = mode.cprofile
+        self.sample_interval = sample_interval
+
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._started = 0
+        self._finished = 0
+        self._tasks: Optional[FrozenSet[str]] = None
+        self._reply: Any = None
+        self._began = 0.0
+        # What each thread is running, so samples can be grouped by task
+        self._labels: Dict[int, str] = {}
+        self._sampler: Optional[_Sampler] = None
+        self._stats: Optional[pstats.Stats] = None
+
+    @property
+    def active(self) -> bool:
+        return self._runs > 0
+
+    def start(self, runs: int, tasks: Optional[List[str]] = None, reply: Any = None) -> bool:
+        """
+        Profile the next `runs` runs.
+
+        :param runs: how many runs to profile.
+        :param tasks: only count runs of these tasks; all of them if empty.
+        :param reply: something with a `.reply()` to send the summary to,
+            like the message that asked for the profile.
+        :return: False if a profile is already being taken.
+        """
+        if runs < 1:
+            raise ValueError('Need at least one run to profile')
+        with self._lock:
+            if self.active:
+                return False
+            self._runs, self._started, self._finished = runs, 0, 0
+            self._tasks = frozenset(tasks) if tasks else None
+            self._reply = reply
+            self._stats = None
+            self._sampler = None
+        log.info(f'Profiling the next {runs} runs of {", ".join(tasks) if tasks else "every task"} ({self.mode})')
+        return True
+
+    def wrap(self, task_name: str, func: Callable) -> Callable:
+        """
+        :return: `func`, profiled if this run is one of the ones we're after.
+        """
+        with self._lock:
+            if not self.active or self._started >= self._runs:
+                return func
+            if self._tasks is not None and task_name not in self._tasks:
+                return func
+            self._started += 1
+            if self._started == 1:
+                self._began = time.monotonic()
+                if self.mode == mode.sample:
+                    self._sampler = _Sampler(self.sample_interval, self._labels)
+                    self._sampler.start()
+
+        def profiled(*args, **kwargs):
+            ident = threading.get_ident()
+            self._labels[ident] = task_name
+            try:
+                if self.mode == mode.cprofile:
+                    profile = cProfile.Profile()
+                    try:
+                        return profile.runcall(func, *args, **kwargs)
+                    finally:
+                        self._add_stats(profile)
+                return func(*args, **kwargs)
+            finally:
+                self._labels.pop(ident, None)
+                self._run_finished()
+
+        return profiled
+
+    def _add_stats(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def _run_finished(self) -> None:
+        with self._lock:
+            self._finished += 1
+            if self._finished < self._runs:
+                return
+            sampler, stats, reply, runs = self._sampler, self._stats, self._reply, self._runs
+            self._runs = 0
+        self._report(runs, sampler, stats, reply)
+
+    def _report(self, runs: int, sampler: Optional[_Sampler], stats: Optional[pstats.Stats], reply: Any) -> None:
+        elapsed = time.monotonic() - self._began
+        os.makedirs(self.out_dir, exist_ok=True)
+        base = os.path.join(self.out_dir, f'profile-{datetime.now():%Y%m%d-%H%M%S}')
+
+        if sampler is not None:
+            sampler.stop()
+            path = f'{base}.folded'
+            sampler.write(path)
+            lines = sampler.summary()
+            detail = f'{sampler.samples} samples'
+        else:
+            path = f'{base}.pstats'
+            lines = []
+            if stats is not None:
+                stats.dump_stats(path)
+                # key: (file, line, function); value: (calls, ..., own time, total time, callers)
+                busiest = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)  # type: ignore
+                lines = [
+                    f'{function} ({os.path.basename(filename)}:{line}): {own_time:.3f}s own, {total_time:.3f}s total'
+                    for (filename, line, function), (_cc, _calls, own_time, total_time, _callers)
+                    in busiest[:SUMMARY_SIZE]
+                ]
+            detail = 'cProfile'
+
+        summary = (
+            f'Profiled {runs} runs in {elapsed:.1f}s ({detail}), saved to `{path}`.\n\n'
+            + ''.join(f'{i}. {line}\n' for i, line in enumerate(lines, start=1))
+        )
+        log.info(summary)
+        if reply is not None:
+            try:
+                reply.reply(summary)
+            except Exception as e:
+                log.error(f'{e} - Unable to send the profile summary')
@@ -0,0 +1,266 @@
+"""
+Runs each stage of the bot (the inbox, the subreddit scan, flair upkeep and so
+on) as its own periodic task, so a slow stage only holds up itself.
+
+Every task has an interval, jitter, timeout and concurrency limit. The
+defaults are set in code and can be changed without a release through a JSON
+file (`SCHEDULE_PATH`, default `schedule.json`) like:
+
+    {"inbox": {"interval": 5}, "meta_flair": {"interval": 900, "jitter": 60}}
+
+The stages themselves are plain blocking functions that take the config
+object; they run on a thread pool while asyncio keeps the time.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from praw.exceptions import APIException  # type: ignore
+from prawcore.exceptions import RequestException, ServerError, Forbidden  # type: ignore
+
+import tor.core
+from tor.core.config import Config
+from tor.core.helpers import rate_limit_delay
+from tor.core.metrics import TASK_DURATION, TASK_RUNS, TASKS_OVERRUNNING, record_rate_limit
+from tor.core.profiling import Profiler
+
+log = logging.getLogger(__name__)
+
+# How long a task waits after trouble talking to Reddit
+REDDIT_ERROR_DELAY = 60
+
+# A task that crashes is restarted after 1, 2, 4... seconds, up to this
+MAX_RESTART_DELAY = 300
+
+SCHEDULE_FIELDS = ('interval', 'jitter', 'timeout', 'concurrency')
+
+
+class Task(NamedTuple):
+    name: str
+    func: Callable[[Config], Any]
+    # Seconds between the end of one run and the start of the next
+    interval: float
+    # Up to this many seconds are added to every wait, so tasks drift apart
+    jitter: float = 0
+    # Seconds before we stop waiting for a run; None to wait forever. A run
+    # can't be stopped from outside, so one that times out keeps going, and
+    # keeps its concurrency slot, until it ends on its own
+    timeout: Optional[float] = None
+    # How many runs of this task can be going on at once
+    concurrency: int = 1
+
+
+def load_schedule(tasks: List[Task], path: str) -> List[Task]:
+    """
+    Apply the overrides from a schedule file to the default tasks.
+
+    :param tasks: the tasks with their default settings.
+    :param path: the JSON file to read; it's fine if it doesn't exist.
+    :return: the tasks with the overrides applied.
+    :raises ValueError: if the file names a task or setting that doesn't
+        exist, so a typo doesn't silently leave the default in place.
+    """
+    if not os.path.exists(path):
+        return tasks
+
+    with open(path) as schedule_file:
+        overrides: Dict[str, Dict] = json.load(schedule_file)
+
+    names = {task.name for task in tasks}
+    unknown = sorted(set(overrides) - names)
+    if unknown:
+        raise ValueError(f'{path} has settings for unknown tasks: {", ".join(unknown)}')
+
+    scheduled = []
+    for task in tasks:
+        settings = overrides.get(task.name, {})
+        bad_fields = sorted(set(settings) - set(SCHEDULE_FIELDS))
+        if bad_fields:
+            raise ValueError(f'{path} has unknown settings for {task.name}: {", ".join(bad_fields)}')
+        task = task._replace(**settings)
+        if task.concurrency < 1:
+            raise ValueError(f'{path}: concurrency for {task.name} has to be at least 1')
+        scheduled.append(task)
+
+    log.info(f'Loaded the schedule from {path}')
+    return scheduled
+
+
+class Scheduler(object):
+    """
+    Runs a list of tasks until `stop()` is called. A task that crashes is
+    restarted on its own, after a growing delay, without touching the rest.
+
+    Usage:
+    scheduler = Scheduler(config, [Task('inbox', check_inbox, interval=10)])
+    scheduler.run()  # blocks until scheduler.stop()
+    """
+
+    def __init__(self, cfg: Config, tasks: List[Task], profiler: Optional[Profiler] = None) -> None:
+        self.cfg = cfg
+        self.tasks = tasks
+        self.profiler = profiler
+        self.failures: Dict[str, int] = {task.name: 0 for task in tasks}
+        # Runs of each task that timed out but haven't ended yet
+        self.overrunning: Dict[str, int] = {task.name: 0 for task in tasks}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._executor = ThreadPoolExecutor(
+            # One thread per run that can be going on at once, so a run that
+            # has timed out but is still going can't starve the others
+            max_workers=max(1, sum(task.concurrency for task in tasks)),
+            thread_name_prefix='task',
+        )
+
+    def run(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._supervise())
+        finally:
+            # Let anything still running finish before we go
+            self._executor.shutdown(wait=True)
+            loop.close()
+
+    def stop(self) -> None:
+        """
+        Stop starting new runs. Safe to call from any thread or from a
+        signal handler.
+        """
+        if self._loop is not None and self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    @property
+    def stopping(self) -> bool:
+        return not tor.core.is_running or (self._stopping is not None and self._stopping.is_set())
+
+    async def _supervise(self) -> None:
+        self._stopping = asyncio.Event()
+        # Every worker, with its task and the slots it shares with the
+        # other workers of that task
+        workers: Dict[asyncio.Future, Tuple[Task, asyncio.Semaphore]] = {}
+        for task in self.tasks:
+            limit = asyncio.Semaphore(task.concurrency)
+            for _ in range(task.concurrency):
+                workers[asyncio.ensure_future(self._worker(task, limit))] = (task, limit)
+
+        stop_waiter = asyncio.ensure_future(self._stopping.wait())
+        while not self.stopping:
+            done, _pending = await asyncio.wait(
+                set(workers) | {stop_waiter}, return_when=asyncio.FIRST_COMPLETED
+            )
+            for worker in done - {stop_waiter}:
+                task, limit = workers.pop(worker)
+                if worker.cancelled() or worker.exception() is None:
+                    # Cancelled, or it saw we're stopping and returned
+                    continue
+                self.failures[task.name] += 1
+                delay = min(2 ** (self.failures[task.name] - 1), MAX_RESTART_DELAY)
+                exc = worker.exception()
+                log.error(
+                    f'Task {task.name} crashed: {exc!r}. Restarting it in {delay}s.',
+                    exc_info=exc,
+                )
+                workers[asyncio.ensure_future(self._worker(task, limit, delay))] = (task, limit)
+
+        stop_waiter.cancel()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.wait(set(workers) | {stop_waiter})
+
+    async def _worker(self, task: Task, limit: asyncio.Semaphore, delay: float = 0) -> None:
+        # Spread out the first runs so every task doesn't hit Reddit at once
+        await self._sleep(delay + random.uniform(0, task.jitter))
+        while not self.stopping:
+            await limit.acquire()
+            if self.stopping:
+                limit.release()
+                return
+            wait = await self._run_once(task, limit)
+            await self._sleep(wait + random.uniform(0, task.jitter))
+
+    async def _run_once(self, task: Task, limit: asyncio.Semaphore) -> float:
+        """
+        Run the task once on the thread pool.
+
+        :return: how long to wait before the next run.
+        """
+        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        func = self.profiler.wrap(task.name, task.func) if self.profiler else task.func
+        run = loop.run_in_executor(self._executor, func, self.cfg)
+        # The slot is only given back once the run really ends, even if we
+        # stopped waiting for it
+        run.add_done_callback(lambda _: limit.release())
+
+        # Runs are timed until they really end, not until we stop waiting
+        run.add_done_callback(lambda _: TASK_DURATION.observe(time.monotonic() - started, task=task.name))
+
+        outcome = 'error'
+        try:
+            await asyncio.wait_for(asyncio.shield(run), task.timeout)
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            self._overrun(task, run)
+            return task.interval
+        except APIException as e:
+            if e.error_type != 'RATELIMIT':
+                raise
+            outcome = 'ratelimited'
+            delay = rate_limit_delay(e)
+            record_rate_limit('reddit', delay)
+            log.warning(f'Ratelimit - task {task.name} is sleeping for {delay}s as requested by Reddit.')
+            return max(delay, task.interval)
+        except (RequestException, ServerError, Forbidden) as e:
+            outcome = 'reddit_error'
+            log.warning(f'{e} - Task {task.name} had trouble communicating with Reddit. Sleeping for {REDDIT_ERROR_DELAY}s!')
+            return max(REDDIT_ERROR_DELAY, task.interval)
+        else:
+            outcome = 'ok'
+        finally:
+            TASK_RUNS.inc(task=task.name, outcome=outcome)
+
+        self.failures[task.name] = 0
+        log.debug(f'Task {task.name} finished in {time.monotonic() - started:.2f}s')
+        return task.interval
+
+    def _overrun(self, task: Task, run: asyncio.Future) -> None:
+        """
+        Keep count of a run we've stopped waiting for until it really ends,
+        since it holds on to one of the task's slots until then.
+        """
+        def ended(_run: asyncio.Future) -> None:
+            self.overrunning[task.name] -= 1
+            TASKS_OVERRUNNING.set(self.overrunning[task.name], task=task.name)
+            log.info(f'Task {task.name} finished {time.monotonic() - started:.2f}s after timing out')
+
+        started = time.monotonic()
+        self.overrunning[task.name] += 1
+        TASKS_OVERRUNNING.set(self.overrunning[task.name], task=task.name)
+        run.add_done_callback(ended)
+
+        held = f'{self.overrunning[task.name]} of {task.concurrency} slots'
+        if self.overrunning[task.name] >= task.concurrency:
+            log.error(
+                f'Task {task.name} is still running after {task.timeout}s and its runs that timed out '
+                f'hold {held}; no new run can start until one of them ends'
+            )
+        else:
+            log.warning(
+                f'Task {task.name} is still running after {task.timeout}s; not waiting for it, '
+                f'but it holds on to its slot until it ends ({held} held by runs that timed out)'
+            )
+
+    async def _sleep(self, seconds: float) -> None:
+        if seconds <= 0 or self._stopping is None:
+            return
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,164 @@
+"""
+When each partner subreddit post reached each stage of its life with us:
+posted on its subreddit, found by our scan, posted to ToR, claimed and
+completed. Every post gets one Redis hash, keyed by its original fullname, of
+stage -> unix time, and only the first time a stage is reached is kept. The
+hashes expire after `TRACE_TTL`.
+
+`tor-trace` (tor/cli/trace.py) turns them into latency percentiles per stage
+and per subreddit.
+"""
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from redis import StrictRedis
+from redis.exceptions import RedisError
+
+log = logging.getLogger(__name__)
+
+TRACE_KEY = '::trace::{}'
+TRACE_TTL = timedelta(days=14)
+
+
+class stage(object):
+    created = 'created'
+    discovered = 'discovered'
+    posted = 'posted'
+    claimed = 'claimed'
+    completed = 'completed'
+
+
+# In the order they happen
+STAGES = (stage.created, stage.discovered, stage.posted, stage.claimed, stage.completed)
+
+Trace = Dict[str, str]
+Step = Tuple[str, str]
+
+
+class LifecycleTrace(object):
+    """
+    Usage:
+    traces = LifecycleTrace(config.redis)
+    traces.record('t3_8swl2n', stage.posted)
+    traces.get('t3_8swl2n')  # {'posted': '1561234567.8', ...}
+    """
+
+    def __init__(self, redis_conn: StrictRedis, ttl: timedelta = TRACE_TTL) -> None:
+        if not redis_conn:
+            raise ValueError('Missing Redis connection')
+
+        self.redis = redis_conn
+        self.ttl = ttl
+
+    @staticmethod
+    def key(post_id: str) -> str:
+        return TRACE_KEY.format(post_id)
+
+    def record(self, post_id: str, stage_name: str, at: Optional[float] = None, **fields: str) -> None:
+        """
+        Note that a post reached a stage, unless it already had. Tracing is
+        only there to be looked at later, so a failure is logged rather than
+        raised.
+
+        :param post_id: the fullname of the post on its own subreddit.
+        :param stage_name: one of `STAGES`.
+        :param at: unix time it happened; now if left out.
+        :param fields: anything else to keep with the trace, like the
+            subreddit. These are only set the first time, too.
+        """
+        if not post_id:
+            return
+
+        key = self.key(post_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hsetnx(key, stage_name, repr(at if at is not None else time.time()))
+        for name, value in fields.items():
+            pipe.hsetnx(key, name, value)
+        pipe.expire(key, self.ttl)
+        try:
+            pipe.execute()
+        except RedisError as e:
+            log.warning(f'{e} - unable to trace {stage_name} for {post_id}')
+
+    def get(self, post_id: str) -> Trace:
+        return {
+            name.decode(): value.decode()
+            for name, value in self.redis.hgetall(self.key(post_id)).items()
+        }
+
+    def scan(self, batch_size=500) -> Iterator[Tuple[str, Trace]]:
+        """
+        :return: every (post ID, trace) we have, in no particular order.
+        """
+        prefix = TRACE_KEY.format('')
+        keys: List[bytes] = []
+        for key in self.redis.scan_iter(match=TRACE_KEY.format('*'), count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                yield from self._load(prefix, keys)
+                keys = []
+        yield from self._load(prefix, keys)
+
+    def _load(self, prefix: str, keys: List[bytes]) -> Iterator[Tuple[str, Trace]]:
+        if not keys:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        for key, trace in zip(keys, pipe.execute()):
+            if trace:
+                yield key.decode()[len(prefix):], {name.decode(): value.decode() for name, value in trace.items()}
+
+
+def steps(trace: Trace) -> Dict[Step, float]:
+    """
+    :return: seconds taken between each stage the post reached and the next
+        one it reached, plus `(created, <last stage>)` for the whole way.
+    """
+    reached = [(name, float(trace[name])) for name in STAGES if name in trace]
+    durations = {
+        (earlier, later): later_at - earlier_at
+        for (earlier, earlier_at), (later, later_at) in zip(reached, reached[1:])
+    }
+    if len(reached) > 2:
+        durations[(reached[0][0], reached[-1][0])] = reached[-1][1] - reached[0][1]
+    return durations
+
+
+def last_stage(trace: Trace) -> Optional[str]:
+    reached = [name for name in STAGES if name in trace]
+    return reached[-1] if reached else None
+
+
+def group_steps(traces: Iterator[Tuple[str, Trace]], by_subreddit=False,
+                since: Optional[float] = None) -> Dict[str, Dict[Step, List[float]]]:
+    """
+    :param traces: (post ID, trace) pairs, like from `LifecycleTrace.scan`.
+    :param by_subreddit: group by subreddit instead of putting everything in
+        one group called 'all'.
+    :param since: only look at posts discovered at or after this unix time.
+    :return: group -> step -> every duration seen for that step.
+    """
+    groups: Dict[str, Dict[Step, List[float]]] = defaultdict(lambda: defaultdict(list))
+    for _post_id, trace in traces:
+        if since is not None and float(trace.get(stage.discovered, 0)) < since:
+            continue
+        group = trace.get('subreddit', 'unknown') if by_subreddit else 'all'
+        for step, duration in steps(trace).items():
+            groups[group][step].append(duration)
+    return groups
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile.
+
+    :param values: anything but empty.
+    :param percent: 0 - 100.
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
@@ -1,16 +1,18 @@
 import logging
 import random
+from typing import Optional
 
 from praw.exceptions import APIException, ClientException  # type: ignore
-from praw.models import Comment, Message  # type: ignore
+from praw.models import Comment, Message, Submission  # type: ignore
 
-from tor import __BOT_NAMES__
 from tor.core.config import Config
-from tor.core.helpers import (_, clean_id, get_parent_post_id, get_wiki_page,
-                              reports, send_to_modchat)
+from tor.core.helpers import (_, clean_id, get_parent_post_id, get_submission,
+                              get_wiki_page, reports, send_to_modchat)
+from tor.core.post_state import PostState, load_post_state, state
+from tor.core.trace import stage as trace_stage
 from tor.core.users import User
 from tor.core.validation import verified_posted_transcript
-from tor.helpers.flair import flair, flair_post, update_user_flair
+from tor.helpers.flair import flair, project_flair, update_user_flair
 from tor.helpers.reddit_ids import is_removed
 from tor.strings import translation
 
@@ -20,14 +22,15 @@ log = logging.getLogger(__name__)
 
 def coc_accepted(post: Comment, cfg: Config) -> bool:
     """
-    Verifies that the user is in the Redis set "accepted_CoC".
+    Verifies that the user is in the Redis set "accepted_CoC", using the
+    local copy of it.
 
     :param post: the Comment object containing the claim.
     :param cfg: the global config dict.
     :return: True if the user has accepted the Code of Conduct, False if they
         haven't.
     """
-    return cfg.redis.sismember('accepted_CoC', post.author.name) == 1
+    return post.author.name in cfg.accepted_coc
 
 
 def process_coc(post: Comment, cfg: Config) -> None:
@@ -39,7 +42,7 @@ def process_coc(post: Comment, cfg: Config) -> None:
     :param cfg: the global config dict.
     :return: None.
     """
-    result = cfg.redis.sadd('accepted_CoC', post.author.name)
+    newly_accepted = cfg.accepted_coc.add(post.author.name)[0]
 
     modchat_emote = random.choice([
         ':tada:',
@@ -60,9 +63,9 @@ def process_coc(post: Comment, cfg: Config) -> None:
         ':fb-like:'
     ])
 
-    # Have they already been added? If 0, then just act like they said `claim`
+    # Have they already been added? If so, then just act like they said `claim`
     # instead. If they're actually new, then send a message to slack.
-    if result == 1:
+    if newly_accepted:
         send_to_modchat(
             f'<{i18n["urls"]["reddit_url"].format("/user/" + post.author.name)}|u/{post.author.name}>'
             f' has just'
@@ -91,42 +94,56 @@ def process_claim(post: Comment, cfg: Config, first_time=False) -> None:
 
     claim_success = i18n['responses']['claim']['first_claim_success' if first_time else 'success']
 
-    # WAIT! Do we actually own this post?
-    if top_parent.author.name not in __BOT_NAMES__:
-        log.debug('Received `claim` on post we do not own. Ignoring.')
+    if not coc_accepted(post, cfg):
+        if not load_post_state(top_parent, cfg):
+            log.debug('Received `claim` on post we do not own. Ignoring.')
+            return
+        # The wiki cache checks for a newer revision of this page before
+        # handing it over, so edits to the CoC show up right away.
+        post.reply(_(
+            please_accept_coc.format(get_wiki_page('codeofconduct', cfg))
+        ))
         return
 
-    try:
-        if not coc_accepted(post, cfg):
-            # do not cache this page. We want to get it every time.
-            post.reply(_(
-                please_accept_coc.format(get_wiki_page('codeofconduct', cfg))
-            ))
+    # Only posts we made have a record, so as long as there is one, this is
+    # the only call it takes to claim the post.
+    claimed = cfg.post_states.claim(top_parent.fullname, post.author.name)
+    if claimed.missing:
+        if not load_post_state(top_parent, cfg):
+            log.debug('Received `claim` on post we do not own. Ignoring.')
             return
+        claimed = cfg.post_states.claim(top_parent.fullname, post.author.name)
+
+    # Claiming a post you already have is fine; if the reply didn't make it
+    # last time (say we were rate limited), this is the second try.
+    is_claimant = claimed.ok or (
+        claimed.post is not None
+        and claimed.post.state == state.in_progress
+        and claimed.post.claimant == post.author.name
+    )
 
-        # this can be either '' or None depending on how the API is feeling
-        # today
-        if not top_parent.link_flair_text:
-            # There exists the very small possibility that the post was
-            # malformed and doesn't actually have flair on it. In that case,
-            # let's set something so the next part doesn't crash.
-            flair_post(top_parent, flair.unclaimed)
+    try:
+        if is_claimant:
+            # The post is theirs whether or not the reply goes through, so
+            # the flair follows the record first
+            project_flair(top_parent, flair.in_progress, cfg)
+            cfg.traces.record(claimed.post.origin, trace_stage.claimed)
 
-        if flair.unclaimed in top_parent.link_flair_text:
             # need to get that "Summoned - Unclaimed" in there too
             post.reply(_(claim_success))
-
-            flair_post(top_parent, flair.in_progress)
             log.info(f'Claim on ID {top_parent.fullname} by {post.author} successful')
 
         # can't claim something that's already claimed
-        elif top_parent.link_flair_text == flair.in_progress:
+        elif claimed.post.state == state.in_progress:
             post.reply(_(already_claimed))
-        elif top_parent.link_flair_text == flair.completed:
+        elif claimed.post.state == state.completed:
             post.reply(_(claim_already_complete))
 
     except APIException as e:
         if e.error_type == 'DELETED_COMMENT':
+            if is_claimant:
+                cfg.post_states.unclaim(top_parent.fullname)
+                project_flair(top_parent, flair.unclaimed, cfg)
             log.info(f'Comment attempting to claim ID {top_parent.fullname} has been deleted. Back up for grabs!')
             return
         raise  # Re-raise exception if not
@@ -152,18 +169,17 @@ def process_done(post: Comment, cfg: Config, override=False, alt_text_trigger=Fa
     top_parent = get_parent_post_id(post, cfg.r)
 
     done_cannot_find_transcript = i18n['responses']['done']['cannot_find_transcript']
-    done_completed_transcript = i18n['responses']['done']['completed_transcript']
     done_still_unclaimed = i18n['responses']['done']['still_unclaimed']
 
-    # WAIT! Do we actually own this post?
-    if top_parent.author.name not in __BOT_NAMES__:
+    current = load_post_state(top_parent, cfg)
+    if not current:
         log.info('Received `done` on post we do not own. Ignoring.')
         return
 
     try:
-        if flair.unclaimed in top_parent.link_flair_text:
+        if current.state == state.unclaimed:
             post.reply(_(done_still_unclaimed))
-        elif top_parent.link_flair_text == flair.in_progress:
+        elif current.state == state.in_progress:
             if not override and not verified_posted_transcript(post, cfg):
                 # we need to double-check these things to keep people
                 # from gaming the system
@@ -189,34 +205,28 @@ def process_done(post: Comment, cfg: Config, override=False, alt_text_trigger=Fa
 
             if override:
                 log.info('Moderator override starting!')
-            # noinspection PyUnresolvedReferences
+
+            # Whoever gets here first completes the post; anyone racing them
+            # is left with nothing to do.
+            completed = cfg.post_states.complete(top_parent.fullname)
+            if not completed.ok:
+                log.info(f'Post {top_parent.fullname} was already completed. Ignoring `done` by {post.author}.')
+                return
+
             try:
-                if alt_text_trigger:
-                    post.reply(_(
-                        'I think you meant `done`, so here we go!\n\n'
-                        f'{done_completed_transcript}'
-                    ))
-                else:
-                    post.reply(_(done_completed_transcript))
-                update_user_flair(post, cfg)
-                current_post_count = int(cfg.redis.get("total_completed").decode())
-                log.info(
-                    f'Post {top_parent.fullname} completed by {post.author} -'
-                    f' post number {str(current_post_count + 1)}!'
-                )
-                # get that information saved for the user
-                author = User(str(post.author), redis_conn=cfg.redis)
-                author.list_update('posts_completed', clean_id(post.fullname))
-                author.save()
-
-            except ClientException:
-                # If the butt deleted their comment and we're already this
-                # far into validation, just mark it as done. Clearly they
-                # already passed.
-                log.info(f'Attempted to mark post {top_parent.fullname} as done... hit ClientException.')
-            flair_post(top_parent, flair.completed)
-
-            cfg.redis.incr('total_completed', amount=1)
+                _credit_done(post, top_parent, completed.post, cfg)
+            except Exception:
+                # Better to have them say `done` again than to leave the post
+                # completed without them being credited for it
+                cfg.post_states.reopen(top_parent.fullname)
+                project_flair(top_parent, flair.in_progress, cfg)
+                raise
+
+            _reply_done(post, top_parent, cfg, alt_text_trigger)
+
+        elif _completed_by(current, post):
+            # Already counted, but the reply didn't make it last time
+            _reply_done(post, top_parent, cfg, alt_text_trigger)
 
     except APIException as e:
         if e.error_type == 'DELETED_COMMENT':
@@ -225,6 +235,48 @@ def process_done(post: Comment, cfg: Config, override=False, alt_text_trigger=Fa
         raise  # Re-raise exception if not
 
 
+def _completed_by(current: Optional[PostState], post: Comment) -> bool:
+    return current is not None and current.state == state.completed and current.claimant == post.author.name
+
+
+def _credit_done(post: Comment, top_parent: Submission, completed: PostState, cfg: Config) -> None:
+    """
+    Everything that comes with completing a post, apart from the reply and
+    the post's flair: the volunteer's count and flair, and their list of
+    posts.
+    """
+    update_user_flair(post, cfg)
+    # get that information saved for the user
+    author = User(str(post.author), redis_conn=cfg.redis)
+    author.list_update('posts_completed', clean_id(post.fullname))
+    author.save()
+
+    post_count = cfg.redis.incr('total_completed', amount=1)
+    log.info(f'Post {top_parent.fullname} completed by {post.author} - post number {post_count}!')
+    cfg.traces.record(completed.origin, trace_stage.completed)
+
+
+def _reply_done(post: Comment, top_parent: Submission, cfg: Config, alt_text_trigger: bool) -> None:
+    done_completed_transcript = i18n['responses']['done']['completed_transcript']
+
+    # Before the reply, so the flair is right even if the reply fails
+    project_flair(top_parent, flair.completed, cfg)
+    # noinspection PyUnresolvedReferences
+    try:
+        if alt_text_trigger:
+            post.reply(_(
+                'I think you meant `done`, so here we go!\n\n'
+                f'{done_completed_transcript}'
+            ))
+        else:
+            post.reply(_(done_completed_transcript))
+    except ClientException:
+        # If the butt deleted their comment and we're already this
+        # far into validation, just mark it as done. Clearly they
+        # already passed.
+        log.info(f'Attempted to mark post {top_parent.fullname} as done... hit ClientException.')
+
+
 def process_unclaim(post: Comment, cfg: Config) -> None:
     # Sometimes people need to unclaim things. Usually this happens because of
     # an issue with the post itself, like it's been locked or deleted. Either
@@ -238,7 +290,7 @@ def process_unclaim(post: Comment, cfg: Config) -> None:
     #   If the linked post has been taken down or deleted, then remove the post
     #    on ToR's side and reply to the user.
 
-    top_parent = post.submission
+    top_parent = get_parent_post_id(post, cfg.r)
 
     unclaim_failure_post_already_completed = i18n['responses']['unclaim']['post_already_completed']
     unclaim_still_unclaimed = i18n['responses']['unclaim']['still_unclaimed']
@@ -246,12 +298,12 @@ def process_unclaim(post: Comment, cfg: Config) -> None:
     unclaim_success_with_report = i18n['responses']['unclaim']['success_with_report']
     unclaim_success_without_report = i18n['responses']['unclaim']['success_without_report']
 
-    # WAIT! Do we actually own this post?
-    if top_parent.author.name not in __BOT_NAMES__:
+    current = load_post_state(top_parent, cfg)
+    if not current:
         log.info('Received `unclaim` on post we do not own. Ignoring.')
         return
 
-    if flair.unclaimed in top_parent.link_flair_text:
+    if current.state == state.unclaimed:
         post.reply(_(unclaim_still_unclaimed))
         return
 
@@ -274,9 +326,7 @@ def process_unclaim(post: Comment, cfg: Config) -> None:
 
     # Okay, so they commented with unclaim, but they didn't report it.
     # Time to check to see if they should have.
-    linked_resource = cfg.r.submission(
-        top_parent.id_from_url(top_parent.url)
-    )
+    linked_resource = get_submission(cfg.r, top_parent.id_from_url(top_parent.url))
     if is_removed(linked_resource):
         top_parent.mod.remove()
         send_to_modchat(
@@ -291,14 +341,14 @@ def process_unclaim(post: Comment, cfg: Config) -> None:
 
     # Finally, if none of the other options apply, we'll reset the flair and
     # continue on as normal.
-    if top_parent.link_flair_text == flair.completed:
-        post.reply(_(unclaim_failure_post_already_completed))
-        return
-
-    if top_parent.link_flair_text == flair.in_progress:
-        flair_post(top_parent, flair.unclaimed)
+    unclaimed = cfg.post_states.unclaim(top_parent.fullname)
+    if unclaimed.ok:
+        project_flair(top_parent, flair.unclaimed, cfg)
         post.reply(_(unclaim_success))
-        return
+    elif unclaimed.post and unclaimed.post.state == state.completed:
+        post.reply(_(unclaim_failure_post_already_completed))
+    else:
+        post.reply(_(unclaim_still_unclaimed))
 
 
 def process_thanks(post: Comment, cfg: Config) -> None:
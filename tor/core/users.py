@@ -1,21 +1,96 @@
 """
-This is a standalone addition which contains a non-thread-safe implementation
-of a dict user object that is stored in Redis. It can either take in an active
-Redis connection as an argument or create its own with some defaults.
+Volunteers' records, stored in Redis. A `User` is loaded once, read like a
+dict with `get`, and only the fields that were changed are written back.
+
+Each user is a hash at `::user::{name}` with one JSON-encoded value per field,
+so single fields can be changed (and counters bumped with HINCRBY) without
+touching the rest of the record. Lists like `posts_completed` only ever grow,
+so each one lives in its own Redis list at `::user::{name}::{field}` and is
+appended to instead of being rewritten.
+
+Users saved by older versions are a single JSON blob at `::user::{name}`;
+they are converted the first time they're loaded, or all at once with
+`migrate_all_users`.
 """
 import json
 import logging
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 from redis import StrictRedis
+from redis.exceptions import ResponseError, WatchError
 
 UserData = Dict[str, Any]
 
+log = logging.getLogger(__name__)
+
+USER_KEY = '::user::{}'
+
+# Fields that are kept as separate Redis lists instead of inside the hash
+LIST_FIELDS = ('posts_completed',)
+
 
 class UserDataNotFound(Exception):
     pass
 
 
+def _list_key(username: str, field: str) -> str:
+    return f'{USER_KEY.format(username)}::{field}'
+
+
+def _migrate_user(redis_conn: StrictRedis, key: str, username: str) -> bool:
+    """
+    Convert a user saved as a single JSON blob into the hash layout. Safe to
+    run while other bots are using the same user; if the blob changes under
+    us, we start over.
+
+    :return: True if the user was converted, False if there was nothing to do.
+    """
+    while True:
+        with redis_conn.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.type(key) != b'string':
+                    return False
+                blob = json.loads(pipe.get(key).decode())
+
+                pipe.multi()
+                pipe.delete(key)
+                fields = {}
+                for field, value in blob.items():
+                    if field in LIST_FIELDS and isinstance(value, list):
+                        if value:
+                            pipe.rpush(_list_key(username, field), *value)
+                    else:
+                        fields[field] = json.dumps(value)
+                if fields:
+                    pipe.hmset(key, fields)
+                pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+
+def migrate_all_users(redis_conn: StrictRedis) -> int:
+    """
+    Convert every user still saved as a JSON blob into the hash layout.
+
+    :param redis_conn: Object; a `StrictRedis` instance.
+    :return: the number of users that were converted.
+    """
+    migrated = 0
+    for raw_key in redis_conn.scan_iter(match=USER_KEY.format('*'), count=500):
+        key = raw_key.decode()
+        username = key[len(USER_KEY.format('')):]
+        if '::' in username:
+            # One of the list keys that hang off a user
+            continue
+        if _migrate_user(redis_conn, key, username):
+            migrated += 1
+
+    log.info(f'Migrated {migrated} users to the hash layout')
+    return migrated
+
+
 class User(object):
     """
     Usage:
@@ -24,7 +99,10 @@ class User(object):
     pam = User('pam', redis_conn=config.redis)
     pam.update('age', 39)
     pam.update('position', 'Office Administrator')
+    pam.list_update('posts_completed', 'abc123')
     pam.save()
+
+    pam.increment('transcriptions')  # written right away
     """
 
     def __init__(self, username: str, redis_conn: StrictRedis, create_if_not_found=True):
@@ -46,20 +124,42 @@ class User(object):
         self.username = username
 
         self.create_if_not_found = create_if_not_found
-        self.redis_key = '::user::{}'
+        self.redis_key = USER_KEY
+
+        # Changes that haven't been saved yet
+        self._changed: Dict[str, Any] = {}
+        self._appended: Dict[str, List[Any]] = {}
+
         self.user_data = self._load()
 
     def __repr__(self) -> str:
         return repr(self.user_data)
 
+    @property
+    def key(self) -> str:
+        return self.redis_key.format(self.username)
+
+    @staticmethod
+    def redis_key_for(username: str) -> str:
+        return USER_KEY.format(username)
+
     def get(self, key: str, default_return=None) -> Any:
+        if key in LIST_FIELDS:
+            values = self.redis.lrange(_list_key(self.username, key), 0, -1)
+            values = [value.decode() for value in values] + self._appended.get(key, [])
+            return values or default_return
         return self.user_data.get(key, default_return)
 
     def _load(self) -> UserData:
         """
         :return: Dict or None; the loaded information from Redis.
         """
-        result = self.redis.get(self.redis_key.format(self.username))
+        try:
+            result = self.redis.hgetall(self.key)
+        except ResponseError:
+            # WRONGTYPE; still saved the old way
+            _migrate_user(self.redis, self.key, self.username)
+            result = self.redis.hgetall(self.key)
         if not result:
             if self.create_if_not_found:
                 logging.debug(
@@ -70,23 +170,65 @@ class User(object):
                 logging.debug('User not found, returning None.')
                 raise UserDataNotFound()
 
-        return json.loads(result.decode())
+        return {
+            field.decode(): json.loads(value.decode())
+            for field, value in result.items()
+        }
 
     def save(self) -> None:
-        self.redis.set(
-            self.redis_key.format(self.username),
-            json.dumps(self.user_data)
-        )
+        """
+        Write only the fields that were changed and the list items that were
+        added since the user was loaded.
+        """
+        if not self._changed and not self._appended:
+            return
+
+        pipe = self.redis.pipeline()
+        if self._changed:
+            pipe.hmset(self.key, {
+                field: json.dumps(value) for field, value in self._changed.items()
+            })
+        for field, values in self._appended.items():
+            pipe.rpush(_list_key(self.username, field), *values)
+        pipe.execute()
+
+        self._changed = {}
+        self._appended = {}
 
     def update(self, key: str, value: Any) -> None:
         self.user_data[key] = value
+        self._changed[key] = value
+
+    def increment(self, key: str, amount=1) -> int:
+        """
+        Atomically add to a numeric field, straight away and without needing
+        `save`, so concurrent updates can't overwrite each other.
+
+        :return: the new value.
+        """
+        try:
+            value = self.redis.hincrby(self.key, key, amount)
+        except ResponseError:
+            # WRONGTYPE; saved the old way again since we loaded it
+            _migrate_user(self.redis, self.key, self.username)
+            value = self.redis.hincrby(self.key, key, amount)
+        self.user_data[key] = value
+        self._changed.pop(key, None)
+        if 'username' in self._changed:
+            # Brand new user; make sure the rest of the record exists too
+            self.save()
+        return value
 
     def list_update(self, key: str, value: Any) -> None:
+        if key in LIST_FIELDS:
+            self._appended.setdefault(key, []).append(value)
+            return
+
         if not self.user_data.get(key):
             self.user_data[key] = []
-        self.user_data[key] += [value]
+        self.update(key, self.user_data[key] + [value])
 
     def _create_default_user_data(self) -> UserData:
         self.user_data = {}
-        self.user_data.update({'username': self.username})
+        self.update('username', self.username)
         return self.user_data
@@ -1,11 +1,27 @@
-from praw.models import Comment, Submission  # type: ignore
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional
+
+from praw.const import API_PATH  # type: ignore
+from praw.models import Comment, MoreComments, Submission  # type: ignore
 from prawcore.exceptions import Forbidden  # type: ignore
 
 from tor.core.config import Config
-from tor.core.helpers import get_parent_post_id, send_to_modchat
+from tor.core.helpers import get_parent_post_id, get_submission, in_object_scope, send_to_modchat
 from tor.strings import translation
 
 i18n = translation()
+log = logging.getLogger(__name__)
+
+# Both ways of finding a transcript run side by side for every `done`
+_verification_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='verify')
+
+# How many of the claimant's latest comments are checked for the transcript
+CLAIMANT_HISTORY_LIMIT = 25
+
+# How many top-level comments are requested at a time
+TOP_LEVEL_PAGE_SIZE = 100
 
 
 def _author_check(original_post: Comment, claimant_post: Comment) -> bool:
@@ -53,45 +69,56 @@ def _thread_title_check(original_post: Comment, history_item: Comment) -> bool:
     )
 
 
-def _thread_author_check(original_post: Comment, history_item: Comment, cfg: Config) -> bool:
+def _linked_thread_match(linked_submission: Submission, history_item: Comment) -> bool:
     """
-    This allows us to check whether the author of the thread that the
-    transcription is posted in is the same as the author of the linked
-    thread in the event of a removed comment where they cannot be directly
-    linked.
+    Check that a comment from the user's history was left on the linked
+    post, in the event of a removed comment that can't be found in the
+    thread itself. Comments in a user's history carry the fullname of
+    their post, so this doesn't need to load anything.
 
-    :param original_post: Comment object; comment that says "done".
+    :param linked_submission: Submission object; the post that the ToR post
+        links to.
     :param history_item: Comment object; comment pulled from user's history.
-    :param cfg: the global config object.
-    :return: True if the author of the original submission matches the author
-        of the submission the transcription is on.
+    :return: True if the transcription is on the linked post.
     """
-    submission = cfg.r.submission(url=original_post.submission.url)
-    return history_item.submission.author == submission.author
+    return history_item.link_id == linked_submission.fullname
 
 
-def _author_history_check(post: Comment, cfg: Config) -> bool:
+def _author_history_check(post: Comment, cfg: Config, cancelled: Optional[threading.Event] = None,
+                          history: Optional[List[Comment]] = None) -> bool:
     """
-    Pull the ten latest comments from the user's history. Chances are that's
+    Pull the latest comments from the user's history. Chances are that's
     enough to see if they've actually done the post or not without slowing
-    everything down _too_ much. See if any of those ten items look right
+    everything down _too_ much. See if any of those items look right
     and complete the post if it's the transcript we're looking for.
 
-    Warning: this is not very fast, but it does the job. Definitely something
-    we're going to have to circle back to when we separate out the jobs.
-
     :param post: The Comment object that contains the string 'done'.
     :param cfg: the global config object.
+    :param cancelled: if set, give up as soon as possible.
+    :param history: the user's latest comments, if they've already been
+        fetched.
     :return: True if the post is found in the history, False if not.
     """
-    for history_post in post.author.comments.new(limit=10):
+    # Every history item is compared against the same linked post, so only
+    # fetch it once (and only if we get that far).
+    linked_submission: Optional[Submission] = None
+
+    if history is None:
+        history = list(post.author.comments.new(limit=CLAIMANT_HISTORY_LIMIT))
+
+    for history_post in history:
+        if cancelled and cancelled.is_set():
+            return False
         if not history_post.is_root:
             continue
         if not _footer_check(history_post, cfg):
             continue
         if not _thread_title_check(post, history_post):
             continue
-        if not _thread_author_check(post, history_post, cfg):
+        if linked_submission is None:
+            top_parent = get_parent_post_id(post, cfg.r)
+            linked_submission = get_submission(cfg.r, top_parent.id_from_url(top_parent.url))
+        if not _linked_thread_match(linked_submission, history_post):
             continue
 
         return True
@@ -99,6 +126,113 @@ def _author_history_check(post: Comment, cfg: Config) -> bool:
     return False
 
 
+def _top_level_comments(linked_resource: Submission, cfg: Config) -> Iterator[Comment]:
+    """
+    Yield the top-level comments of a post, newest first, one page at a
+    time. Replies are never requested, so this costs the same no matter how
+    big the discussion underneath gets.
+
+    :param linked_resource: the post to read.
+    :param cfg: the global config object.
+    """
+    _, listing = cfg.r.get(
+        API_PATH['submission'].format(id=linked_resource.id),
+        params={'depth': 1, 'sort': 'new', 'limit': TOP_LEVEL_PAGE_SIZE},
+    )
+    page = listing.children
+    while True:
+        unloaded: List[str] = []
+        for item in page:
+            # "Continue this thread" links and stubs for replies can still
+            # show up; only the ones hanging off the post itself matter.
+            if item.parent_id != linked_resource.fullname:
+                continue
+            if isinstance(item, MoreComments):
+                unloaded.extend(item.children)
+            else:
+                yield item
+
+        if not unloaded:
+            return
+        page = cfg.r.post(API_PATH['morechildren'], data={
+            'children': ','.join(unloaded[:TOP_LEVEL_PAGE_SIZE]),
+            'link_id': linked_resource.fullname,
+            'sort': 'new',
+            'depth': 1,
+            'limit_children': True,
+        })
+        leftover = unloaded[TOP_LEVEL_PAGE_SIZE:]
+        if leftover:
+            # Anything that didn't fit in this request goes in the next one
+            page = list(page) + [MoreComments(cfg.r, {
+                'parent_id': linked_resource.fullname,
+                'children': leftover,
+                'count': len(leftover),
+            })]
+
+
+def _linked_thread_check(post: Comment, linked_resource: Submission, cfg: Config,
+                         cancelled: threading.Event) -> Optional[bool]:
+    """
+    Look for a top-level comment by the claimant with the footer in it on the
+    linked post. Stops at the first one it finds.
+
+    :return: True if found, False if not, and None if we aren't allowed to
+        see the thread.
+    """
+    try:
+        for top_level_comment in _top_level_comments(linked_resource, cfg):
+            if cancelled.is_set():
+                return False
+            if not _author_check(post, top_level_comment):
+                continue
+            if not _footer_check(top_level_comment, cfg):
+                continue
+            return True
+    except Forbidden:
+        # we've attempted to load a subreddit that we don't have access to. The
+        # only way this can happen (reasonably) is when the sub goes private
+        # after we've already pulled the submission from it. In this case, we
+        # will rely on the author history check.
+        return None
+
+    return False
+
+
+def _transcripts_by_post(history: List[Comment], cfg: Config) -> Dict[str, List[Comment]]:
+    """
+    Index the top-level comments with a footer in a user's history by the
+    post they were left on.
+    """
+    index: Dict[str, List[Comment]] = {}
+    for comment in history:
+        if comment.is_root and _footer_check(comment, cfg):
+            index.setdefault(comment.link_id, []).append(comment)
+    return index
+
+
+def _report_removed_post(post: Comment, cfg: Config, thread_job: Future) -> None:
+    """
+    Called once the linked thread has been searched after the transcript was
+    already found in the claimant's history. If it isn't in the thread, it
+    was most likely caught by the spam filter.
+    """
+    if thread_job.cancelled():
+        return
+    if thread_job.exception():
+        log.warning(f'{thread_job.exception()} - unable to search thread for {post.fullname}')
+        return
+
+    # We only want to complain about it being removed if it was actually
+    # removed, not if the thread is hidden from us.
+    if thread_job.result() is False:
+        send_to_modchat(
+            f'Found removed post: <{post.submission.shortlink}>',
+            cfg,
+            channel='#removed_posts'
+        )
+
+
 def verified_posted_transcript(post: Comment, cfg: Config) -> bool:
     """
     Because we're using basic gamification, we need to put in at least
@@ -109,44 +243,56 @@ def verified_posted_transcript(post: Comment, cfg: Config) -> bool:
     it complete. Otherwise, we ask them to please contact the mods.
 
     Process:
-    Get source link, check all comments, look for a root level comment
-    by the author of the post and verify that the key is in their post.
-    Return True if found, False if not.
+    Check the author's latest comments for a root level comment on the linked
+    post with the key in it; if it's there, the thread is still searched in
+    the background so a removed transcript gets reported. If it isn't there,
+    search the top-level comments of the linked thread, and at the same time
+    look through their recent history in case the transcript was removed by
+    the spam filter. The first one to find it wins. Return True if found,
+    False if not.
 
     :param post: The Comment object that contains the string 'done'.
     :param cfg: the global config object.
     :return: True if a post is found, False if not.
     """
-    forbidden: bool = False
     top_parent: Submission = get_parent_post_id(post, cfg.r)
-    linked_resource: Submission = cfg.r.submission(top_parent.id_from_url(top_parent.url))
+    linked_resource: Submission = get_submission(cfg.r, top_parent.id_from_url(top_parent.url))
 
-    try:
-        # get rid of the "See More Comments" crap
-        linked_resource.comments.replace_more(limit=0)
-        for top_level_comment in linked_resource.comments.list():
-            if not _author_check(post, top_level_comment):
-                continue
-            if not _footer_check(top_level_comment, cfg):
-                continue
+    # The transcript is almost always one of the claimant's latest comments,
+    # so one request usually settles it without waiting for the thread.
+    history = list(post.author.comments.new(limit=CLAIMANT_HISTORY_LIMIT))
+    if linked_resource.fullname in _transcripts_by_post(history, cfg):
+        # Comments caught by the spam filter still show up in their history,
+        # so search the thread in the background to see if it was removed.
+        thread_job: Future = _verification_pool.submit(
+            in_object_scope(_linked_thread_check), post, linked_resource, cfg, threading.Event()
+        )
+        thread_job.add_done_callback(lambda done: _report_removed_post(post, cfg, done))
+        return True
+
+    cancelled = threading.Event()
+    thread_job = _verification_pool.submit(in_object_scope(_linked_thread_check), post, linked_resource, cfg, cancelled)
+    history_job: Future = _verification_pool.submit(in_object_scope(_author_history_check), post, cfg, cancelled, history)
+
+    # If one of the searches fails, the other one can still find it
+    errors: List[Exception] = []
+    for job in as_completed([thread_job, history_job]):
+        try:
+            found = job.result()
+        except Exception as e:
+            log.warning(f'{e} - transcript search failed for {post.fullname}')
+            errors.append(e)
+            continue
+        if not found:
+            continue
+        if job is history_job:
+            # Let the thread search finish on its own so we know whether
+            # the transcript was removed from it.
+            thread_job.add_done_callback(lambda done: _report_removed_post(post, cfg, done))
             return True
-    except Forbidden:
-        # we've attempted to load a subreddit that we don't have access to. The
-        # only way this can happen (reasonably) is when the sub goes private
-        # after we've already pulled the submission from it. In this case, we
-        # will default to the author history check.
-        forbidden = True
-
-    # Did their transcript get flagged by the spam filter? Check their history.
-    if _author_history_check(post, cfg):
-        # We only want to complain about it being removed if it was
-        # actually removed.
-        if not forbidden:
-            send_to_modchat(
-                f'Found removed post: <{post.submission.shortlink}>',
-                cfg,
-                channel='#removed_posts'
-            )
+        cancelled.set()
         return True
 
+    if len(errors) == 2:
+        raise errors[0]
     return False
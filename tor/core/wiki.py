@@ -0,0 +1,234 @@
+"""
+A local copy of the subreddit wiki, keyed by page name and the revision ID of
+the content we have on hand. Reddit is only asked for the (small) list of
+recent revisions; a page is only downloaded again when that list says it has
+changed since we last looked.
+
+The cache can be written to disk so that a restarted bot can start working
+with the last known configuration straight away and revalidate afterwards.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from praw.models import Subreddit  # type: ignore
+from prawcore.exceptions import Forbidden, NotFound  # type: ignore
+
+log = logging.getLogger(__name__)
+
+# Reddit's timestamps and ours won't ever line up exactly, so give ourselves
+# some wiggle room when deciding if a page was checked after a revision.
+CLOCK_SKEW_ALLOWANCE = 60
+
+# Size of the page of recent revisions requested when validating the cache.
+REVISION_LISTING_LIMIT = 100
+
+
+class CachedPage(object):
+    __slots__ = ('revision', 'content', 'checked')
+
+    def __init__(self, revision: Optional[str], content: str, checked: float) -> None:
+        self.revision = revision
+        self.content = content
+        # When we last confirmed this is the newest revision of the page
+        self.checked = checked
+
+
+class WikiCache(object):
+    """
+    Usage:
+    from tor.core.wiki import WikiCache
+
+    cache = WikiCache('wiki_snapshot.json')
+    cache.get('codeofconduct', config.tor)
+    """
+
+    def __init__(self, snapshot_path: str) -> None:
+        self.snapshot_path = snapshot_path
+        self._pages: Dict[str, CachedPage] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, pagename: str) -> bool:
+        return pagename.lower() in self._pages
+
+    def content(self, pagename: str) -> str:
+        """
+        Return what we have on hand for a page without going to Reddit.
+
+        :param pagename: String. The name of the page.
+        :return: String. The cached content, or an empty string if we have
+            never seen the page.
+        """
+        with self._lock:
+            page = self._pages.get(pagename.lower())
+        return page.content if page else ''
+
+    def get(self, pagename: str, subreddit: Subreddit, max_age=60) -> str:
+        """
+        Return the current contents of a wiki page, only downloading it if
+        the page has been revised since we last grabbed it.
+
+        :param pagename: String. The name of the page to be requested.
+        :param subreddit: the Subreddit object whose wiki we're reading.
+        :param max_age: Seconds for which a previously validated copy is
+            trusted without asking Reddit at all.
+        :return: String. The content of the requested page, or an empty string
+            if the page does not exist.
+        """
+        name = pagename.lower()
+        with self._lock:
+            cached = self._pages.get(name)
+
+        if cached and time.time() - cached.checked < max_age:
+            return cached.content
+
+        revision = self._latest_revision(name, subreddit)
+        if cached and revision is not None and revision == cached.revision:
+            self._mark_checked([name])
+            return cached.content
+
+        return self.fetch(name, subreddit, revision=revision)
+
+    def fetch(self, pagename: str, subreddit: Subreddit, revision: Optional[str] = None) -> str:
+        """
+        Download a wiki page and store it in the cache.
+
+        :param pagename: String. The name of the page to be requested.
+        :param subreddit: the Subreddit object whose wiki we're reading.
+        :param revision: the revision ID we expect to receive, if known.
+        :return: String. The content of the requested page.
+        """
+        name = pagename.lower()
+        log.debug(f'Downloading wiki page {name}')
+        try:
+            page = subreddit.wiki[name]
+            content = page.content_md
+            # Not every version of the API hands this back, so fall back to
+            # the revision ID we were told about.
+            revision = getattr(page, 'revision_id', None) or revision
+        except NotFound:
+            content = ''
+            revision = None
+
+        with self._lock:
+            self._pages[name] = CachedPage(revision, content, time.time())
+        return content
+
+    def stale_pages(self, pagenames: Iterable[str], subreddit: Subreddit) -> List[str]:
+        """
+        Figure out which of the requested pages need to be downloaded again,
+        using a single request for the recent revisions across the whole
+        wiki. Pages we have never seen are always considered stale.
+
+        :param pagenames: the names of the pages we care about.
+        :param subreddit: the Subreddit object whose wiki we're reading.
+        :return: List of page names that must be fetched.
+        """
+        names = [pagename.lower() for pagename in pagenames]
+        with self._lock:
+            cached = {name: self._pages[name] for name in names if name in self._pages}
+
+        if not cached:
+            # Nothing to compare against, so don't bother asking.
+            return names
+
+        latest: Dict[str, str] = {}
+        oldest_timestamp = 0.0
+        count = 0
+        try:
+            for revision in subreddit.wiki.revisions(limit=REVISION_LISTING_LIMIT):
+                count += 1
+                # Newest first, so the first one we see for a page is current
+                latest.setdefault(revision['page'].name.lower(), revision['id'])
+                oldest_timestamp = float(revision['timestamp'])
+        except (Forbidden, NotFound) as e:
+            log.warning(f'{e} - Unable to list wiki revisions; refreshing everything')
+            return names
+
+        # If the listing isn't full, it covers the whole history of the wiki.
+        complete_history = count < REVISION_LISTING_LIMIT
+
+        stale: List[str] = []
+        fresh: List[str] = []
+        for name in names:
+            if name not in cached:
+                stale.append(name)
+            elif name in latest:
+                (fresh if latest[name] == cached[name].revision else stale).append(name)
+            elif complete_history:
+                fresh.append(name)
+            elif cached[name].checked - CLOCK_SKEW_ALLOWANCE >= oldest_timestamp:
+                # Any edit since we last checked would be newer than the
+                # oldest revision in the listing, so it would have shown up.
+                fresh.append(name)
+            else:
+                stale.append(name)
+
+        self._mark_checked(fresh)
+        return stale
+
+    def load_snapshot(self, subreddit: Subreddit) -> bool:
+        """
+        Fill the cache from the snapshot on disk, if there is one for this
+        subreddit.
+
+        :param subreddit: the Subreddit object the snapshot must belong to.
+        :return: True if the snapshot was loaded, False otherwise.
+        """
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            log.info(f'No usable wiki snapshot at {self.snapshot_path}')
+            return False
+
+        if str(snapshot.get('subreddit', '')).casefold() != str(subreddit).casefold():
+            log.info(f'Wiki snapshot at {self.snapshot_path} is for another subreddit. Ignoring.')
+            return False
+
+        with self._lock:
+            for name, page in snapshot.get('pages', {}).items():
+                # Anything from disk must be revalidated before it is trusted
+                self._pages[name] = CachedPage(page.get('revision'), page.get('content', ''), 0.0)
+        log.info(f'Loaded {len(self._pages)} wiki pages from {self.snapshot_path}')
+        return True
+
+    def save_snapshot(self, subreddit: Subreddit) -> None:
+        """
+        Write everything in the cache to disk. The file is swapped into place
+        so a crash halfway through never leaves a truncated snapshot behind.
+
+        :param subreddit: the Subreddit object the cache belongs to.
+        :return: None.
+        """
+        with self._lock:
+            pages = {
+                name: {'revision': page.revision, 'content': page.content}
+                for name, page in self._pages.items()
+            }
+
+        temp_path = f'{self.snapshot_path}.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'subreddit': str(subreddit), 'pages': pages}, f)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            log.warning(f'{e} - Unable to write wiki snapshot to {self.snapshot_path}')
+
+    def _latest_revision(self, pagename: str, subreddit: Subreddit) -> Optional[str]:
+        try:
+            for revision in subreddit.wiki[pagename].revisions(limit=1):
+                return revision['id']
+        except (Forbidden, NotFound):
+            pass
+        return None
+
+    def _mark_checked(self, pagenames: Iterable[str]) -> None:
+        now = time.time()
+        with self._lock:
+            for name in pagenames:
+                if name in self._pages:
+                    self._pages[name].checked = now
@@ -0,0 +1,139 @@
+"""
+In-process copies of small Redis sets that are checked far more often than
+they change, like the blacklist and the list of people who have accepted the
+Code of Conduct. Membership checks never leave the process.
+
+Changes made through `add` / `remove` are published on a pub/sub channel so
+every running bot updates its copy right away, and the whole set is reloaded
+from Redis every so often in case an update was missed or the set was
+changed behind our back.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Dict, FrozenSet, List, Optional
+
+from redis import StrictRedis
+
+log = logging.getLogger(__name__)
+
+# How often the full set is reloaded from Redis, in seconds
+DEFAULT_RESYNC_INTERVAL = 5 * 60
+
+
+class CachedRedisSet(object):
+    """
+    Usage:
+    blacklist = CachedRedisSet(config.redis, 'blacklist')
+    if author_name in blacklist:
+        ...
+    blacklist.add('spez')
+    """
+
+    def __init__(self, redis_conn: StrictRedis, key: str, resync_interval=DEFAULT_RESYNC_INTERVAL) -> None:
+        if not redis_conn:
+            raise ValueError('Missing Redis connection')
+
+        self.redis = redis_conn
+        self.key = key
+        self.channel = f'set_updates::{key}'
+        self.resync_interval = resync_interval
+
+        self._members: FrozenSet[str] = frozenset()
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+        self._resync_lock = threading.Lock()
+        self._listener: Optional[threading.Thread] = None
+
+    def __contains__(self, member: object) -> bool:
+        if self._stale():
+            self._resync_once()
+        return member in self._members
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def _stale(self) -> bool:
+        return time.time() - self._synced_at > self.resync_interval
+
+    def _resync_once(self) -> None:
+        # Only one thread reloads the set. Everyone else carries on with the
+        # copy we have, unless there isn't one yet.
+        if not self._resync_lock.acquire(blocking=not self._synced_at):
+            return
+        try:
+            if self._stale():
+                self._load()
+        finally:
+            self._resync_lock.release()
+
+    def resync(self) -> None:
+        """
+        Reload the whole set from Redis and make sure we're listening for
+        updates.
+        """
+        with self._resync_lock:
+            self._load()
+
+    def _load(self) -> None:
+        self._listen()
+        members = frozenset(member.decode() for member in self.redis.smembers(self.key))
+        with self._lock:
+            self._members = members
+            self._synced_at = time.time()
+        log.debug(f'Loaded {len(members)} members of {self.key!r}')
+
+    def add(self, *members: str) -> List[bool]:
+        """
+        Add members to the set in Redis and announce the change.
+
+        :return: for each member, True if it was not already in the set.
+        """
+        return self._change('add', members)
+
+    def remove(self, *members: str) -> List[bool]:
+        """
+        Remove members from the set in Redis and announce the change.
+
+        :return: for each member, True if it was in the set.
+        """
+        return self._change('remove', members)
+
+    def _change(self, op: str, members: tuple) -> List[bool]:
+        if not members:
+            return []
+
+        command = 'sadd' if op == 'add' else 'srem'
+        pipe = self.redis.pipeline()
+        for member in members:
+            getattr(pipe, command)(self.key, member)
+        pipe.publish(self.channel, json.dumps({'op': op, 'members': list(members)}))
+        results = pipe.execute()
+
+        # Don't wait for our own announcement to come back around
+        self._apply(op, members)
+        return [result == 1 for result in results[:-1]]
+
+    def _apply(self, op: str, members: tuple) -> None:
+        with self._lock:
+            if op == 'add':
+                self._members = self._members.union(members)
+            elif op == 'remove':
+                self._members = self._members.difference(members)
+
+    def _handle_message(self, message: Dict) -> None:
+        try:
+            update = json.loads(message['data'].decode())
+            self._apply(update['op'], tuple(update['members']))
+        except (ValueError, KeyError, AttributeError) as e:
+            log.warning(f'{e} - Ignoring malformed update on {self.channel}: {message!r}')
+
+    def _listen(self) -> None:
+        with self._lock:
+            if self._listener and self._listener.is_alive():
+                return
+
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._handle_message})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
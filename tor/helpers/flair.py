@@ -1,15 +1,38 @@
+import csv
+import datetime
+import io
+import json
 import logging
-from typing import Tuple
+from typing import Any, Dict, List, Tuple
 
+from praw.const import API_PATH  # type: ignore
 from praw.models import Comment, Submission  # type: ignore
+from redis.exceptions import ResponseError
 
 from tor import __BOT_NAMES__
 from tor.core.config import Config
-from tor.core.helpers import clean_id, flair, send_to_modchat
+from tor.core.helpers import flair, get_comment, send_to_modchat
 from tor.core.users import User
+from tor.helpers.leaderboard import Leaderboard
 
 log = logging.getLogger(__name__)
 
+# Users whose flair needs to catch up with their count in Redis
+FLAIR_UPDATE_QUEUE = 'flair_updates'
+
+# What comes after the count for people who have never had flair
+DEFAULT_FLAIR_SUFFIX = ' - Beta Tester'
+
+# Kept in place of the suffix for people with flair of their own, so that we
+# neither look it up again nor ever replace it
+CUSTOM_FLAIR = False
+
+# The most users the bulk flair endpoint takes per request
+FLAIR_CSV_BATCH_SIZE = 100
+
+# How often every flair on the subreddit is checked against Redis
+FLAIR_RECONCILE_INTERVAL = datetime.timedelta(hours=6)
+
 
 def flair_post(post: Submission, text: str) -> None:
     """
@@ -39,93 +62,248 @@ def flair_post(post: Submission, text: str) -> None:
     log.error(f'Cannot find requested flair {text}. Not flairing.')
 
 
+def project_flair(post: Submission, text: str, cfg: Config) -> None:
+    """
+    Queues up a flair change for a post without waiting for Reddit. The state
+    of the post lives in Redis, so the flair just has to catch up eventually;
+    changes are applied one at a time in the order they were queued.
+
+    :param post: A Submission object on ToR.
+    :param text: String. The name of the flair template to apply.
+    :param cfg: The global config instance.
+    :return: None.
+    """
+    def report_failure(job) -> None:
+        error = job.exception()
+        if error:
+            log.error(f'{error} - unable to set flair {text!r} on {post.fullname}')
+
+    cfg.flair_writer.submit(flair_post, post, text).add_done_callback(report_failure)
+
+
+# (minimum transcriptions, CSS class) for each flair tier, highest first
+FLAIR_TIERS = [
+    (10000, 'grafeas-jade'),
+    (5000, 'grafeas-topaz'),
+    (2500, 'grafeas-ruby'),
+    (1000, 'grafeas-diamond'),
+    (500, 'grafeas-golden'),
+    (250, 'grafeas-purple'),
+    (100, 'grafeas-teal'),
+    (50, 'grafeas-green'),
+    (0, 'grafeas'),
+]
+
+
 def _get_flair_css(transcription_count: int) -> str:
-    if transcription_count >= 10000:
-        return 'grafeas-jade'
-    elif transcription_count >= 5000:
-        return 'grafeas-topaz'
-    elif transcription_count >= 2500:
-        return 'grafeas-ruby'
-    elif transcription_count >= 1000:
-        return 'grafeas-diamond'
-    elif transcription_count >= 500:
-        return 'grafeas-golden'
-    elif transcription_count >= 250:
-        return 'grafeas-purple'
-    elif transcription_count >= 100:
-        return 'grafeas-teal'
-    elif transcription_count >= 50:
-        return 'grafeas-green'
-    else:
-        return 'grafeas'
+    for minimum, css in FLAIR_TIERS:
+        if transcription_count >= minimum:
+            return css
+    return 'grafeas'
 
 
-def _parse_existing_flair(user_flair: str) -> Tuple[int, str]:
+def _split_flair(user_flair: str) -> Tuple[int, str]:
     """
-    Take the flair string and identify the proper incremented score along with
-    its matching CSS class.
+    Take the flair string and pull out the transcription count along with
+    whatever comes after the Γ, which we keep intact.
 
-    :param user_flair: String; the existing flair string for the user.
-    :return:
+    :param user_flair: String; the existing flair string for the user, like
+        '51 Γ - Beta Tester'.
+    :return: the count and the rest of the flair, like (51, ' - Beta Tester').
     """
+    count = int(user_flair[:user_flair.index('Γ') - 1])
+    suffix = user_flair[user_flair.index('Γ') + 1:]
+    return count, suffix
 
-    # extract their current flair and add one to it
-    new_flair_count = int(user_flair[:user_flair.index('Γ') - 1]) + 1
 
-    css = _get_flair_css(new_flair_count)
+def _flair_text(count: int, suffix: str) -> str:
+    return f'{count} Γ{suffix}'
 
-    return new_flair_count, css
+
+def _flair_csv(flair_list: List[Dict[str, Any]]) -> str:
+    """
+    Build the body of a bulk flair request. Reddit reads it as CSV, so
+    anything in a suffix like quotes or commas has to be escaped.
+    """
+    rows = io.StringIO()
+    writer = csv.writer(rows, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    for item in flair_list:
+        writer.writerow([item['user'], item['flair_text'], item['flair_css_class']])
+    return rows.getvalue().rstrip('\n')
+
+
+def queue_flair_update(username: str, cfg: Config) -> None:
+    """
+    Mark a user's flair as out of date. It is brought in line with their
+    count the next time `push_flair_updates` runs.
+    """
+    cfg.redis.sadd(FLAIR_UPDATE_QUEUE, username)
 
 
 def update_user_flair(post: Comment, cfg: Config) -> None:
     """
-    On a successful transcription, this takes the user's current flair,
-    increments the counter by one, and stores it back to the subreddit.
+    On a successful transcription, this increments the user's count in Redis
+    (which is the real count) and queues their flair to be updated to match.
 
-    If the user is past 50 transcriptions, select the appropriate flair
-    class and write that back too.
+    The first time we see someone, we read their current flair instead, both
+    to keep anything special after the Γ and so that nobody loses
+    transcriptions that were only ever counted in their flair. Whatever we
+    find is stored, so that only ever happens once per person; custom flair
+    is remembered as `CUSTOM_FLAIR` and left alone from then on.
 
     :param post: The post which holds the author information.
     :param cfg: The global config instance.
     :return: None.
     """
-    flair_text = '{} Γ - Beta Tester'
-
     post_author = User(str(post.author), redis_conn=cfg.redis)
-    current_transcription_count = post_author.get('transcriptions', 0)
+    new_total = post_author.increment('transcriptions')
 
-    try:
-        # The post object is technically an inbox mention, even though it's
-        # a Comment object. In order to get the flair, we have to take the
-        # ID of our post object and re-request it from Reddit in order to
-        # get the *actual* object, even though they have the same ID. It's
-        # weird.
-        user_flair = cfg.r.comment(id=clean_id(post.fullname)).author_flair_text
-    except AttributeError:
-        user_flair = flair_text.format('0')
-
-    if not user_flair:
-        # HOLD ON. Do we have one saved? Maybe Reddit's screwing up.
-        if current_transcription_count != 0:
-            # we have a user object for them and shouldn't have landed here.
-            user_flair = flair_text.format(current_transcription_count)
+    suffix = post_author.get('flair_suffix')
+    if suffix is None:
+        try:
+            # The post object is technically an inbox mention, even though
+            # it's a Comment object. In order to get the flair, we have to
+            # take the ID of our post object and re-request it from Reddit in
+            # order to get the *actual* object, even though they have the same
+            # ID. It's weird.
+            user_flair = get_comment(cfg.r, post.fullname).author_flair_text
+        except AttributeError:
+            user_flair = None
+
+        if user_flair and 'Γ' not in user_flair:
+            # Custom flair that isn't ours to touch
+            log.info(f'Not managing custom flair {user_flair!r} of {post.author}')
+            suffix = CUSTOM_FLAIR
         else:
-            user_flair = flair_text.format('0')
+            flair_count, suffix = _split_flair(user_flair) if user_flair else (0, DEFAULT_FLAIR_SUFFIX)
+            if flair_count + 1 > new_total:
+                new_total = post_author.increment('transcriptions', flair_count + 1 - new_total)
+        post_author.update('flair_suffix', suffix)
+        post_author.save()
 
-    if 'Γ' in user_flair:
-        new_count, flair_css = _parse_existing_flair(user_flair)
+    Leaderboard(cfg.redis).set(post_author.username, new_total)
+    if suffix is not CUSTOM_FLAIR:
+        queue_flair_update(post_author.username, cfg)
 
-        # if there's anything special in their flair string, let's save it
-        additional_flair_text = user_flair[user_flair.index('Γ') + 1:]
-        user_flair = f'{new_count} Γ'
-        # add in that special flair bit back in to keep their flair intact
-        user_flair += additional_flair_text
 
-        cfg.tor.flair.set(post.author, text=user_flair, css_class=flair_css)
-        log.info(f'Setting flair for {post.author}')
+def push_flair_updates(cfg: Config) -> int:
+    """
+    Set the flair of everyone queued by `queue_flair_update` to match their
+    count in Redis, up to `FLAIR_CSV_BATCH_SIZE` people per request.
 
-        post_author.update('transcriptions', current_transcription_count + 1)
-        post_author.save()
+    :param cfg: The global config instance.
+    :return: the number of flairs that were set.
+    """
+    usernames = [username.decode() for username in cfg.redis.smembers(FLAIR_UPDATE_QUEUE)]
+    if not usernames:
+        return 0
+
+    # Take them off the queue before reading their counts; anyone who
+    # completes another post in the meantime is simply queued again.
+    cfg.redis.srem(FLAIR_UPDATE_QUEUE, *usernames)
+
+    pipe = cfg.redis.pipeline()
+    for username in usernames:
+        pipe.hmget(User.redis_key_for(username), 'transcriptions', 'flair_suffix')
+
+    flair_list = []
+    for username, (count, suffix) in zip(usernames, pipe.execute()):
+        if count is None or suffix is None:
+            continue
+        count, suffix = json.loads(count.decode()), json.loads(suffix.decode())
+        if suffix is CUSTOM_FLAIR:
+            continue
+        flair_list.append({
+            'user': username,
+            'flair_text': _flair_text(count, suffix),
+            'flair_css_class': _get_flair_css(count),
+        })
+
+    # Not `cfg.tor.flair.update`, which puts the values in quotes without
+    # escaping the ones already in them
+    url = API_PATH['flaircsv'].format(subreddit=cfg.tor)
+    results = []
+    try:
+        for start in range(0, len(flair_list), FLAIR_CSV_BATCH_SIZE):
+            batch = flair_list[start:start + FLAIR_CSV_BATCH_SIZE]
+            results.extend(cfg.r.post(url, data={'flair_csv': _flair_csv(batch)}))
+    except Exception:
+        # Put everyone back so we try again next time
+        cfg.redis.sadd(FLAIR_UPDATE_QUEUE, *usernames)
+        raise
+
+    failed = [result for result in results if not result.get('ok')]
+    if failed:
+        log.error(f'Unable to set {len(failed)} flairs: {failed}')
+    log.info(f'Set flair for {len(flair_list) - len(failed)} users')
+    return len(flair_list) - len(failed)
+
+
+def reconcile_flair(cfg: Config) -> int:
+    """
+    Compare every transcriber flair on the subreddit with the counts in
+    Redis and queue up fixes for any that have fallen behind. People we have
+    no count for yet have theirs picked up from their flair. Flair that is
+    ahead of Redis was most likely set by hand by a mod, so it is left alone
+    and logged instead of being brought back down.
+
+    :param cfg: The global config instance.
+    :return: the number of flairs that were queued to be fixed.
+    """
+    drifted = 0
+    batch: List[Tuple[str, int, str]] = []
+
+    def check(batch: List[Tuple[str, int, str]]) -> int:
+        pipe = cfg.redis.pipeline()
+        for username, _count, _suffix in batch:
+            pipe.hmget(User.redis_key_for(username), 'transcriptions', 'flair_suffix')
+
+        fixes = 0
+        for (username, flair_count, suffix), stored in zip(batch, pipe.execute(raise_on_error=False)):
+            if isinstance(stored, ResponseError):
+                # Saved the old way by a bot that hasn't been upgraded yet;
+                # loading the user converts them
+                user = User(username, redis_conn=cfg.redis)
+                count, stored_suffix = user.get('transcriptions'), user.get('flair_suffix')
+            else:
+                count, stored_suffix = (None if value is None else json.loads(value.decode()) for value in stored)
+            if count is None:
+                user = User(username, redis_conn=cfg.redis)
+                user.increment('transcriptions', flair_count)
+                user.update('flair_suffix', suffix)
+                user.save()
+                Leaderboard(cfg.redis).set(username, flair_count)
+                continue
+            if stored_suffix is None or stored_suffix is CUSTOM_FLAIR:
+                # Their flair is one of ours (again), so it's managed from now on
+                cfg.redis.hset(User.redis_key_for(username), 'flair_suffix', json.dumps(suffix))
+            if flair_count > count:
+                log.warning(
+                    f'Flair of {username} says {flair_count} but Redis has {count}; '
+                    f'leaving it alone in case a mod set it'
+                )
+            elif flair_count < count:
+                queue_flair_update(username, cfg)
+                fixes += 1
+        return fixes
+
+    for user_flair in cfg.tor.flair(limit=None):
+        text = user_flair.get('flair_text') or ''
+        if 'Γ' not in text:
+            continue
+        try:
+            flair_count, suffix = _split_flair(text)
+        except ValueError:
+            continue
+        batch.append((str(user_flair['user']), flair_count, suffix))
+        if len(batch) >= 100:
+            drifted += check(batch)
+            batch = []
+    if batch:
+        drifted += check(batch)
+
+    log.info(f'Flair reconciliation queued {drifted} fixes')
+    return drifted
 
 
 def set_meta_flair_on_other_posts(cfg: Config) -> None:
@@ -140,7 +318,7 @@ def set_meta_flair_on_other_posts(cfg: Config) -> None:
     for post in cfg.tor.new(limit=10):
         if str(post.author) in __BOT_NAMES__:
             continue
-        if str(post.author) in cfg.tor_mods:
+        if str(post.author).casefold() in cfg.tor_mods:
             continue
         if post.link_flair_text == flair.meta:
             continue
@@ -0,0 +1,142 @@
+"""
+Transcription counts for every volunteer, kept in a Redis sorted set so that
+ranks, the top N and how many people are in each flair tier can be answered
+without looking at every user.
+
+The counts are copied from the user records as they change; `rebuild` fills
+the set from scratch out of the existing user records.
+"""
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from redis import StrictRedis
+
+from tor.core.users import USER_KEY
+
+log = logging.getLogger(__name__)
+
+LEADERBOARD_KEY = 'leaderboard'
+
+
+class Leaderboard(object):
+    """
+    Usage:
+    leaderboard = Leaderboard(config.redis)
+    leaderboard.set('pam', 51)
+    leaderboard.rank('pam')  # 1
+    leaderboard.top(10)  # [('pam', 51)]
+    """
+
+    def __init__(self, redis_conn: StrictRedis, key=LEADERBOARD_KEY) -> None:
+        if not redis_conn:
+            raise ValueError('Missing Redis connection')
+
+        self.redis = redis_conn
+        self.key = key
+
+    def set(self, username: str, count: int) -> None:
+        self.redis.zadd(self.key, count, username)
+
+    def count(self, username: str) -> Optional[int]:
+        score = self.redis.zscore(self.key, username)
+        return int(score) if score is not None else None
+
+    def rank(self, username: str) -> Optional[int]:
+        """
+        :return: the position of the user on the leaderboard, starting at 1,
+            or None if they have no transcriptions on record.
+        """
+        rank = self.redis.zrevrank(self.key, username)
+        return rank + 1 if rank is not None else None
+
+    def top(self, n=10) -> List[Tuple[str, int]]:
+        """
+        :return: List of (username, count) for the n users with the most
+            transcriptions, best first.
+        """
+        return [
+            (username.decode(), int(score))
+            for username, score in self.redis.zrevrange(self.key, 0, n - 1, withscores=True)
+        ]
+
+    def tier_counts(self, tiers: List[Tuple[int, str]]) -> Dict[str, int]:
+        """
+        Count the users in each tier.
+
+        :param tiers: List of (minimum count, name), highest first, like
+            `FLAIR_TIERS`.
+        :return: Dict of tier name to the number of users in it.
+        """
+        pipe = self.redis.pipeline()
+        upper = '+inf'
+        for minimum, _name in tiers:
+            pipe.zcount(self.key, minimum, upper)
+            upper = f'({minimum}'
+        return {name: count for (_minimum, name), count in zip(tiers, pipe.execute())}
+
+    def rebuild(self, batch_size=500) -> int:
+        """
+        Fill the leaderboard from the transcription counts in every user
+        record. The new set is built on the side and swapped in at the end,
+        so the leaderboard is never half-empty. Completions that happen while
+        it's running may be lost, so it's best run when things are quiet.
+
+        :return: the number of users on the new leaderboard.
+        """
+        staging_key = f'{self.key}::rebuild'
+        self.redis.delete(staging_key)
+
+        usernames: List[str] = []
+        total = 0
+        for raw_key in self.redis.scan_iter(match=USER_KEY.format('*'), count=batch_size):
+            username = raw_key.decode()[len(USER_KEY.format('')):]
+            if '::' in username:
+                # One of the list keys that hang off a user
+                continue
+            usernames.append(username)
+            if len(usernames) >= batch_size:
+                total += self._stage(staging_key, usernames)
+                usernames = []
+        total += self._stage(staging_key, usernames)
+
+        if total:
+            self.redis.rename(staging_key, self.key)
+        else:
+            self.redis.delete(self.key)
+        log.info(f'Rebuilt the leaderboard with {total} users')
+        return total
+
+    def _stage(self, staging_key: str, usernames: List[str]) -> int:
+        if not usernames:
+            return 0
+
+        pipe = self.redis.pipeline()
+        for username in usernames:
+            pipe.type(USER_KEY.format(username))
+        key_types = pipe.execute()
+
+        for username, key_type in zip(usernames, key_types):
+            if key_type == b'hash':
+                pipe.hget(USER_KEY.format(username), 'transcriptions')
+            else:
+                # Not migrated yet; the whole record is one JSON blob
+                pipe.get(USER_KEY.format(username))
+        records = pipe.execute()
+
+        counts = {}
+        for username, key_type, record in zip(usernames, key_types, records):
+            if not record:
+                continue
+            if key_type == b'hash':
+                count = json.loads(record.decode())
+            else:
+                count = json.loads(record.decode()).get('transcriptions', 0)
+            if count:
+                counts[username] = int(count)
+
+        if counts:
+            self.redis.zadd(staging_key, *(
+                item for username, count in counts.items() for item in (count, username)
+            ))
+        return len(counts)
@@ -0,0 +1,208 @@
+"""
+Sends messages to the mod chat from a background thread so that a slow (or
+unavailable) Slack API never holds up anything that has to talk to Reddit.
+
+Messages are queued and the sender works through them one channel at a time,
+never posting to the same channel more often than `min_interval`. Messages
+that pile up for a channel in the meantime are merged into one post. If the
+queue is full, new messages are dropped (and logged) rather than blocking.
+Whatever is still queued is sent when the process exits, as long as Slack
+lets us before the flush times out; anything left after that is logged and
+dropped.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from tor.core.metrics import SLACK_CALLS, record_rate_limit
+
+log = logging.getLogger(__name__)
+
+# Slack allows roughly one message per second per channel
+DEFAULT_MIN_INTERVAL = 1.0
+
+# How long to hold on to a message in case more show up for the same channel
+DEFAULT_COALESCE_WINDOW = 1.0
+
+# How long a channel is left alone after Slack tells us we're rate limited
+RATE_LIMITED_BACKOFF = 30.0
+
+# Slack truncates anything much longer than this, so batches are split up
+MAX_MESSAGE_LENGTH = 3500
+
+QueuedMessage = Tuple[str, str]
+
+
+class ModchatDispatcher(object):
+    """
+    Usage:
+    dispatcher = ModchatDispatcher(SlackClient(api_key))
+    dispatcher.send('general', 'Hello!')
+    """
+
+    def __init__(self, client, max_queue_size=1000, min_interval=DEFAULT_MIN_INTERVAL,
+                 coalesce_window=DEFAULT_COALESCE_WINDOW) -> None:
+        self.client = client
+        self.min_interval = min_interval
+        self.coalesce_window = coalesce_window
+        self.dropped = 0
+
+        self._queue: 'queue.Queue[Optional[QueuedMessage]]' = queue.Queue(maxsize=max_queue_size)
+        self._pending: Dict[str, List[str]] = OrderedDict()
+        self._pending_since: Dict[str, float] = {}
+        self._not_before: Dict[str, float] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._flush_on_exit = False
+        self._close_by = 0.0
+
+    def send(self, channel: str, message: str) -> bool:
+        """
+        Queue up a message without waiting for it to be sent.
+
+        :param channel: String; the name of the channel. '#' optional.
+        :param message: String; the message to send.
+        :return: True if the message was queued, False if it was dropped.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait((channel, message))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            log.error(
+                f'Modchat queue is full; dropped message to #{channel} '
+                f'({self.dropped} dropped so far): {message!r}'
+            )
+            return False
+
+    def flush(self, timeout=10.0) -> None:
+        """
+        Send everything that's still queued and stop the sender.
+
+        :param timeout: the most seconds to wait for Slack.
+        :return: None.
+        """
+        thread = self._thread
+        if not thread or not thread.is_alive():
+            return
+
+        self._close_by = time.time() + timeout
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            log.error('Modchat queue is still full; unable to flush it')
+            return
+        # The sender gives up at the deadline; this leaves it a moment to
+        # notice and log what it dropped
+        thread.join(max(0.0, self._close_by - time.time()) + 1.0)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='modchat', daemon=True)
+            self._thread.start()
+            # The sender is started again if it ever dies; flushing once
+            # at exit covers all of them
+            if not self._flush_on_exit:
+                atexit.register(self.flush)
+                self._flush_on_exit = True
+
+    def _run(self) -> None:
+        closing = False
+        while not closing or self._pending:
+            try:
+                item = self._queue.get(timeout=self._next_wakeup(closing))
+                if item is None:
+                    closing = True
+                else:
+                    self._hold(*item)
+                # Grab anything else that's already waiting so it can be merged
+                while True:
+                    item = self._queue.get_nowait()
+                    if item is None:
+                        closing = True
+                    else:
+                        self._hold(*item)
+            except queue.Empty:
+                pass
+
+            for channel in self._ready_channels(closing):
+                self._post(channel)
+
+            if closing and self._pending and time.time() >= self._close_by:
+                self._drop_pending()
+
+    def _drop_pending(self) -> None:
+        for channel, messages in self._pending.items():
+            self.dropped += len(messages)
+            log.error(
+                f'Out of time to send {len(messages)} message(s) to modchat #{channel} '
+                f'before exiting; dropped: {messages!r}'
+            )
+        self._pending.clear()
+        self._pending_since.clear()
+
+    def _hold(self, channel: str, message: str) -> None:
+        self._pending.setdefault(channel, []).append(message)
+        self._pending_since.setdefault(channel, time.time())
+
+    def _next_wakeup(self, closing=False) -> float:
+        if not self._pending:
+            return 1.0
+        wakeup = min(self._ready_at(channel, closing) for channel in self._pending)
+        if closing:
+            wakeup = min(wakeup, self._close_by)
+        return max(0.05, wakeup - time.time())
+
+    def _ready_at(self, channel: str, closing=False) -> float:
+        not_before = self._not_before.get(channel, 0.0)
+        if closing:
+            # Nothing else is coming to merge with, but Slack's limits still apply
+            return not_before
+        return max(not_before, self._pending_since[channel] + self.coalesce_window)
+
+    def _ready_channels(self, closing=False) -> List[str]:
+        now = time.time()
+        return [
+            channel for channel in list(self._pending)
+            if self._ready_at(channel, closing) <= now
+        ]
+
+    def _post(self, channel: str) -> None:
+        messages = self._pending.pop(channel)
+        del self._pending_since[channel]
+
+        batch = messages.pop(0)
+        while messages and len(batch) + len(messages[0]) + 2 <= MAX_MESSAGE_LENGTH:
+            batch += '\n\n' + messages.pop(0)
+        if messages:
+            # Didn't all fit; the rest goes out in the next post
+            self._pending[channel] = messages
+            self._pending_since[channel] = time.time()
+
+        self._not_before[channel] = time.time() + self.min_interval
+        started = time.monotonic()
+        try:
+            response = self.client.api_call('chat.postMessage', channel=channel, text=batch)
+        except Exception as e:
+            SLACK_CALLS.observe(time.monotonic() - started, method='chat.postMessage', outcome='error')
+            log.error(f'Failed to send message to modchat #{channel}: \'{batch}\'')
+            log.error(e)
+            return
+
+        ratelimited = isinstance(response, dict) and response.get('error') == 'ratelimited'
+        SLACK_CALLS.observe(
+            time.monotonic() - started, method='chat.postMessage', outcome='ratelimited' if ratelimited else 'ok'
+        )
+        if ratelimited:
+            record_rate_limit('slack', RATE_LIMITED_BACKOFF)
+            log.warning(f'Rate limited by Slack on #{channel}; backing off for {RATE_LIMITED_BACKOFF}s')
+            self._pending[channel] = [batch] + self._pending.get(channel, [])
+            self._pending_since.setdefault(channel, time.time())
+            self._not_before[channel] = time.time() + RATE_LIMITED_BACKOFF
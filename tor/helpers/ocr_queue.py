@@ -0,0 +1,183 @@
+"""
+Job queue for the OCR bot, built on a Redis Stream with a consumer group.
+
+Each job is a single stream entry carrying the whole payload, so publishing is
+one call and there are no per-post keys left lying around afterwards. Workers
+read through the consumer group, acknowledge jobs once they are finished and
+pick up jobs that a crashed worker left pending.
+
+The redis client we're pinned to predates the stream commands, so they are
+sent with `execute_command` and the replies are unpacked by hand.
+
+Usage (on the OCR side):
+    queue = OCRJobQueue(config.redis, consumer='transcribot-1')
+    queue.ensure_group()
+    for job in queue.reclaim() + queue.read():
+        ...  # do the work
+        queue.ack(job.id)
+"""
+import logging
+import os
+import socket
+from typing import Any, List, NamedTuple, Optional
+
+from redis import StrictRedis
+from redis.exceptions import ResponseError
+
+log = logging.getLogger(__name__)
+
+OCR_STREAM = 'ocr_jobs'
+OCR_GROUP = 'ocr_workers'
+
+# Approximate cap on the length of the stream; Redis trims old entries as new
+# ones come in so the stream can't grow forever.
+OCR_STREAM_MAXLEN = 10000
+
+# A job that has been handed out this many times without being acknowledged
+# is considered poisoned and is dropped.
+OCR_MAX_DELIVERIES = 5
+
+
+class OCRJob(NamedTuple):
+    id: str
+    post_name: str
+    tor_fullname: str
+
+
+def _decode(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _parse_entry(entry: List[Any]) -> Optional[OCRJob]:
+    """
+    Stream entries come back as `[id, [field, value, field, value, ...]]`.
+    The field list is empty if the entry was trimmed while still pending.
+    """
+    entry_id, raw_fields = entry
+    if not raw_fields:
+        return None
+
+    fields = dict(zip(
+        (_decode(key) for key in raw_fields[::2]),
+        (_decode(value) for value in raw_fields[1::2]),
+    ))
+    return OCRJob(_decode(entry_id), fields.get('post_name', ''), fields.get('tor_fullname', ''))
+
+
+def default_consumer_name() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class OCRJobQueue(object):
+    def __init__(self, redis_conn: StrictRedis, consumer: Optional[str] = None,
+                 stream=OCR_STREAM, group=OCR_GROUP) -> None:
+        if not redis_conn:
+            raise ValueError('Missing Redis connection')
+
+        self.redis = redis_conn
+        self.consumer = consumer or default_consumer_name()
+        self.stream = stream
+        self.group = group
+
+    def publish(self, post_name: str, tor_fullname: str) -> str:
+        """
+        Queue up an OCR job in a single call.
+
+        :param post_name: the fullname of the post on the partner subreddit.
+        :param tor_fullname: the fullname of our post on ToR.
+        :return: the ID of the stream entry.
+        """
+        entry_id = self.redis.execute_command(
+            'XADD', self.stream, 'MAXLEN', '~', OCR_STREAM_MAXLEN, '*',
+            'post_name', post_name,
+            'tor_fullname', tor_fullname,
+        )
+        return _decode(entry_id)
+
+    def ensure_group(self) -> None:
+        """
+        Create the consumer group (and the stream) if it doesn't exist yet.
+        """
+        try:
+            self.redis.execute_command('XGROUP', 'CREATE', self.stream, self.group, '0', 'MKSTREAM')
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, count=10, block_ms=5000) -> List[OCRJob]:
+        """
+        Fetch jobs that have never been handed to any worker in the group.
+
+        :param count: the most jobs to return at once.
+        :param block_ms: how long to wait for new jobs before giving up.
+        :return: List of jobs. They must be `ack`ed once they are done.
+        """
+        response = self.redis.execute_command(
+            'XREADGROUP', 'GROUP', self.group, self.consumer,
+            'COUNT', count, 'BLOCK', block_ms,
+            'STREAMS', self.stream, '>',
+        )
+        if not response:
+            return []
+
+        jobs = []
+        for _stream, entries in response:
+            for entry in entries:
+                job = _parse_entry(entry)
+                if job:
+                    jobs.append(job)
+        return jobs
+
+    def ack(self, *job_ids: str) -> int:
+        """
+        Mark jobs as finished so they are never handed out again.
+
+        :return: the number of jobs that were acknowledged.
+        """
+        if not job_ids:
+            return 0
+        return self.redis.execute_command('XACK', self.stream, self.group, *job_ids)
+
+    def reclaim(self, min_idle_ms=5 * 60 * 1000, count=10) -> List[OCRJob]:
+        """
+        Take over jobs that another worker received but never acknowledged,
+        most likely because it crashed. Jobs that have failed too often are
+        acknowledged and dropped instead.
+
+        :param min_idle_ms: how long a job must have been pending before it is
+            considered abandoned.
+        :param count: the most pending jobs to look at.
+        :return: List of jobs that now belong to this worker.
+        """
+        pending = self.redis.execute_command('XPENDING', self.stream, self.group, '-', '+', count)
+
+        claimable = []
+        poisoned = []
+        for entry_id, _consumer, idle_ms, deliveries in pending or []:
+            if int(idle_ms) < min_idle_ms:
+                continue
+            if int(deliveries) >= OCR_MAX_DELIVERIES:
+                poisoned.append(_decode(entry_id))
+            else:
+                claimable.append(_decode(entry_id))
+
+        if poisoned:
+            log.warning(f'Dropping OCR jobs that failed {OCR_MAX_DELIVERIES} times: {poisoned}')
+            self.ack(*poisoned)
+
+        if not claimable:
+            return []
+
+        entries = self.redis.execute_command(
+            'XCLAIM', self.stream, self.group, self.consumer, min_idle_ms, *claimable
+        )
+
+        jobs = []
+        for entry in entries or []:
+            job = _parse_entry(entry) if entry else None
+            if job:
+                jobs.append(job)
+            elif entry:
+                # The payload was trimmed from the stream; nothing to retry.
+                self.ack(_decode(entry[0]))
+        return jobs
@@ -9,12 +9,12 @@ import logging
 import random
 import string
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime, timedelta
 from typing import Dict, List
 
 import requests
 
 from tor.core.config import Config
+from tor.core.metrics import POSTS, SUBREDDIT_FETCH_DURATION, SUBREDDIT_FETCH_ERRORS
 from tor.core.posts import process_post, PostSummary
 
 
@@ -39,7 +39,7 @@ def check_domain_filter(item: Dict, cfg: Config) -> bool:
     return False
 
 
-def get_subreddit_posts(sub: str) -> List[PostSummary]:
+def get_subreddit_posts(sub: str, http: requests.Session) -> List[PostSummary]:
 
     def generate_user_agent() -> str:
         """
@@ -76,7 +76,8 @@ def get_subreddit_posts(sub: str) -> List[PostSummary]:
                     'locked': item['locked'],
                     'archived': item['archived'],
                     'author': item.get('author', None),
-                    'url': item['url']
+                    'url': item['url'],
+                    'created_utc': item.get('created_utc', None),
                 })
         return trimmed_links
 
@@ -84,21 +85,23 @@ def get_subreddit_posts(sub: str) -> List[PostSummary]:
         'User-Agent': generate_user_agent()
     }
     url = f'https://www.reddit.com/r/{sub}/new/.json'
-    result = requests.get(url, headers=headers).json()
+    try:
+        with SUBREDDIT_FETCH_DURATION.time(subreddit=sub):
+            result = http.get(url, headers=headers).json()
+    except Exception:
+        SUBREDDIT_FETCH_ERRORS.inc(subreddit=sub)
+        raise
     # we have two states here: one has the data we want and the other is an
     # error state. The error state looks like this:
     # {'message': 'Too Many Requests', 'error': 429}
 
     if result.get('error', None):
+        SUBREDDIT_FETCH_ERRORS.inc(subreddit=sub)
         logging.warning('hit error state for {}'.format(sub))
         return []
     return parse_json_posts(result)
 
 
-def is_time_to_scan(cfg: Config) -> bool:
-    return datetime.now() > cfg.last_post_scan_time + timedelta(seconds=45)
-
-
 def threaded_check_submissions(cfg: Config) -> None:
     """
     Single threaded PRAW performance:
@@ -111,13 +114,6 @@ def threaded_check_submissions(cfg: Config) -> None:
     finished in 1.3632569313049316s
     """
 
-    if not is_time_to_scan(cfg):
-        # we're still within the defined time window from the last time we
-        # looked for new posts. We'll try again later.
-        return
-
-    cfg.last_post_scan_time = datetime.now()
-
     subreddits = cfg.subreddits_to_check
 
     total_posts: List[PostSummary] = []
@@ -127,7 +123,7 @@ def threaded_check_submissions(cfg: Config) -> None:
     with ThreadPoolExecutor() as executor:
         jobs = list()
         for sub in subreddits:
-            jobs.append(executor.submit(get_subreddit_posts, sub))
+            jobs.append(executor.submit(get_subreddit_posts, sub, cfg.http))
         for f in as_completed(jobs):
             try:
                 data: List[PostSummary] = f.result()
@@ -135,6 +131,9 @@ def threaded_check_submissions(cfg: Config) -> None:
             except Exception as exc:
                 logging.warning('an exception was generated: {}'.format(exc))
 
+    POSTS.inc(len(total_posts), outcome='scanned')
     for item in total_posts:
         if check_domain_filter(item, cfg):
             process_post(item, cfg)
+        else:
+            POSTS.inc(outcome='filtered')